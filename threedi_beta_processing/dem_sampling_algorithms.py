@@ -11,11 +11,15 @@
 ***************************************************************************
 """
 
-from typing import (Any, Dict, Tuple, Union, List)
+import os
+from collections import defaultdict
+from functools import lru_cache
+from typing import (Any, Dict, Tuple, Union, List, Optional)
 
 from osgeo import ogr
 from osgeo import gdal
 import numpy as np
+import shapely
 
 from qgis.PyQt.QtCore import (QCoreApplication, QVariant)
 from qgis.core import (
@@ -34,7 +38,7 @@ from qgis.core import (
     QgsProcessingAlgorithm,
     QgsProcessingContext,
     QgsProcessingFeatureSource,
-    QgsProcessingMultiStepFeedback,
+    QgsProcessingFeedback,
     QgsProcessingParameterBoolean,
     QgsProcessingParameterFeatureSource,
     QgsProcessingParameterFeatureSink,
@@ -44,9 +48,9 @@ from qgis.core import (
     QgsRasterLayer,
     QgsVectorLayer
 )
-import processing
 
-from .raster_tools.dem_sampler import AttributeProcessor
+from .raster_tools.dem_sampler import AttributeProcessor, PointProcessor, ZonalMinimumProcessor
+from .raster_tools.groups import BlockCache
 
 # Calculation types channel (taken from CalculationType in threedi_modelchecker.threedi_model.constants)
 EMBEDDED = 100
@@ -65,25 +69,37 @@ EGG = 3
 TABULATED_RECTANGLE = 5
 TABULATED_TRAPEZIUM = 6
 
+# shapely geometry type ids
+LINESTRING = 1
+MULTILINESTRING = 5
+
 ogr.UseExceptions()
 gdal.UseExceptions()
 
 
 def cross_section_max_width(shape: int, width: float, table: str):
-    if shape in [0, 1, 2, 3]:
+    """
+    Return the maximum width of a cross section definition
+
+    Results are cached per distinct (shape, width, table), so each definition is parsed only once, also across
+    algorithm runs in the same session.
+    """
+    return _cross_section_max_width(*[None if value == NULL else value for value in (shape, width, table)])
+
+
+@lru_cache(maxsize=4096)
+def _cross_section_max_width(shape: int, width: float, table: str):
+    if shape in [CLOSED_RECTANGLE, RECTANGLE, CIRCLE, EGG]:
         if width is None:
             raise ValueError(f'Invalid cross section: width is required for shape {shape}')
         return width
-    elif shape in [5, 6]:
+    elif shape in [TABULATED_RECTANGLE, TABULATED_TRAPEZIUM]:
         try:
-            max_width = 0
-            height_width_pairs = table.split('\n')
-            for height_width_pair in height_width_pairs:
-                width_str = height_width_pair[1]
-                width = float(width_str)
-                if width > max_width:
-                    max_width = width
-            return max_width
+            height_width_pairs = np.array(
+                [line.split(',') for line in table.splitlines() if line.strip()],
+                dtype=float
+            )
+            return max(0.0, float(height_width_pairs[:, 1].max()))
         except Exception:
             raise ValueError(f'Invalid cross section table')
     else:
@@ -108,10 +124,61 @@ def add_float_field_if_not_exists(source: Union[QgsFeature, QgsProcessingFeature
     return result_fields, result_field_idx, field_added
 
 
+def point_coordinates(features: List[QgsFeature], coordinate_transform: QgsCoordinateTransform,
+                      feedback: QgsProcessingFeedback = None) -> np.ndarray:
+    """
+    Return (n, 2) array of the transformed point coordinates of the features, NaN for empty geometries
+
+    For multipoint geometries, the first point is used. A warning is pushed to feedback if any of them has more than
+    one point.
+    """
+    points = np.full((len(features), 2), np.nan)
+    multipoint_feature_ids = []
+    for i, feature in enumerate(features):
+        geom = QgsGeometry(feature.geometry())
+        if geom.isEmpty():
+            continue
+        geom.transform(coordinate_transform)
+        if geom.constGet().nCoordinates() > 1:
+            multipoint_feature_ids.append(feature.id())
+        point = geom.vertexAt(0)
+        points[i] = point.x(), point.y()
+    if multipoint_feature_ids and feedback is not None:
+        feedback.pushWarning(
+            f'Warning: {len(multipoint_feature_ids)} feature(s) have more than one point, only the first point is '
+            f'sampled. Feature ids: {", ".join(str(fid) for fid in multipoint_feature_ids)}'
+        )
+    return points
+
+
+def sample_points(processor: Union[PointProcessor, ZonalMinimumProcessor], points: np.ndarray,
+                  feedback: QgsProcessingFeedback, batch_size: int, progress_end: float = 100) -> Optional[np.ndarray]:
+    """
+    Return processor.process_many() result for the (n, 2) array of points, NaN for NaN points
+
+    Points are processed in batches of batch_size, setting progress from 0 to progress_end. Returns None if canceled.
+    """
+    result = np.full(len(points), np.nan)
+    valid_indices = np.flatnonzero(~np.isnan(points).any(axis=1))
+    for start in range(0, len(valid_indices), batch_size):
+        if feedback.isCanceled():
+            return None
+        batch = valid_indices[start:start + batch_size]
+        result[batch] = processor.process_many(points[batch])
+        feedback.setProgress(int(progress_end * (start + len(batch)) / len(valid_indices)))
+    return result
+
+
 class DemSamplerQgsConnector:
     """"Interface between dem_sampler.py and the QGIS API"""
+    # Number of features that are sampled together, reading each part of the DEM only once per batch
+    BATCH_SIZE = 1000
+    # Maximum size in bytes of the DEM blocks that are kept in memory between batches
+    BLOCK_CACHE_BYTES = 256 * 2 ** 20
+
     def __init__(self, raster: QgsRasterLayer, source: QgsProcessingFeatureSource, target_fieldname: str, width: float,
-                 distance: float, overwrite: bool, inverse: bool = False, modify: bool = False, average: int = None):
+                 distance: float, overwrite: bool, inverse: bool = False, modify: bool = False, average: int = None,
+                 max_workers: int = 1):
         self.source = source
         self.target_fieldname = target_fieldname
         self.target_fields, self.target_field_idx, field_added = add_float_field_if_not_exists(
@@ -126,13 +193,16 @@ class DemSamplerQgsConnector:
 
         dem_fn = raster.source()
         dem_ds = gdal.Open(dem_fn)
+        self.block_cache = BlockCache(max_bytes=self.BLOCK_CACHE_BYTES)
         self.processor = AttributeProcessor(
             raster=dem_ds,
             width=width,
             distance=distance,
             inverse=inverse,
             modify=modify,
-            average=average
+            average=average,
+            block_cache=self.block_cache,
+            max_workers=max_workers
         )
 
         src_crs = source.sourceCrs()
@@ -146,49 +216,117 @@ class DemSamplerQgsConnector:
             request = QgsFeatureRequest(QgsExpression(f'{self.target_fieldname} IS NULL'))
             self.features = self.source.getFeatures(request)
 
-    def results(self, return_features: bool = True, left: bool = True, right: bool = True, search_distance_field: str = None):
-        self._get_features()
-        for feature in self.features:
-            print(f'processing feature {feature.id()}')
-            input_qgs_geometry = QgsGeometry(feature.geometry())
-            if input_qgs_geometry.isEmpty():
-                raise ValueError(f'Feature {feature.id()} has an empty geometry. Please fix or remove this feature and '
-                                 f'try again.')
-            input_qgs_geometry.transform(self.coordinate_transform)
-            input_qgs_geometry_simple = input_qgs_geometry.simplify(0.01)
-            input_wkb_geometry = input_qgs_geometry_simple.asWkb()
-            input_ogr_geometry = ogr.Geometry(wkb=input_wkb_geometry)
+    def _batches(self, search_distance_field: str = None):
+        """
+        Yield (features, line feature indices, line coordinates, line distance overrides) for batches of at most
+        BATCH_SIZE features
+
+        The geometries of each batch are converted in bulk: WKB of the (transformed) QGIS geometries is read into
+        shapely, simplified and split into the coordinate arrays of their line strings. ``line feature indices`` refers
+        to the position of the line's feature in ``features``.
+
+        The processor is closed when all batches have been read or the caller stops reading, so that the DEM handles of
+        its worker threads are released.
+        """
+        try:
             if search_distance_field:
                 search_distance_field_idx = self.source.fields().indexFromName(search_distance_field)
                 if search_distance_field_idx == -1:
                     raise ValueError(f'Invalid search_distance_field: source has no field {search_distance_field}')
-                distance_override = feature[search_distance_field_idx]
-            else:
-                distance_override = None
-            processed_features = self.processor.process(
-                source_geometry=input_ogr_geometry,
+            self._get_features()
+            transform = not self.coordinate_transform.isShortCircuited()
+            features = []
+            wkbs = []
+            for feature in self.features:
+                input_qgs_geometry = feature.geometry()
+                if input_qgs_geometry.isEmpty():
+                    raise ValueError(f'Feature {feature.id()} has an empty geometry. Please fix or remove this feature '
+                                     f'and try again.')
+                if transform:
+                    input_qgs_geometry = QgsGeometry(input_qgs_geometry)
+                    input_qgs_geometry.transform(self.coordinate_transform)
+                features.append(feature)
+                wkbs.append(bytes(input_qgs_geometry.asWkb()))
+                if len(features) == self.BATCH_SIZE:
+                    yield self._convert_batch(features, wkbs, search_distance_field)
+                    features = []
+                    wkbs = []
+            if features:
+                yield self._convert_batch(features, wkbs, search_distance_field)
+        finally:
+            self.processor.close()
+
+    def _convert_batch(self, features: List[QgsFeature], wkbs: List[bytes], search_distance_field: str = None):
+        """See _batches()"""
+        geometries = shapely.simplify(shapely.from_wkb(wkbs), 0.01, preserve_topology=False)
+        type_ids = shapely.get_type_id(geometries)
+        invalid = ~np.isin(type_ids, [LINESTRING, MULTILINESTRING])
+        if invalid.any():
+            first_invalid = np.flatnonzero(invalid)[0]
+            raise ValueError(f'Unexpected geometry type: {geometries[first_invalid].geom_type} for feature '
+                             f'{features[first_invalid].id()}')
+        parts, line_feature_indices = shapely.get_parts(geometries, return_index=True)
+        coordinates = shapely.get_coordinates(parts)
+        line_coordinates = np.split(coordinates, np.cumsum(shapely.get_num_coordinates(parts))[:-1])
+        if search_distance_field:
+            distance_overrides = [feature[search_distance_field] for feature in features]
+            line_distance_overrides = [distance_overrides[i] for i in line_feature_indices]
+        else:
+            line_distance_overrides = None
+        return features, line_feature_indices, line_coordinates, line_distance_overrides
+
+    def results(self, return_features: bool = True, left: bool = True, right: bool = True, search_distance_field: str = None):
+        for features, line_feature_indices, line_coordinates, line_distance_overrides in self._batches(
+                search_distance_field=search_distance_field
+        ):
+            processed_lines = self.processor.process_coordinates(
+                line_nodes=line_coordinates,
                 left=left,
                 right=right,
-                distance_override=distance_override
+                distance_overrides=line_distance_overrides
             )
-            for output_ogr_geometry, crest_level in processed_features:
-                if not return_features:
+            if not return_features:
+                for _, crest_level in processed_lines:
                     yield crest_level
-                else:
-                    result_feature = QgsFeature()
-                    result_feature.setFields(self.target_fields)
-                    for idx, value in enumerate(feature.attributes()):
-                        result_feature.setAttribute(idx, value)
-                    if not np.isnan(crest_level):
-                        result_feature[self.target_field_idx] = float(crest_level)
-
-                    output_wkb_geometry = output_ogr_geometry.ExportToWkb()
-                    output_qgs_geometry = QgsGeometry()
-                    output_qgs_geometry.fromWkb(output_wkb_geometry)
+                continue
+
+            output_wkbs = shapely.to_wkb(
+                [shapely.linestrings(coordinates) for coordinates, _ in processed_lines]
+            )
+            for feature_idx, (_, crest_level), output_wkb in zip(line_feature_indices, processed_lines, output_wkbs):
+                feature = features[feature_idx]
+                result_feature = QgsFeature()
+                result_feature.setFields(self.target_fields)
+                for idx, value in enumerate(feature.attributes()):
+                    result_feature.setAttribute(idx, value)
+                if not np.isnan(crest_level):
+                    result_feature[self.target_field_idx] = float(crest_level)
+
+                output_qgs_geometry = QgsGeometry()
+                output_qgs_geometry.fromWkb(output_wkb)
+                if not self.coordinate_transform.isShortCircuited():
                     output_qgs_geometry.transform(self.coordinate_transform, QgsCoordinateTransform.ReverseTransform)
-                    result_feature.setGeometry(output_qgs_geometry)
+                result_feature.setGeometry(output_qgs_geometry)
+
+                yield result_feature
 
-                    yield result_feature
+    def results_per_side(self, search_distance_field: str = None):
+        """
+        Yield (feature, crest level left, crest level right) for each sampled line, sampling both sides of the line
+        in one pass over the DEM
+        """
+        for features, line_feature_indices, line_coordinates, line_distance_overrides in self._batches(
+                search_distance_field=search_distance_field
+        ):
+            processed_lines = self.processor.process_coordinates(
+                line_nodes=line_coordinates,
+                distance_overrides=line_distance_overrides,
+                separate_sides=True
+            )
+            for feature_idx, ((_, crest_level_left), (_, crest_level_right)) in zip(
+                    line_feature_indices, processed_lines
+            ):
+                yield features[feature_idx], crest_level_left, crest_level_right
 
 
 class CrestLevelAlgorithm(QgsProcessingAlgorithm):
@@ -201,6 +339,7 @@ class CrestLevelAlgorithm(QgsProcessingAlgorithm):
     SEARCH_DISTANCE = 'SEARCH_DISTANCE'
     MIN_CREST_WIDTH = 'MIN_CREST_WIDTH'
     DEM = 'DEM'
+    WORKERS = 'WORKERS'
 
     TARGET_FIELDNAME = 'crest_level'
 
@@ -248,6 +387,16 @@ class CrestLevelAlgorithm(QgsProcessingAlgorithm):
         param.setMetadata({'widget_wrapper': {'decimals': 2}})
         self.addParameter(param)
 
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                self.tr('Number of parallel workers'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=os.cpu_count() or 1,
+                minValue=1
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT,
@@ -264,7 +413,8 @@ class CrestLevelAlgorithm(QgsProcessingAlgorithm):
                                              width=self.parameterAsDouble(parameters, self.MIN_CREST_WIDTH, context),
                                              distance=self.parameterAsDouble(parameters, self.SEARCH_DISTANCE, context),
                                              overwrite=self.parameterAsBoolean(parameters, self.OVERWRITE_VALUES,
-                                                                               context))
+                                                                               context),
+                                             max_workers=self.parameterAsInt(parameters, self.WORKERS, context))
 
         (sink, dest_id) = self.parameterAsSink(
             parameters,
@@ -346,6 +496,7 @@ class MaxBreachDepthAlgorithm(QgsProcessingAlgorithm):
     SEARCH_DISTANCE = 'SEARCH_DISTANCE'
     MIN_DEPRESSION_WIDTH = 'MIN_DEPRESSION_WIDTH'
     DEM = 'DEM'
+    WORKERS = 'WORKERS'
 
     TARGET_FIELDNAME = 'max_breach_depth'
 
@@ -393,6 +544,16 @@ class MaxBreachDepthAlgorithm(QgsProcessingAlgorithm):
         param.setMetadata({'widget_wrapper': {'decimals': 2}})
         self.addParameter(param)
 
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                self.tr('Number of parallel workers'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=os.cpu_count() or 1,
+                minValue=1
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT,
@@ -423,7 +584,8 @@ class MaxBreachDepthAlgorithm(QgsProcessingAlgorithm):
                                                                           context),
                                              distance=self.parameterAsDouble(parameters, self.SEARCH_DISTANCE, context),
                                              overwrite=self.parameterAsBoolean(parameters, self.OVERWRITE_VALUES,
-                                                                               context), inverse=True)
+                                                                               context), inverse=True,
+                                             max_workers=self.parameterAsInt(parameters, self.WORKERS, context))
 
         (sink, dest_id) = self.parameterAsSink(
             parameters,
@@ -510,6 +672,7 @@ class BankLevelAlgorithm(QgsProcessingAlgorithm):
     CHANNELS = 'CHANNELS'
     CONNECTED_ONLY = 'CONNECTED_ONLY'
     DEM = 'DEM'
+    WORKERS = 'WORKERS'
     EXTRA_SEARCH_DISTANCE = 'EXTRA_SEARCH_DISTANCE'
     MIN_CREST_WIDTH = 'MIN_CREST_WIDTH'
     MAX_SEGMENT_LENGTH = 'MAX_SEGMENT_LENGTH'
@@ -582,6 +745,16 @@ class BankLevelAlgorithm(QgsProcessingAlgorithm):
         param.setMetadata({'widget_wrapper': {'decimals': 2}})
         self.addParameter(param)
 
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                self.tr('Number of parallel workers'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=os.cpu_count() or 1,
+                minValue=1
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT,
@@ -616,6 +789,7 @@ class BankLevelAlgorithm(QgsProcessingAlgorithm):
         extra_search_distance = self.parameterAsDouble(parameters, self.EXTRA_SEARCH_DISTANCE, context)
         min_crest_width = self.parameterAsDouble(parameters, self.MIN_CREST_WIDTH, context)
         max_segment_length = self.parameterAsDouble(parameters, self.MAX_SEGMENT_LENGTH, context)
+        max_workers = self.parameterAsInt(parameters, self.WORKERS, context)
 
         target_fields, target_field_idx, field_added = add_float_field_if_not_exists(
             source=cross_section_locations_source,
@@ -672,9 +846,10 @@ class BankLevelAlgorithm(QgsProcessingAlgorithm):
         # create channel segment features
         bank_level_sample_layer.startEditing()
         bank_level_sample_features = []
-        channel_ids = [str(feature[cross_section_locations_channel_id_field_idx])
-                       for feature in cross_section_locations_source.getFeatures()]
-        channel_ids_str = ','.join(channel_ids)
+        cross_section_locations_per_channel = defaultdict(list)
+        for feature in cross_section_locations_source.getFeatures():
+            cross_section_locations_per_channel[feature[cross_section_locations_channel_id_field_idx]].append(feature)
+        channel_ids_str = ','.join(str(channel_id) for channel_id in cross_section_locations_per_channel)
         request = QgsFeatureRequest(QgsExpression(f'id IN ({channel_ids_str})'))
         if calculation_type_field_idx != -1 and connected_only:
             request.combineFilterExpression(f'calculation_type IN ({CONNECTED}, {DOUBLE_CONNECTED})')
@@ -684,8 +859,7 @@ class BankLevelAlgorithm(QgsProcessingAlgorithm):
             channel_geom.transform(channels_coordinate_transform)
             for part in channel_geom.parts():  # get QgsLineString from QgsGeometry
                 channel_geom_part = part
-            request = QgsFeatureRequest(QgsExpression(f'channel_id = {channel_id}'))
-            cross_section_locations = cross_section_locations_source.getFeatures(request)
+            cross_section_locations = cross_section_locations_per_channel.get(channel_id, [])
             positions = []
             for cross_section_location in cross_section_locations:
                 cross_section_location_fid = cross_section_location.id()
@@ -756,37 +930,20 @@ class BankLevelAlgorithm(QgsProcessingAlgorithm):
 
         dem_sampler = DemSamplerQgsConnector(raster=dem_layer, source=bank_level_sample_layer,
                                              target_fieldname=self.TARGET_FIELDNAME, width=min_crest_width,
-                                             distance=extra_search_distance, overwrite=overwrite)
+                                             distance=extra_search_distance, overwrite=overwrite,
+                                             max_workers=max_workers)
 
         total = 100.0 / cross_section_locations_source.featureCount() if cross_section_locations_source.featureCount() else 0
 
-        crest_levels_left = list()
-        # crest level on left side of the sample line
-        for i, crest_level in enumerate(dem_sampler.results(
-                return_features=False,
-                left=True,
-                right=False,
-                search_distance_field=self.SEARCH_DISTANCE_FIELDNAME
-        )):
-            if feedback.isCanceled():
-                break
-            crest_levels_left.append(crest_level)
-            feedback.setProgress(int(i/2 * total))
-
-        # crest level on right side of the sample line
+        # crest levels on the left and right side of the sample line, sampled in one pass
         crest_level_fid_dict = dict()
-        for i, feature in enumerate(dem_sampler.results(
-                return_features=True,
-                left=False,
-                right=True,
+        for i, (feature, crest_level_left, crest_level_right) in enumerate(dem_sampler.results_per_side(
                 search_distance_field=self.SEARCH_DISTANCE_FIELDNAME
         )):
             if feedback.isCanceled():
                 break
-            crest_level_right = np.nan if feature[dem_sampler.target_field_idx] is None else feature[dem_sampler.target_field_idx]
-            crest_level_left = np.nan if crest_levels_left[i] is None else crest_levels_left[i]
             crest_level_fid_dict[feature[0]] = float(np.nanmin([crest_level_right, crest_level_left]))
-            feedback.setProgress(50 + int(i/2 * total))
+            feedback.setProgress(int(i * total))
 
         for source_feature in cross_section_locations_layer.getFeatures():
             sink_feature = QgsFeature()
@@ -850,7 +1007,10 @@ class BankLevelAlgorithm(QgsProcessingAlgorithm):
         "'Connected' only, because the bank level is not relevant for channels with other calculation types." \
         "\n\n" \
         "By default, only those features are processed that have an empty bank level field. Check the box 'Overwrite " \
-        "existing values' to change this behaviour."
+        "existing values' to change this behaviour." \
+        "\n\n" \
+        "The DEM is sampled per tile by 'Number of parallel workers' worker threads. The results do not depend on the " \
+        "number of workers."
 
         return self.tr(help_string)
 
@@ -889,6 +1049,7 @@ class DrainLevelAlgorithm(QgsProcessingAlgorithm):
     INSPECTION_ONLY = 'INSPECTION_ONLY'
     SEARCH_DISTANCE = 'SEARCH_DISTANCE'
     DEM = 'DEM'
+    WORKERS = 'WORKERS'
 
     TARGET_FIELDNAME = 'drain_level'
 
@@ -947,6 +1108,16 @@ class DrainLevelAlgorithm(QgsProcessingAlgorithm):
         param.toolTip = 'Search distance for finding minimum value in DEM around manhole'
         self.addParameter(param)
 
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                self.tr('Number of parallel workers'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=os.cpu_count() or 1,
+                minValue=1
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT,
@@ -955,10 +1126,8 @@ class DrainLevelAlgorithm(QgsProcessingAlgorithm):
         )
 
     def processAlgorithm(self, parameters, context, feedback):
-        feedback = QgsProcessingMultiStepFeedback(3, feedback)
-
         source = self.parameterAsSource(parameters, self.INPUT_POINTS, context)
-        source_layer = self.parameterAsVectorLayer(parameters, self.INPUT_POINTS, context)
+        dem_layer = self.parameterAsRasterLayer(parameters, self.DEM, context)
         distance = self.parameterAsDouble(parameters, self.SEARCH_DISTANCE, context)
         overwrite = self.parameterAsBoolean(parameters, self.OVERWRITE_VALUES, context)
         connected_only = self.parameterAsBoolean(parameters, self.CONNECTED_ONLY, context)
@@ -980,78 +1149,62 @@ class DrainLevelAlgorithm(QgsProcessingAlgorithm):
             source.sourceCrs()
         )
 
-        # Buffer
-        alg_params = {
-            'DISSOLVE': False,
-            'DISTANCE': distance,
-            'END_CAP_STYLE': 0,
-            'INPUT': parameters[self.INPUT_POINTS],
-            'JOIN_STYLE': 0,
-            'MITER_LIMIT': 2,
-            'SEGMENTS': 5,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        buffer_run = processing.run('native:buffer', alg_params, context=context, feedback=feedback,
-                                    is_child_algorithm=True)
-        buffered = buffer_run['OUTPUT']
-
-        feedback.setCurrentStep(1)
-        if feedback.isCanceled():
-            return
-
-        # Zonal statistics (in place)
-        alg_params = {
-            'COLUMN_PREFIX': 'stats_',
-            'INPUT_RASTER': parameters['DEM'],
-            'INPUT_VECTOR': buffered,
-            'RASTER_BAND': 1,
-            'STATISTICS': [5]  # 5 = MIN
-        }
-
-        processing.run(
-            'native:zonalstatistics',
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True
-        )
-
-        zonal_statistics_output_layer = context.getMapLayer(buffered)
-        feedback.setCurrentStep(2)
-        if feedback.isCanceled():
-            return
+        def skip(feature: QgsFeature) -> bool:
+            """Return True if the drain level of this feature is not written to the output"""
+            if overwrite and not field_added and feature[target_field_idx] != NULL:
+                return True
+            if calculation_type_field_idx != -1:
+                if feature[calculation_type_field_idx] not in (CONNECTED, DOUBLE_CONNECTED) and connected_only:
+                    return True
+            if manhole_indicator_field_idx != -1:
+                if feature[manhole_indicator_field_idx] != INSPECTION and inspection_only:
+                    return True
+            return False
+
+        # Minimum DEM value within search distance of each point, read per DEM tile. Only the features that are written
+        # to the output are sampled.
+        coordinate_transform = QgsCoordinateTransform(source.sourceCrs(), dem_layer.crs(), QgsProject.instance())
+        source_features = list(source.getFeatures())
+        skipped = np.array([skip(source_feature) for source_feature in source_features], dtype=bool)
+        points = point_coordinates(source_features, coordinate_transform, feedback)
+        points[skipped] = np.nan
+        with ZonalMinimumProcessor(
+            raster=gdal.Open(dem_layer.source()),
+            distance=distance,
+            max_workers=self.parameterAsInt(parameters, self.WORKERS, context)
+        ) as processor:
+            drain_levels = sample_points(
+                processor=processor,
+                points=points,
+                feedback=feedback,
+                batch_size=DemSamplerQgsConnector.BATCH_SIZE,
+                progress_end=50,
+            )
+        if drain_levels is None:
+            return {}
 
-        total = 100.0 / source.featureCount() if source.featureCount() else 0
-        for current, feature in enumerate(zonal_statistics_output_layer.getFeatures()):
+        total = 50.0 / len(source_features) if source_features else 0
+        for current, (source_feature, drain_level, skip_feature) in enumerate(
+                zip(source_features, drain_levels, skipped)
+        ):
 
             if feedback.isCanceled():
                 break
 
-            source_feature = source_layer.getFeature(feature.id())
             output_feature = QgsFeature()
             output_feature.setFields(target_fields)
 
             for idx, value in enumerate(source_feature.attributes()):
                 output_feature.setAttribute(idx, value)
 
-            skip = False
-            if overwrite and output_feature[target_field_idx] != NULL:
-                skip = True
-            if calculation_type_field_idx != -1:
-                if output_feature[calculation_type_field_idx] not in (CONNECTED, DOUBLE_CONNECTED) and connected_only:
-                    skip = True
-            if manhole_indicator_field_idx != -1:
-                if output_feature[manhole_indicator_field_idx] != INSPECTION and inspection_only:
-                    skip = True
-
-            if not skip:
-                output_feature[target_field_idx] = feature['stats_min']
+            if not skip_feature and not np.isnan(drain_level):
+                output_feature[target_field_idx] = float(drain_level)
             geom = QgsGeometry(source_feature.geometry())
             output_feature.setGeometry(geom)
 
             sink.addFeature(output_feature, QgsFeatureSink.FastInsert)
 
-            feedback.setProgress(int(current * total))
+            feedback.setProgress(50 + int(current * total))
 
         return {self.OUTPUT: dest_id}
 
@@ -1113,6 +1266,7 @@ class SurfaceLevelAlgorithm(QgsProcessingAlgorithm):
     INPUT_POINTS = 'INPUT_POINTS'
     OVERWRITE_VALUES = 'OVERWRITE_VALUES'
     DEM = 'DEM'
+    WORKERS = 'WORKERS'
 
     TARGET_FIELDNAME = 'surface_level'
 
@@ -1144,6 +1298,16 @@ class SurfaceLevelAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                self.tr('Number of parallel workers'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=os.cpu_count() or 1,
+                minValue=1
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT,
@@ -1153,7 +1317,7 @@ class SurfaceLevelAlgorithm(QgsProcessingAlgorithm):
 
     def processAlgorithm(self, parameters, context, feedback):
         source = self.parameterAsSource(parameters, self.INPUT_POINTS, context)
-        source_layer = self.parameterAsVectorLayer(parameters, self.INPUT_POINTS, context)
+        dem_layer = self.parameterAsRasterLayer(parameters, self.DEM, context)
         overwrite = self.parameterAsBoolean(parameters, self.OVERWRITE_VALUES, context)
 
         target_fields, target_field_idx, field_added = add_float_field_if_not_exists(
@@ -1170,21 +1334,25 @@ class SurfaceLevelAlgorithm(QgsProcessingAlgorithm):
             source.sourceCrs()
         )
 
-        # Sample raster values
-        alg_params = {
-            'COLUMN_PREFIX': 'value_1234567890',   # make sure input layer doesn't have a field with this name
-            'INPUT': parameters[self.INPUT_POINTS],
-            'RASTERCOPY': parameters[self.DEM],
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        sampled = processing.run('native:rastersampling', alg_params, context=context, feedback=feedback)['OUTPUT']
-
-        for current, feature in enumerate(sampled.getFeatures()):
-
-            if feedback.isCanceled():
-                break
+        # Sample raster values in batches of points, reading only the DEM tiles that contain points
+        coordinate_transform = QgsCoordinateTransform(source.sourceCrs(), dem_layer.crs(), QgsProject.instance())
+        source_features = list(source.getFeatures())
+        points = point_coordinates(source_features, coordinate_transform, feedback)
+        with PointProcessor(
+            raster=gdal.Open(dem_layer.source()),
+            max_workers=self.parameterAsInt(parameters, self.WORKERS, context)
+        ) as processor:
+            surface_levels = sample_points(
+                processor=processor,
+                points=points,
+                feedback=feedback,
+                batch_size=DemSamplerQgsConnector.BATCH_SIZE,
+            )
+        if surface_levels is None:
+            return {}
 
-            source_feature = source_layer.getFeature(feature.id())
+        output_features = []
+        for source_feature, surface_level in zip(source_features, surface_levels):
             output_feature = QgsFeature()
             output_feature.setFields(target_fields)
 
@@ -1192,11 +1360,12 @@ class SurfaceLevelAlgorithm(QgsProcessingAlgorithm):
                 output_feature.setAttribute(idx, value)
 
             if overwrite or output_feature[target_field_idx] == NULL:
-                output_feature[target_field_idx] = feature['value_12345678901']
+                output_feature[target_field_idx] = NULL if np.isnan(surface_level) else float(surface_level)
             geom = QgsGeometry(source_feature.geometry())
             output_feature.setGeometry(geom)
+            output_features.append(output_feature)
 
-            sink.addFeature(output_feature, QgsFeatureSink.FastInsert)
+        sink.addFeatures(output_features, QgsFeatureSink.FastInsert)
 
         return {self.OUTPUT: dest_id}
 
@@ -17,12 +17,17 @@ import logging
 import math
 import os
 import sys
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
 from osgeo import gdal, gdal_array
 from osgeo import ogr
 from scipy import ndimage
 import numpy as np
 
+from . import groups
 from . import utils
 from . import vectors
 
@@ -120,20 +125,57 @@ class BaseProcessor(object):
             distance: float,
             inverse: bool = False,
             modify: bool = False,
-            average: int = None
+            average: int = None,
+            tile_size: int = 1024,
+            block_cache: groups.BlockCache = None,
+            max_workers: int = 1,
     ):
+        """
+        :param tile_size: size in pixels of the tiles by which lines are grouped when processing many lines at once.
+            The raster is read once for each group of lines.
+        :param block_cache: optional cache to read the raster through, which can be shared between processors
+        :param max_workers: number of worker threads that process the tiles when processing many lines at once. Each
+            worker opens its own handle of the raster.
+        """
         self.raster = raster
         self.width = width
         self.average = average
         self.inverse = inverse
         self.modify = modify
         self.distance = distance
+        self.tile_size = tile_size
+        self.block_cache = block_cache
+        self.max_workers = max_workers
+        self._local = threading.local()
+        self._read_lock = threading.Lock()
+        self._executor = None
+        self._thread_rasters = []
 
         self.no_data_value = raster.GetRasterBand(1).GetNoDataValue()
 
         if modify and not distance:
             logger.warning('Warning: modify option used with zero distance.')
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Stop the worker threads and close the raster handles they opened.
+
+        The processor can still be used afterwards, new workers are started
+        when needed.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        with self._read_lock:
+            self._thread_rasters.clear()
+        self._local = threading.local()
+
     def read_raster(self, bounds, inflate=False):
         """
         Return numpy array.
@@ -165,9 +207,18 @@ class BaseProcessor(object):
         array = np.full((y2 - y1, x2 - x1), self.no_data_value, numpy_type)
         view = array[q1 - y1: q2 - y1, p1 - x1: p2 - x1]
 
+        # nothing to read if the bounds are completely outside the dataset
+        if p1 == p2 or q1 == q2:
+            return array
+
         kwargs = {'xoff': p1, 'yoff': q1, 'xsize': p2 - p1, 'ysize': q2 - q1}
         # for dataset, no_data_value in zip(self.datasets, self.no_data_values):
-        data = self.raster.ReadAsArray(**kwargs)
+        raster, lock = self._thread_raster()
+        with lock:
+            if self.block_cache is None:
+                data = raster.ReadAsArray(**kwargs)
+            else:
+                data = self.block_cache.read(raster, **kwargs)
         index = data != self.no_data_value
         view[index] = data[index]
 
@@ -217,15 +268,26 @@ class BaseProcessor(object):
 
         return {'lines': rlines, 'values': rvalues, 'centers': rcenters}
 
-    def _calculate(self, wkb_line_string, left=True, right=True, distance_override: float = None):
-        """ Return lines, points, values tuple of numpy arrays. """
+    def _sample_locations(self, nodes, left=True, right=True, distance_override: float = None,
+                          pixelized_points=None):
+        """
+        Return dictionary with the parameterized lines, the sample points,
+        their integer pixel indices and the pixel bounds that contain them.
+
+        :param nodes: N x 2 (or N x 3) array of line string coordinates
+        :param pixelized_points: points of the pixelized line, if already
+            determined with vectors.pixelize_many()
+        """
         # determine the point and values carpets
         geo_transform = self.raster.GetGeoTransform()
 
         # determine the points
-        nodes = np.array(wkb_line_string.GetPoints())     # original nodes
+        nodes = np.asarray(nodes)                         # original nodes
         pline1 = vectors.ParameterizedLine(nodes[:, :2])  # parameterization
-        pline2 = pline1.pixelize(geo_transform)           # add pixel edges
+        if pixelized_points is None:
+            pline2 = pline1.pixelize(geo_transform)       # add pixel edges
+        else:
+            pline2 = vectors.ParameterizedLine(pixelized_points)
 
         # expand points when necessary
         search_distance = distance_override if distance_override else self.distance
@@ -249,12 +311,23 @@ class BaseProcessor(object):
         j = np.int64(e * (x - p) + f * (y - q))
         i = np.int64(g * (x - p) + h * (y - q))
 
-        # read corresponding values from raster
         bounds = (int(j.min()),
                   int(i.min()),
                   int(j.max()) + 1,
                   int(i.max()) + 1)
-        array = self.read_raster(bounds)
+
+        return {'pline1': pline1, 'pline2': pline2, 'points': points,
+                'i': i, 'j': j, 'bounds': bounds}
+
+    def _sample_result(self, sample, array, bounds):
+        """
+        Return result dictionary for a sample from _sample_locations().
+
+        :param array: raster values within bounds, containing at least
+            the bounds of the sample.
+        """
+        # read corresponding values from raster
+        i, j = sample['i'], sample['j']
         values = array[i - bounds[1], j - bounds[0]].transpose()
 
         # set nodatavalues to NaN
@@ -262,15 +335,15 @@ class BaseProcessor(object):
 
         # return lines, centers, values
         if self.modify:
-            step = geo_transform[1]
+            step = self.raster.GetGeoTransform()[1]
             result = self._modify(step=step,
-                                  points=points,
+                                  points=sample['points'],
                                   values=values,
-                                  parameterized_line=pline1)
+                                  parameterized_line=sample['pline1'])
         else:
             extremum = np.nanmin if self.inverse else np.nanmax
-            result = {'lines': pline2.lines,
-                      'centers': pline2.centers,
+            result = {'lines': sample['pline2'].lines,
+                      'centers': sample['pline2'].centers,
                       'values': extremum(values, 1)}
 
         if self.average:
@@ -279,6 +352,147 @@ class BaseProcessor(object):
         else:
             return result
 
+    def _thread_raster(self):
+        """
+        Return (raster, lock) to read the raster from in the current thread.
+
+        Gdal datasets must not be shared between threads, so with more than
+        one worker each thread opens its own handle of the raster. Rasters
+        that can't be reopened (in-memory datasets without a filename) are
+        shared, and read with a lock. The handles stay open until close().
+        """
+        if self.max_workers == 1:
+            return self.raster, nullcontext()
+        if not hasattr(self._local, 'raster'):
+            description = self.raster.GetDescription()
+            self._local.raster = gdal.Open(description) if description else None
+            if self._local.raster is not None:
+                with self._read_lock:
+                    self._thread_rasters.append(self._local.raster)
+        if self._local.raster is None:
+            return self.raster, self._read_lock
+        return self._local.raster, nullcontext()
+
+    def _map_tiles(self, function, tiles):
+        """
+        Return list of function(indices, bounds) for each tile from
+        _group_by_tile(), in order, using max_workers threads.
+
+        The threads are started once and reused for every call, so that each
+        of them opens the raster only once. They run until close().
+        """
+        if self.max_workers == 1 or len(tiles) < 2:
+            return [function(indices, bounds) for indices, bounds in tiles]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return list(self._executor.map(lambda tile: function(*tile), tiles))
+
+    def _group_by_tile(self, bounds_list):
+        """
+        Return list of (indices, bounds) tuples.
+
+        The pixel bounds in bounds_list are grouped by the tile (of
+        tile_size pixels) that contains their top left corner. The bounds
+        of each group contain the bounds of all its members. Bounds that
+        are larger than a tile get a group of their own, so that the
+        bounds of a group never exceed twice the tile size.
+        """
+        bounds_array = np.array(bounds_list, dtype='i8').reshape(-1, 4)
+        sizes = bounds_array[:, 2:] - bounds_array[:, :2]
+        fits = (sizes <= self.tile_size).all(axis=1)
+
+        groups = defaultdict(list)
+        for index, (x1, y1) in enumerate(bounds_array[:, :2] // self.tile_size):
+            groups[(x1, y1) if fits[index] else index].append(index)
+
+        result = []
+        for indices in groups.values():
+            group_bounds = bounds_array[indices]
+            bounds = (int(group_bounds[:, 0].min()),
+                      int(group_bounds[:, 1].min()),
+                      int(group_bounds[:, 2].max()),
+                      int(group_bounds[:, 3].max()))
+            result.append((indices, bounds))
+        return result
+
+    @staticmethod
+    def _split_sides(sample):
+        """
+        Return (left, right) samples for a sample of both sides.
+
+        The carpet of both sides contains the carpets of the left and the
+        right side as its first and last columns, which share the center
+        column.
+        """
+        width = sample['points'].shape[1]
+        if width == 1:
+            return sample, sample
+        steps = (width - 1) // 2
+        left = dict(sample, points=sample['points'][:, :steps + 1],
+                    i=sample['i'][:steps + 1], j=sample['j'][:steps + 1])
+        right = dict(sample, points=sample['points'][:, steps:],
+                     i=sample['i'][steps:], j=sample['j'][steps:])
+        return left, right
+
+    def _calculate(self, wkb_line_string, left=True, right=True, distance_override: float = None):
+        """ Return lines, points, values tuple of numpy arrays. """
+        sample = self._sample_locations(nodes=np.array(wkb_line_string.GetPoints()),
+                                        left=left,
+                                        right=right,
+                                        distance_override=distance_override)
+        array = self.read_raster(sample['bounds'])
+        return self._sample_result(sample, array, sample['bounds'])
+
+    def _calculate_many(self, line_nodes, left=True, right=True, distance_overrides=None,
+                        separate_sides=False):
+        """
+        Return list of results, like _calculate(), for the nodes (N x 2
+        array) of each line string.
+
+        If separate_sides, both sides are sampled in one read, and the
+        result for each line string is a (left, right) tuple of results,
+        identical to calculating left=True, right=False and left=False,
+        right=True separately.
+
+        Lines are grouped by the tile (of tile_size pixels) that contains
+        the top left corner of their sample bounds. The raster is read
+        once per group, for the combined bounds of the lines in the group,
+        so that the many short lines in a small area do not each read the
+        same part of the raster. Lines larger than a tile are read on their
+        own bounds.
+        """
+        if distance_overrides is None:
+            distance_overrides = [None] * len(line_nodes)
+        pixelized = vectors.pixelize_many(line_nodes,
+                                          self.raster.GetGeoTransform())
+        samples = [
+            self._sample_locations(nodes=nodes,
+                                   left=left,
+                                   right=right,
+                                   distance_override=distance_override,
+                                   pixelized_points=points)
+            for nodes, distance_override, (_, points, _)
+            in zip(line_nodes, distance_overrides, pixelized)
+        ]
+
+        def process_tile(indices, bounds):
+            array = self.read_raster(bounds)
+            if separate_sides:
+                return [
+                    tuple(self._sample_result(side_sample, array, bounds)
+                          for side_sample in self._split_sides(samples[index]))
+                    for index in indices
+                ]
+            return [self._sample_result(samples[index], array, bounds)
+                    for index in indices]
+
+        results = [None] * len(samples)
+        tiles = self._group_by_tile([sample['bounds'] for sample in samples])
+        for (indices, _), tile_results in zip(tiles, self._map_tiles(process_tile, tiles)):
+            for index, result in zip(indices, tile_results):
+                results[index] = result
+        return results
+
 
 class CoordinateProcessor(BaseProcessor):
     """ Writes a shapefile with height in z coordinate. """
@@ -321,29 +535,218 @@ class CoordinateProcessor(BaseProcessor):
         ))
 
 
+class PointProcessor(BaseProcessor):
+    """ Samples the raster value at points. """
+    def __init__(self, raster: gdal.Dataset, tile_size: int = 1024, block_cache: groups.BlockCache = None,
+                 max_workers: int = 1):
+        super().__init__(raster=raster,
+                         width=0,
+                         distance=0,
+                         tile_size=tile_size,
+                         block_cache=block_cache,
+                         max_workers=max_workers)
+
+    def process_many(self, points):
+        """
+        Return array with the value of the pixel that contains each point.
+
+        :param points: N x 2 array of x, y coordinates
+
+        The result is NaN for points on pixels with no data or outside the
+        raster. Only the windows around the points in each tile are read.
+        """
+        points = np.asarray(points, dtype='f8').reshape(-1, 2)
+        geo_transform = utils.GeoTransform(self.raster.GetGeoTransform())
+        i, j = geo_transform.get_pixel_indices(*points.transpose())
+
+        def process_tile(indices, bounds):
+            array = self.read_raster(bounds)
+            values = array[i[indices] - bounds[1], j[indices] - bounds[0]]
+            return np.where(values == self.no_data_value, np.nan, values)
+
+        result = np.full(len(points), np.nan)
+        tiles = self._group_by_tile(np.stack([j, i, j + 1, i + 1], axis=1))
+        for (indices, _), values in zip(tiles, self._map_tiles(process_tile, tiles)):
+            result[indices] = values
+        return result
+
+
+class ZonalMinimumProcessor(BaseProcessor):
+    """ Finds the minimum raster value within distance of points. """
+    # maximum number of (point, pixel) pairs to evaluate at once
+    chunk_size = 2 ** 22
+
+    def __init__(self, raster: gdal.Dataset, distance: float, tile_size: int = 1024,
+                 block_cache: groups.BlockCache = None, max_workers: int = 1):
+        super().__init__(raster=raster,
+                         width=0,
+                         distance=distance,
+                         inverse=True,
+                         tile_size=tile_size,
+                         block_cache=block_cache,
+                         max_workers=max_workers)
+
+    def process_many(self, points):
+        """
+        Return array with the minimum value per point.
+
+        :param points: N x 2 array of x, y coordinates
+
+        The zone of a point consists of the pixels whose center is within
+        distance of the point, plus the pixel that contains the point.
+        Pixels with no data are ignored; the result is NaN for points
+        without any data in their zone.
+        """
+        points = np.asarray(points, dtype='f8').reshape(-1, 2)
+        geo_transform = utils.GeoTransform(self.raster.GetGeoTransform())
+        p, a, b, q, c, d = geo_transform
+
+        # pixel that contains each point
+        x, y = points.transpose()
+        i, j = geo_transform.get_pixel_indices(x, y)
+
+        # offsets of the candidate pixels around that pixel
+        radius_j = int(math.ceil(self.distance / abs(a))) + 1
+        radius_i = int(math.ceil(self.distance / abs(d))) + 1
+        offsets_i, offsets_j = np.mgrid[-radius_i:radius_i + 1,
+                                        -radius_j:radius_j + 1]
+        offsets_i = offsets_i.ravel()
+        offsets_j = offsets_j.ravel()
+        own_pixel = (offsets_i == 0) & (offsets_j == 0)
+
+        bounds_list = np.stack([j - radius_j, i - radius_i,
+                                j + radius_j + 1, i + radius_i + 1], axis=1)
+        chunk_size = max(1, self.chunk_size // offsets_i.size)
+
+        def process_tile(indices, bounds):
+            array = self.read_raster(bounds)
+            minima = np.full(len(indices), np.nan)
+            for start in range(0, len(indices), chunk_size):
+                chunk = np.array(indices[start:start + chunk_size])
+                pixels_i = i[chunk].reshape(-1, 1) + offsets_i
+                pixels_j = j[chunk].reshape(-1, 1) + offsets_j
+
+                # distance from the pixel centers to the points
+                centers_x, centers_y = geo_transform.get_coordinates(
+                    (pixels_i + 0.5, pixels_j + 0.5),
+                )
+                in_zone = np.logical_or(
+                    np.hypot(centers_x - x[chunk].reshape(-1, 1),
+                             centers_y - y[chunk].reshape(-1, 1))
+                    <= self.distance,
+                    own_pixel,
+                )
+
+                values = array[pixels_i - bounds[1], pixels_j - bounds[0]]
+                valid = in_zone & (values != self.no_data_value)
+                chunk_minima = np.where(valid, values, np.inf).min(axis=1)
+                minima[start:start + chunk.size] = np.where(
+                    valid.any(axis=1), chunk_minima, np.nan,
+                )
+            return minima
+
+        result = np.full(len(points), np.nan)
+        tiles = self._group_by_tile(bounds_list)
+        for (indices, _), minima in zip(tiles, self._map_tiles(process_tile, tiles)):
+            result[indices] = minima
+        return result
+
+
 class AttributeProcessor(BaseProcessor):
     """ Writes a shapefile with height in z attribute. """
+    @staticmethod
+    def _line_strings(source_geometry):
+        """ Return list of the line strings in a (multi)linestring. """
+        geometry_type = source_geometry.GetGeometryType()
+        if geometry_type in LINESTRINGS:
+            return [source_geometry]
+        if geometry_type in MULTILINESTRINGS:
+            return [line for line in source_geometry]
+        raise ValueError('Unexpected geometry type: {}'.format(
+            source_geometry.GetGeometryName(),
+        ))
+
+    @staticmethod
+    def _merge_coordinates(result):
+        """
+        Return (coordinates, height) for a result of _calculate().
+
+        The coordinates are those of all result lines one after another,
+        the height is the average of the values weighted by line length.
+        """
+        lines = result['lines']
+        lengths = vectors.magnitude(lines[:, 1] - lines[:, 0])
+        height = (result['values'] * lengths).sum() / lengths.sum()
+        return lines.reshape(-1, 2), height
+
+    def _merge_result(self, result):
+        """ Return [geometry, height] for a result of _calculate(). """
+        coordinates, height = self._merge_coordinates(result)
+        return [vectors.line2geometry(coordinates), height]
+
     def process(self, source_geometry, left=True, right=True, distance_override: float = None):
         """
         Return generator of (geometry, height) tuples.
         """
-        geometry_type = source_geometry.GetGeometryType()
-        if geometry_type in LINESTRINGS:
-            source_wkb_line_strings = [source_geometry]
-        elif geometry_type in MULTILINESTRINGS:
-            source_wkb_line_strings = [line for line in source_geometry]
-        else:
-            raise ValueError('Unexpected geometry type: {}'.format(
-                source_geometry.GetGeometryName(),
-            ))
-        for source_wkb_line_string in source_wkb_line_strings:
+        for source_wkb_line_string in self._line_strings(source_geometry):
             result = self._calculate(wkb_line_string=source_wkb_line_string, left=left, right=right, distance_override=distance_override)
-            weighted_sum_of_heights = 0
-            lines = []
-            for line, value in zip(result['lines'], result['values']):
-                geom = vectors.line2geometry(line)
-                lines.append(geom)
-                weighted_sum_of_heights += value*geom.Length()
-            merged_line = vectors.linemerge(lines)
-            weighted_averge_height = weighted_sum_of_heights/merged_line.Length()
-            yield [merged_line, weighted_averge_height]
+            yield self._merge_result(result)
+
+    def process_coordinates(self, line_nodes, left=True, right=True, distance_overrides=None,
+                            separate_sides=False):
+        """
+        Return list with a (coordinates, height) tuple for the nodes (N x 2
+        array) of each line string, or a ((coordinates, height),
+        (coordinates, height)) tuple for the left and the right side if
+        separate_sides.
+
+        This is process_many() without conversion from and to ogr
+        geometries.
+        """
+        results = self._calculate_many(line_nodes=line_nodes,
+                                       left=left,
+                                       right=right,
+                                       distance_overrides=distance_overrides,
+                                       separate_sides=separate_sides)
+        if separate_sides:
+            return [
+                tuple(self._merge_coordinates(side_result) for side_result in result)
+                for result in results
+            ]
+        return [self._merge_coordinates(result) for result in results]
+
+    def process_many(self, source_geometries, left=True, right=True, distance_overrides=None,
+                     separate_sides=False):
+        """
+        Return list with, for each source geometry, the list of (geometry,
+        height) tuples that process() would yield for it.
+
+        The raster is read per tile instead of per line, see
+        BaseProcessor._calculate_many(). If separate_sides, the list
+        contains a ((geometry, height), (geometry, height)) tuple for the
+        left and the right side instead, sampled in one pass.
+        """
+        if distance_overrides is None:
+            distance_overrides = [None] * len(source_geometries)
+        line_nodes = []
+        line_distance_overrides = []
+        counts = []
+        for source_geometry, distance_override in zip(source_geometries, distance_overrides):
+            line_strings = self._line_strings(source_geometry)
+            line_nodes += [np.array(line_string.GetPoints()) for line_string in line_strings]
+            line_distance_overrides += [distance_override] * len(line_strings)
+            counts.append(len(line_strings))
+        results = self.process_coordinates(line_nodes=line_nodes,
+                                           left=left,
+                                           right=right,
+                                           distance_overrides=line_distance_overrides,
+                                           separate_sides=separate_sides)
+        if separate_sides:
+            merged_results = [
+                tuple([vectors.line2geometry(coordinates), height] for coordinates, height in result)
+                for result in results
+            ]
+        else:
+            merged_results = [[vectors.line2geometry(coordinates), height] for coordinates, height in results]
+        offsets = np.cumsum([0] + counts)
+        return [merged_results[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
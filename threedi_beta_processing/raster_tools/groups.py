@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import threading
+from collections import OrderedDict
 
 from osgeo import gdal
 from osgeo import gdal_array
@@ -9,8 +11,8 @@ from osgeo import ogr
 from osgeo import osr
 import numpy as np
 
-import datasets
-import utils
+from . import datasets
+from . import utils
 
 logger = logging.getLogger(__name__)
 
@@ -41,12 +43,149 @@ class Meta(object):
                 and self.geo_transform == other.geo_transform)
 
 
+class BlockCache(object):
+    """
+    A bounded LRU cache of raster blocks, shared by anything that reads
+    windows from gdal datasets.
+
+    Blocks are keyed by dataset and block index. Datasets are identified
+    by their description (the filename), so that different handles of
+    the same file share blocks, or by identity if they have none. The
+    blocks are multiples of the native block size of the dataset, at
+    least min_block_size pixels in each direction. Native blocks that
+    are larger than min_block_size in a direction, like the full width
+    strips of striped datasets, are split into min_block_size pixels.
+    The least recently used blocks are removed when the blocks in the
+    cache together take more than max_bytes.
+
+    Usage:
+        >>> cache = BlockCache(max_bytes=256 * 2 ** 20)
+        >>> group = Group(dataset, block_cache=cache)
+        >>> group.read(bounds)
+        >>> cache.statistics()
+    """
+    def __init__(self, max_bytes=256 * 2 ** 20, min_block_size=256):
+        """
+        :param max_bytes: maximum total size in bytes of the blocks in the cache
+        :param min_block_size: minimum width and height of cached blocks
+        """
+        self.max_bytes = max_bytes
+        self.min_block_size = min_block_size
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def statistics(self):
+        """ Return dictionary with hits, misses, hit rate and size. """
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'blocks': len(self._blocks),
+                'bytes': self._bytes}
+
+    def clear(self):
+        """ Remove all blocks and reset the statistics. """
+        with self._lock:
+            self._blocks.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _block_size(self, dataset):
+        """ Return width, height of the cached blocks for dataset. """
+        return tuple(
+            self.min_block_size if native > self.min_block_size
+            else native * -(-self.min_block_size // native)
+            for native in dataset.GetRasterBand(1).GetBlockSize()
+        )
+
+    def _block(self, dataset, column, row, width, height):
+        """ Return the block at column, row, clipped to the dataset. """
+        description = dataset.GetDescription()
+        key = (description or id(dataset), column, row)
+        with self._lock:
+            if key in self._blocks:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+                return self._blocks[key][1]
+            self.misses += 1
+
+        xoff, yoff = column * width, row * height
+        block = dataset.ReadAsArray(
+            xoff=xoff,
+            yoff=yoff,
+            xsize=min(width, dataset.RasterXSize - xoff),
+            ysize=min(height, dataset.RasterYSize - yoff),
+        )
+
+        with self._lock:
+            if key in self._blocks:
+                # another thread read the same block meanwhile
+                self._bytes -= self._blocks[key][1].nbytes
+            # keep a reference to datasets without description, so that their
+            # id is not reused. Datasets with a description are not kept
+            # alive, so that their handles close when the reader is done.
+            self._blocks[key] = (None if description else dataset), block
+            self._blocks.move_to_end(key)
+            self._bytes += block.nbytes
+            while self._bytes > self.max_bytes:
+                self._bytes -= self._blocks.popitem(last=False)[1][1].nbytes
+        return block
+
+    def read(self, dataset, xoff, yoff, xsize, ysize):
+        """
+        Return numpy array, like dataset.ReadAsArray().
+
+        The window must be inside the dataset.
+        """
+        if xsize <= 0 or ysize <= 0:
+            data_type = dataset.GetRasterBand(1).DataType
+            numpy_type = gdal_array.GDALTypeCodeToNumericTypeCode(data_type)
+            return np.empty((max(ysize, 0), max(xsize, 0)), numpy_type)
+
+        width, height = self._block_size(dataset)
+        result = None
+        for row in range(yoff // height, (yoff + ysize - 1) // height + 1):
+            for column in range(xoff // width, (xoff + xsize - 1) // width + 1):
+                block = self._block(dataset, column, row, width, height)
+                if result is None:
+                    result = np.empty((ysize, xsize), block.dtype)
+
+                # intersection of block and window
+                x1 = max(xoff, column * width)
+                y1 = max(yoff, row * height)
+                x2 = min(xoff + xsize, column * width + block.shape[1])
+                y2 = min(yoff + ysize, row * height + block.shape[0])
+                result[y1 - yoff:y2 - yoff, x1 - xoff:x2 - xoff] = block[
+                    y1 - row * height:y2 - row * height,
+                    x1 - column * width:x2 - column * width,
+                ]
+        return result
+
+
 class Group(object):
     """
     A group of gdal rasters, automatically merges, and has a more pythonic
     interface.
+
+    Where more than one dataset has data, the value of the last dataset
+    is used.
     """
-    def __init__(self, *datasets):
+    def __init__(self, *datasets, block_cache=None, coverage_size=None):
+        """
+        :param block_cache: optional BlockCache to read the datasets through
+        :param coverage_size: if given, precompute for all but the last
+            dataset which cells of coverage_size x coverage_size pixels
+            contain any data, to skip reads that can't contribute. This
+            reads these datasets once, so it pays off for sparse fallback
+            datasets that are read many times.
+        """
         metas = [Meta(dataset) for dataset in datasets]
         meta = metas[0]
         if not all([meta == m for m in metas]):
@@ -61,6 +200,60 @@ class Group(object):
 
         self.no_data_values = [m.no_data_value for m in metas]
         self.datasets = datasets
+        self.block_cache = block_cache
+
+        self.coverage_size = coverage_size
+        self.coverages = [None] * len(datasets)
+        if coverage_size:
+            for index in range(len(datasets) - 1):
+                self.coverages[index] = self._coverage(
+                    datasets[index], self.no_data_values[index],
+                )
+
+    def _coverage(self, dataset, no_data_value):
+        """
+        Return boolean array with a cell per coverage_size pixels, True
+        where the dataset has any data in the cell.
+        """
+        size = self.coverage_size
+        rows = -(-self.height // size)
+        columns = -(-self.width // size)
+        coverage = np.zeros((rows, columns), dtype='b1')
+        # read a strip of at most 16 cells at a time
+        strip = 16 * size
+        for row in range(rows):
+            yoff = row * size
+            ysize = min(size, self.height - yoff)
+            for xoff in range(0, self.width, strip):
+                xsize = min(strip, self.width - xoff)
+                data = dataset.ReadAsArray(
+                    xoff=xoff, yoff=yoff, xsize=xsize, ysize=ysize,
+                )
+                valid = (data != no_data_value).any(axis=0)
+                column = xoff // size
+                coverage[row, column:column + -(-xsize // size)] = (
+                    np.logical_or.reduceat(valid, np.arange(0, xsize, size))
+                )
+        return coverage
+
+    def _covers(self, index, x1, y1, x2, y2):
+        """ Return if dataset index may have data in the pixel window. """
+        coverage = self.coverages[index]
+        if coverage is None:
+            return True
+        size = self.coverage_size
+        return bool(coverage[y1 // size:(y2 - 1) // size + 1,
+                             x1 // size:(x2 - 1) // size + 1].any())
+
+    def _read_dataset(self, index, xoff, yoff, xsize, ysize):
+        dataset = self.datasets[index]
+        if self.block_cache is None:
+            return dataset.ReadAsArray(
+                xoff=xoff, yoff=yoff, xsize=xsize, ysize=ysize,
+            )
+        return self.block_cache.read(
+            dataset, xoff=xoff, yoff=yoff, xsize=xsize, ysize=ysize,
+        )
 
     def read(self, bounds, inflate=False):
         """
@@ -91,11 +284,28 @@ class Group(object):
         array = np.full((y2 - y1, x2 - x1), self.no_data_value, self.dtype)
         view = array[q1 - y1: q2 - y1, p1 - x1: p2 - x1]
 
-        kwargs = {'xoff': p1, 'yoff': q1, 'xsize': p2 - p1, 'ysize': q2 - q1}
-        for dataset, no_data_value in zip(self.datasets, self.no_data_values):
-            data = dataset.ReadAsArray(**kwargs)
-            index = data != no_data_value
-            view[index] = data[index]
+        # fill the view in order of priority, the last dataset first, and
+        # read only the part of the view that still has gaps
+        unfilled = np.ones(view.shape, dtype='b1')
+        for index in reversed(range(len(self.datasets))):
+            rows = np.flatnonzero(unfilled.any(axis=1))
+            if rows.size == 0:
+                break
+            columns = np.flatnonzero(unfilled.any(axis=0))
+            r1, r2 = rows[0], rows[-1] + 1
+            c1, c2 = columns[0], columns[-1] + 1
+            x1, y1, x2, y2 = p1 + c1, q1 + r1, p1 + c2, q1 + r2
+            if not self._covers(index, x1, y1, x2, y2):
+                continue
+
+            data = self._read_dataset(
+                index, xoff=x1, yoff=y1, xsize=x2 - x1, ysize=y2 - y1,
+            )
+            sub_view = view[r1:r2, c1:c2]
+            sub_unfilled = unfilled[r1:r2, c1:c2]
+            fill = sub_unfilled & (data != self.no_data_values[index])
+            sub_view[fill] = data[fill]
+            sub_unfilled[fill] = False
 
         return array
 
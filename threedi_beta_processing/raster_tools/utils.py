@@ -111,6 +111,21 @@ class GeoTransform(tuple):
         i, j = indices
         return p + a * j + b * i, q + c * j + d * i
 
+    def get_pixel_indices(self, x, y):
+        """ Return i, j integer arrays of the pixels containing points.
+
+        :param x: array of x coordinates
+        :param y: array of y coordinates
+
+        i corresponds to the y direction in a non-skew grid.
+        """
+        p, a, b, q, c, d = self
+        e, f, g, h = get_inverse(a, b, c, d)
+        x, y = np.asarray(x), np.asarray(y)
+        i = np.floor(g * (x - p) + h * (y - q)).astype('i8')
+        j = np.floor(e * (x - p) + f * (y - q)).astype('i8')
+        return i, j
+
     def get_indices(self, geometry, inflate=False):
         """
         Return array indices tuple for geometry.
@@ -4,6 +4,8 @@
 from osgeo import ogr
 import numpy as np
 
+from . import utils
+
 
 def point2geometry(point):
     """ Return geometry. """
@@ -109,9 +111,9 @@ class ParameterizedLine(object):
             nonzero = self.vectors[:, i].nonzero()
             lparameters = ((intersects - self.p[nonzero, i])
                            / self.vectors[nonzero, i])
-            # add integer to parameter and mask outside line
+            # add segment index to parameter and mask outside line
             global_parameters = np.ma.array(
-                np.ma.array(lparameters + np.arange(nonzero[0].size)),
+                np.ma.array(lparameters + nonzero[0]),
                 mask=np.logical_or(lparameters < 0, lparameters > 1),
             )
             # only unmasked values must be in parameters
@@ -167,6 +169,132 @@ class ParameterizedLine(object):
         return closest.data
 
 
+def pixelize_many(lines, geo_transform):
+    """
+    Return list of (parameters, points, indices) tuples, one per line.
+
+    :param lines: sequence of N x 2 arrays with the coordinates of lines
+    :param geo_transform: geo transform of aligned, square pixels
+
+    This is ParameterizedLine.pixelize() for many lines at once. The grid
+    crossings of all segments of all lines are found in one vectorized
+    traversal, in the order in which a grid traversal (Amanatides & Woo)
+    would visit them along each segment. Per line, the parameters are those
+    of the vertices and grid crossings, the points are the corresponding
+    coordinates (the points of the pixelized ParameterizedLine) and indices
+    are the i, j indices of the pixel traversed between consecutive points.
+    """
+    p, a, b, q, c, d = geo_transform
+    if p % a or q % d or b or c or a + d:
+        raise ValueError('Currently only aligned, '
+                         'square pixels are implemented')
+    size = a
+
+    lines = [np.asarray(line, dtype='f8')[:, :2] for line in lines]
+    if not lines:
+        return []
+    counts = np.array([len(line) for line in lines])
+    points = np.concatenate(lines)
+    starts = np.cumsum(counts) - counts
+    line_of_point = np.repeat(np.arange(len(lines)), counts)
+    local_point = np.arange(len(points)) - starts[line_of_point]
+
+    # segments, from each point that is not the last of its line
+    first = np.flatnonzero(local_point < counts[line_of_point] - 1)
+    segment_p = points[first]
+    segment_vectors = points[first + 1] - segment_p
+    segment_line = line_of_point[first]
+    segment_local = local_point[first]
+
+    # parameters of the original points
+    parameter_lines = [line_of_point]
+    parameters = [local_point.astype('f8')]
+
+    # parameters of the grid crossings, per dimension
+    for i in 0, 1:
+        # grid coordinates per line, exactly like arange in pixelize()
+        low = np.minimum.reduceat(points[:, i], starts)
+        high = np.maximum.reduceat(points[:, i], starts)
+        grid_start = size * np.ceil(low / size)
+        grid_stop = size * np.ceil(high / size)
+        grid_count = np.maximum(np.ceil((grid_stop - grid_start) / size), 0)
+        grid_delta = (grid_start + size) - grid_start
+
+        # candidate grid lines for each segment that is not parallel
+        nonzero = np.flatnonzero(segment_vectors[:, i])
+        line = segment_line[nonzero]
+        start = segment_p[nonzero, i]
+        end = start + segment_vectors[nonzero, i]
+        first_index = np.maximum(
+            np.floor((np.minimum(start, end) - grid_start[line]) / size) - 1,
+            0,
+        ).astype('i8')
+        last_index = np.minimum(
+            np.ceil((np.maximum(start, end) - grid_start[line]) / size) + 1,
+            grid_count[line] - 1,
+        ).astype('i8')
+        candidates = np.maximum(last_index - first_index + 1, 0)
+
+        # expand to one entry per (segment, grid line)
+        segment = np.repeat(np.arange(nonzero.size), candidates)
+        offsets = np.cumsum(candidates) - candidates
+        index = (first_index[segment]
+                 + np.arange(segment.size) - offsets[segment])
+        line = line[segment]
+        intersects = grid_start[line] + index * grid_delta[line]
+
+        lparameters = (
+            (intersects - start[segment]) / segment_vectors[nonzero[segment], i]
+        )
+        inside = (lparameters >= 0) & (lparameters <= 1)
+        parameter_lines.append(line[inside])
+        parameters.append(
+            lparameters[inside] + segment_local[nonzero[segment[inside]]],
+        )
+
+    # unique on single precision per line, eliminating really close points
+    parameter_lines = np.concatenate(parameter_lines)
+    parameters = np.concatenate(parameters).astype('f4')
+    order = np.lexsort((parameters, parameter_lines))
+    parameter_lines = parameter_lines[order]
+    parameters = parameters[order]
+    unique = np.ones(parameters.size, dtype='b1')
+    unique[1:] = ((parameter_lines[1:] != parameter_lines[:-1])
+                  | (parameters[1:] != parameters[:-1]))
+    parameter_lines = parameter_lines[unique]
+    parameters = parameters[unique]
+
+    # points at the parameters, like ParameterizedLine.__getitem__()
+    length = (counts - 1)[parameter_lines]
+    segment_index = np.uint64(np.where(parameters == length,
+                                       length - 1, parameters))
+    t = np.where(parameters == length,
+                 1, np.remainder(parameters, 1)).reshape(-1, 1)
+    global_index = (starts[parameter_lines]
+                    - parameter_lines + segment_index.astype('i8'))
+    new_points = (segment_p[global_index]
+                  + t * segment_vectors[global_index])
+
+    # pixels traversed between consecutive points of the same line
+    centers = (new_points[:-1] + new_points[1:]) / 2
+    same_line = parameter_lines[:-1] == parameter_lines[1:]
+    e, f, g, h = utils.get_inverse(a, b, c, d)
+    x, y = centers.transpose()
+    pixel_j = np.floor(e * (x - p) + f * (y - q)).astype('i8')
+    pixel_i = np.floor(g * (x - p) + h * (y - q)).astype('i8')
+
+    result = []
+    splits = np.flatnonzero(~same_line) + 1
+    bounds = np.concatenate([[0], splits, [parameters.size]])
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        indices = np.stack([pixel_i[start:stop - 1],
+                            pixel_j[start:stop - 1]], axis=1)
+        result.append((parameters[start:stop],
+                       new_points[start:stop],
+                       indices))
+    return result
+
+
 def array2polygon(array):
     """
     Return a polygon geometry.
@@ -1,11 +1,13 @@
 # TODO error when channels (in .fill_wedge()) or
 #  cross-section locations (in .split() or .make_valid()) do not have id.
 
+import math
+from collections import defaultdict, deque
 from enum import Enum
 from typing import Iterator, List, Union, Set, Sequence, Tuple
 
 import numpy as np
-from shapely import wkt, set_precision, MultiPoint
+from shapely import wkt, set_precision, MultiPoint, line_interpolate_point, line_locate_point
 from shapely.geometry import LineString, MultiLineString, MultiPolygon, Point, Polygon
 from shapely.ops import unary_union, linemerge, nearest_points, transform
 
@@ -42,6 +44,12 @@ def is_monotonically_increasing(a: np.array, equal_allowed=False):
     return np.all(a[1:] > a[0:-1])
 
 
+def cumulative_chainage(coords: np.array) -> np.array:
+    """Distance along a line from its start to each of its vertices. ``coords`` is a (n, 2) or (n, 3) array"""
+    segment_lengths = np.hypot(*np.diff(np.asarray(coords)[:, :2], axis=0).T)
+    return np.concatenate([[0.0], np.cumsum(segment_lengths)])
+
+
 def is_left_of_line(point: Point, line: LineString) -> Union[bool, None]:
     """
     Is ``point`` to the left of ``line``?
@@ -212,10 +220,9 @@ def highest_valid_index_single_offset(line: LineString, offset: float) -> int:
     Returns index of the vertex at which to split ``line`` in a (first) part for which a valid offset_curve can be made
     at given ``offset`` and a (second) part, i.e. the rest of ``line``
     """
-    vertex_positions = [line.project(Point(vertex)) for vertex in line.coords]
     highest_valid_idx = 1
-    lowest_invalid_idx = len(vertex_positions) - 1
-    current_idx = len(vertex_positions) - 1
+    lowest_invalid_idx = len(line.coords) - 1
+    current_idx = len(line.coords) - 1
     while lowest_invalid_idx - highest_valid_idx > 1:
         test_line = LineString([(Point(vertex)) for vertex in line.coords[:current_idx + 1]])
         if is_valid_offset(test_line, offset):
@@ -575,11 +582,7 @@ class Channel:
     @property
     def vertex_positions(self) -> np.array:
         """Array of channel vertex positions along the channel"""
-        result_list = [
-            self.geometry.project(Point(vertex)) for vertex in self.geometry.coords
-        ]
-        result_array = np.array(result_list)
-        return result_array
+        return cumulative_chainage(self.geometry.coords)
 
     @property
     def last_index(self) -> int:
@@ -594,8 +597,8 @@ class Channel:
 
     @property
     def outline(self) -> Polygon:
-        radii = np.array([self.max_width_at(position) / 2 for position in self.vertex_positions])
-        thalweg_ys = np.array([self.thalweg_y_at(position) for position in self.vertex_positions])
+        radii = self.max_width_at(self.vertex_positions) / 2
+        thalweg_ys = self.thalweg_y_at(self.vertex_positions)
         shifts = (radii - thalweg_ys) * -1
         result = variable_buffer(linestring=self.geometry, radii=radii, shifts=shifts)
 
@@ -661,7 +664,23 @@ class Channel:
         self._extra_outline = []
         # offsets are sorted from left to right
         offsets = sorted(list(set(self.unique_offsets) | {0}), reverse=RIGHT == -1) if offset_0 else self.unique_offsets
-        self.parallel_offsets = [ParallelOffset(parent=self, offset_distance=offset) for offset in offsets]
+
+        # the cross-section location points and their z at each offset are the same for all parallel offsets
+        cross_section_location_points = line_interpolate_point(
+            self.geometry, self.cross_section_location_positions
+        )
+        z_ordinates_at_cross_sections = np.array(
+            [xsec.z_at(np.asarray(offsets)) for xsec in self.cross_section_locations]
+        ).reshape(-1, len(offsets))
+        self.parallel_offsets = [
+            ParallelOffset(
+                parent=self,
+                offset_distance=offset,
+                cross_section_location_points=cross_section_location_points,
+                z_ordinates_at_cross_sections=z_ordinates_at_cross_sections[:, i],
+            )
+            for i, offset in enumerate(offsets)
+        ]
 
         last_vertex_index = -1
         # -1 so that we have 0-based indexing, because QgsMesh vertices have 0-based indices too
@@ -699,21 +718,20 @@ class Channel:
         assert len(all_points) -1 == all_points[-1].index
         return all_points
 
-    @staticmethod
-    def add_to_triangle_sort(
-        triangle: Triangle,
-        processed_sides: Set[Tuple],
-        sorted_triangles: List[Triangle],
-    ) -> bool:
-        """Adds the triangle to `sorted_triangles` if at least one of its sides is already present in `processed_sides`
-        Returns True if adding was successful, False if not"""
-        if len(triangle.sides & processed_sides):
-            # at least one of the sides of the new triangle has already been processed
-            sorted_triangles.append(triangle)
-            processed_sides.update(triangle.sides)
-            return True
-        else:
-            return False
+    @property
+    def vertex_coordinates(self) -> np.array:
+        """(n, 3) array of the x, y, z coordinates of all points, ordered by vertex index"""
+        return np.array([point.geom.coords[0] for point in self.points])
+
+    @property
+    def triangle_vertex_indices(self) -> np.array:
+        """
+        (n, 3) array of the vertex indices of all triangles. Unlike ``triangles``, these are not sorted.
+
+        Will only return triangles if ``fill_parallel_offsets`` and/or ``fill_wedge()`` have been called first.
+        """
+        triangles = self._parallel_offset_triangles + self._wedge_fill_triangles
+        return np.array([triangle.vertex_indices for triangle in triangles], dtype=int).reshape(-1, 3)
 
     @property
     def triangles(self) -> List[Triangle]:
@@ -725,38 +743,29 @@ class Channel:
         Will only return triangles if ``fill_parallel_offsets`` and/or ``fill_wedge()`` have been called first.
         """
         triangles = self._parallel_offset_triangles + self._wedge_fill_triangles
-
-        # sort
-        processed_sides = triangles[0].sides
-        sorted_triangles = [triangles[0]]
-
-        while len(sorted_triangles) < len(triangles):
-            failed_triangles = []
-            for triangle in triangles[1:]:
-                # handle next triangle from the original list
-                if not self.add_to_triangle_sort(
-                    triangle, processed_sides, sorted_triangles
-                ):
-                    failed_triangles.append(triangle)
-
-                # handle failed triangles from previous run(s)
-                triangle_added = True
-                while triangle_added:
-                    before_count = len(sorted_triangles)
-                    failed_triangles = [
-                        ft
-                        for ft in failed_triangles
-                        if not self.add_to_triangle_sort(
-                            ft, processed_sides, sorted_triangles
-                        )
-                    ]
-                    triangle_added = len(sorted_triangles) > before_count
-            if failed_triangles:
-                # force first failed triangle in the sorted list and continue while loop
-                sorted_triangles.append(failed_triangles[0])
-                processed_sides.update(failed_triangles[0].sides)
-                triangles = failed_triangles[1:]
-
+        triangle_sides = [triangle.sides for triangle in triangles]
+        triangles_per_side = defaultdict(list)
+        for i, sides in enumerate(triangle_sides):
+            for side in sides:
+                triangles_per_side[side].append(i)
+
+        # breadth-first traversal of the triangles via their shared sides, starting a new section at the first
+        # triangle that has not been reached yet
+        sorted_triangles = []
+        reached = [False] * len(triangles)
+        for first in range(len(triangles)):
+            if reached[first]:
+                continue
+            reached[first] = True
+            queue = deque([first])
+            while queue:
+                i = queue.popleft()
+                sorted_triangles.append(triangles[i])
+                for side in triangle_sides[i]:
+                    for neighbour in triangles_per_side[side]:
+                        if not reached[neighbour]:
+                            reached[neighbour] = True
+                            queue.append(neighbour)
         return sorted_triangles
 
     def find_vertex(self, connection_node_id: int, n: int) -> Point:
@@ -861,7 +870,7 @@ class Channel:
         for po in sorted(channel_to_update.parallel_offsets, key=lambda x: np.abs(x.offset_distance)):
             if po.offset_distance * channel_to_update_side >= 0:
                 channel_to_update_offsets.append(po.offset_distance)
-                channel_to_update_points.append(po.points[channel_to_update_idx])
+                channel_to_update_points.append(po.point(channel_to_update_idx))
 
         # Append start or end vertices of all other_channel's parallel offsets to self._wedge_fill_points
         # left is positive, right is negative
@@ -874,7 +883,7 @@ class Channel:
         for po in sorted(wedge_fill_points_source.parallel_offsets, key=lambda x: np.abs(x.offset_distance)):
             if po.offset_distance * wedge_fill_points_source_side > 0:
                 wedge_fill_points_source_offsets.append(po.offset_distance)
-                existing_point = po.points[wedge_fill_points_source_idx]
+                existing_point = po.point(wedge_fill_points_source_idx)
                 wedge_fill_points.append(
                     IndexedPoint(
                         existing_point.geom, index=last_index + 1
@@ -1088,11 +1097,22 @@ class Channel:
 
 
 class ParallelOffset:
-    def __init__(self, parent: Channel, offset_distance: float):
+    def __init__(
+            self,
+            parent: Channel,
+            offset_distance: float,
+            cross_section_location_points: np.array = None,
+            z_ordinates_at_cross_sections: np.array = None,
+    ):
         """
         The side is determined by the sign of the distance parameter (negative for right side offset, positive for left
         side offset). Left and right are determined by following the direction of the given geometric points of the
         LineString.
+
+        :param cross_section_location_points: array of the Points on ``parent`` at its cross-section location
+        positions. Calculated if not given; pass it to avoid recalculating it for every offset
+        :param z_ordinates_at_cross_sections: array of the z of each of ``parent``'s cross-section locations at
+        ``offset_distance``. Calculated if not given
         """
         self.parent = parent
         self.geometry = offset_curve_fixed(parent.geometry, offset_distance)
@@ -1101,26 +1121,27 @@ class ParallelOffset:
         if type(self.geometry) != LineString:
             raise InvalidOffsetError
         self.offset_distance = offset_distance
-        cross_section_location_positions = []
-        for pos in self.parent.cross_section_location_positions:
-            # handle normal case where CrossSectionLocation is located on the Channel
-            if pos >= 0 and pos <= self.parent.geometry.length:
-                location_xy = self.parent.geometry.interpolate(pos)
-                cross_section_location_point = nearest_points(location_xy, self.geometry)[0]
-                cross_section_location_positions.append(self.geometry.project(cross_section_location_point))
-
-            # handle 'ghost' cross-section locations that belong to channels created by Channel.split()
-            # it is implicitly assumed that the channel in the "ghost" section(s) is straight, i.e. the length of the
-            # ParallelOffset equals the length of the Channel in those sections
-            else:
-                cross_section_location_positions.append(pos)
+        parent_positions = self.parent.cross_section_location_positions
+        if cross_section_location_points is None:
+            cross_section_location_points = line_interpolate_point(self.parent.geometry, parent_positions)
+
+        # normal case where CrossSectionLocation is located on the Channel: project its location on the Channel onto
+        # the parallel offset.
+        # 'ghost' cross-section locations that belong to channels created by Channel.split() keep their position
+        # it is implicitly assumed that the channel in the "ghost" section(s) is straight, i.e. the length of the
+        # ParallelOffset equals the length of the Channel in those sections
+        on_channel = (parent_positions >= 0) & (parent_positions <= self.parent.geometry.length)
+        cross_section_location_positions = np.where(
+            on_channel,
+            line_locate_point(self.geometry, cross_section_location_points),
+            parent_positions
+        )
 
-        z_ordinates_at_cross_sections = [
-            xsec.z_at(self.offset_distance) for xsec in self.parent.cross_section_locations
-        ]
-        self.vertex_positions = [
-            self.geometry.project(Point(vertex)) for vertex in self.geometry.coords
-        ]
+        if z_ordinates_at_cross_sections is None:
+            z_ordinates_at_cross_sections = [
+                xsec.z_at(self.offset_distance) for xsec in self.parent.cross_section_locations
+            ]
+        self.vertex_positions = cumulative_chainage(self.geometry.coords)
         self.heights_at_vertices = np.interp(
             self.vertex_positions,
             cross_section_location_positions,
@@ -1135,6 +1156,11 @@ class ParallelOffset:
             result.append(IndexedPoint(x, y, self.heights_at_vertices[i], index=self.vertex_indices[i]))
         return result
 
+    def point(self, i: int) -> IndexedPoint:
+        """Returns the ``i``th point of ``points``, without creating all the others"""
+        x, y = self.geometry.coords[i]
+        return IndexedPoint(x, y, self.heights_at_vertices[i], index=self.vertex_indices[i])
+
     def set_vertex_indices(self, first_vertex_index: int):
         self.vertex_indices = list(
             range(first_vertex_index, first_vertex_index + len(self.geometry.coords))
@@ -1158,6 +1184,83 @@ class ParallelOffset:
         )
 
 
+def is_clearly_between(
+    triangle_vertices: Sequence[Tuple[int, int]],
+    sides_xy: Tuple[np.array, np.array],
+    tolerance: float = 1e-9,
+) -> bool:
+    """
+    Coordinate-based check whether a triangle with one side along one of two lines is between those lines, i.e. none
+    of the lines' segments touches the triangle, except the triangle's own side and the segments that start at one of
+    the triangle's vertices and point away from the triangle.
+
+    If True, ``Triangle.is_between()`` is True as well. False means that this could not be established with a margin of
+    ``tolerance``, in which case ``Triangle.is_between()`` has to decide.
+
+    :param triangle_vertices: (side, index) of the triangle's vertices. Side 0 is the left side, 1 the right side. Two
+    of the vertices must be consecutive vertices on the same side
+    :param sides_xy: (n, 2) arrays of the vertex coordinates of the left and the right side
+    """
+    triangle_xy = np.array([sides_xy[side][index] for side, index in triangle_vertices])
+    edges = np.roll(triangle_xy, -1, axis=0) - triangle_xy
+    doubled_area = edges[0, 0] * edges[1, 1] - edges[0, 1] * edges[1, 0]
+    if abs(doubled_area) <= tolerance:
+        return False
+
+    # unit normals of the triangle edges, pointing outwards
+    normals = np.stack([edges[:, 1], -edges[:, 0]], axis=1) * np.sign(doubled_area)
+    normals /= np.hypot(normals[:, 0], normals[:, 1])[:, np.newaxis]
+    triangle_projections = triangle_xy @ normals.T  # [vertex, edge]
+    triangle_max = np.max(triangle_projections, axis=0)
+    triangle_min = np.min(triangle_projections, axis=0)
+
+    for side, side_xy in enumerate(sides_xy):
+        if len(side_xy) < 2:
+            continue
+        starts, ends = side_xy[:-1], side_xy[1:]
+        other = np.ones(len(starts), dtype=bool)  # segments that do not share a vertex with the triangle
+        for vertex_nr, (vertex_side, index) in enumerate(triangle_vertices):
+            if vertex_side != side:
+                continue
+            for segment_index, far_end in ((index - 1, index - 1), (index, index + 1)):
+                if not 0 <= segment_index < len(starts) or not other[segment_index]:
+                    continue
+                other[segment_index] = False
+                if (side, far_end) in triangle_vertices:
+                    continue  # the triangle's own side
+                # the segment must leave the triangle at the vertex, i.e. its far end has to be clearly outside one of
+                # the two triangle edges that meet at the vertex
+                distances = (side_xy[far_end] - triangle_xy[vertex_nr]) @ normals[[vertex_nr - 1, vertex_nr]].T
+                if not np.any(distances > tolerance):
+                    return False
+
+        # separating axis test for all other segments: the triangle edge normals and the segment normals
+        starts, ends = starts[other], ends[other]
+        if len(starts) == 0:
+            continue
+        start_projections = starts @ normals.T
+        end_projections = ends @ normals.T
+        separated = np.any(
+            (np.minimum(start_projections, end_projections) > triangle_max + tolerance)
+            | (np.maximum(start_projections, end_projections) < triangle_min - tolerance),
+            axis=1
+        )
+        if np.all(separated):
+            continue
+        directions = ends[~separated] - starts[~separated]
+        lengths = np.hypot(directions[:, 0], directions[:, 1])
+        segment_normals = np.stack([directions[:, 1], -directions[:, 0]], axis=1) / np.where(lengths > 0, lengths, 1)[:, np.newaxis]
+        segment_projections = np.sum(starts[~separated] * segment_normals, axis=1)
+        triangle_on_segment_normals = triangle_xy @ segment_normals.T  # [vertex, segment]
+        separated_by_segment_normal = (lengths > 0) & (
+            (segment_projections > np.max(triangle_on_segment_normals, axis=0) + tolerance)
+            | (segment_projections < np.min(triangle_on_segment_normals, axis=0) - tolerance)
+        )
+        if not np.all(separated_by_segment_normal):
+            return False
+    return True
+
+
 def triangulate_between(
     left_side_points: List[IndexedPoint],
     right_side_points: List[IndexedPoint],
@@ -1196,6 +1299,22 @@ def triangulate_between(
             f"right side line: {right_side_line.wkt}"
         )
 
+    sides_xy = (
+        np.array([(point.x, point.y) for point in left_side_points]),
+        np.array([(point.x, point.y) for point in right_side_points]),
+    )
+
+    def is_between(triangle: Triangle, triangle_vertices: Sequence[Tuple[int, int]]) -> bool:
+        """``triangle.is_between()``, but only evaluating the shapely predicates if the coordinates are not conclusive"""
+        return is_clearly_between(triangle_vertices, sides_xy) or \
+            triangle.is_between(left_side_line, right_side_line)
+
+    def distance(left_idx: int, right_idx: int) -> float:
+        """Length of the line between a left and a right side point, calculated in the same way as GEOS does"""
+        dx = sides_xy[0][left_idx][0] - sides_xy[1][right_idx][0]
+        dy = sides_xy[0][left_idx][1] - sides_xy[1][right_idx][1]
+        return math.sqrt(dx * dx + dy * dy)
+
     left_side_idx = 0
     right_side_idx = 0
     left_side_last_idx = len(left_side_points) - 1
@@ -1213,29 +1332,25 @@ def triangulate_between(
 
         # then we handle the 'normal' case when we are still halfway at both sides
         else:
-            move_on_left_side_cross_line = LineString([
-                left_side_points[left_side_idx + 1].geom,
-                right_side_points[right_side_idx].geom
-            ])
-            move_on_right_side_cross_line = LineString([
-                left_side_points[left_side_idx].geom,
-                right_side_points[right_side_idx + 1].geom
-            ])
-            move = LEFT if move_on_left_side_cross_line.length < move_on_right_side_cross_line.length else RIGHT
+            move_on_left_side_cross_line_length = distance(left_side_idx + 1, right_side_idx)
+            move_on_right_side_cross_line_length = distance(left_side_idx, right_side_idx + 1)
+            move = LEFT if move_on_left_side_cross_line_length < move_on_right_side_cross_line_length else RIGHT
 
             # switch move side if moving on that side results in invalid triangle
             test_triangle_move_left = Triangle(triangle_points + [left_side_points[left_side_idx + 1]])
             test_triangle_move_right = Triangle(triangle_points + [right_side_points[right_side_idx + 1]])
+            move_left_vertices = [(0, left_side_idx), (1, right_side_idx), (0, left_side_idx + 1)]
+            move_right_vertices = [(0, left_side_idx), (1, right_side_idx), (1, right_side_idx + 1)]
             if move == LEFT:
-                if not test_triangle_move_left.is_between(left_side_line, right_side_line):
-                    if test_triangle_move_right.is_between(left_side_line, right_side_line):
+                if not is_between(test_triangle_move_left, move_left_vertices):
+                    if is_between(test_triangle_move_right, move_right_vertices):
                         move = RIGHT
                     else:
                         # both 'default' options are invalid
                         move = 0
             elif move == RIGHT:
-                if not test_triangle_move_right.is_between(left_side_line, right_side_line):
-                    if test_triangle_move_left.is_between(left_side_line, right_side_line):
+                if not is_between(test_triangle_move_right, move_right_vertices):
+                    if is_between(test_triangle_move_left, move_left_vertices):
                         move = LEFT
                     else:
                         # both 'default' options are invalid
@@ -1285,18 +1400,16 @@ def unique_connection_node_ids(channels: List[Channel]) -> Set[int]:
 
 
 def get_channels_per_connection_node(channels: List[Channel]) -> dict:
-    result = dict()
-    connection_node_ids = unique_connection_node_ids(channels)
-    for connection_node_id in connection_node_ids:
-        current_node_channels = []
-        for channel in channels:
-            if connection_node_id in [
-                channel.connection_node_id_start,
-                channel.connection_node_id_end,
-            ]:
-                current_node_channels.append(channel)
-        result[connection_node_id] = current_node_channels
-    return result
+    """
+    Returns a dict {connection node id: [channels that start or end at that connection node]}, built in a single pass
+    over ``channels``. Channels are listed in the order in which they occur in ``channels``.
+    """
+    result = defaultdict(list)
+    for channel in channels:
+        result[channel.connection_node_id_start].append(channel)
+        if channel.connection_node_id_end != channel.connection_node_id_start:
+            result[channel.connection_node_id_end].append(channel)
+    return dict(result)
 
 
 def azimuth(point1, point2):
@@ -10,20 +10,18 @@
 *                                                                         *
 ***************************************************************************
 """
-from typing import List, Union, Tuple
-from uuid import uuid4
+import os
+from collections import defaultdict
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Set, Union, Tuple
 
 import numpy as np
 from osgeo import gdal
 from qgis.PyQt.QtCore import QCoreApplication, QVariant
 from qgis.core import (
-    Qgis,
-    QgsApplication,
     QgsCoordinateReferenceSystem,
-    QgsCoordinateTransform,
     QgsGeometry,
-    QgsMesh,
-    QgsMeshLayer,
     QgsProcessingMultiStepFeedback,
     QgsFeature,
     QgsFeatureSink,
@@ -37,16 +35,12 @@ from qgis.core import (
     QgsProcessingFeedback,
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterFile,
     QgsProcessingParameterNumber,
     QgsProcessingParameterRasterDestination,
     QgsProcessingParameterRasterLayer,
-    QgsProcessingUtils,
-    QgsProviderRegistry,
-    QgsRectangle,
-    QgsVectorLayer,
     QgsWkbTypes,
 )
-import processing
 from shapely import __version__ as shapely_version, geos_version
 
 from .rasterize_channel import (
@@ -58,20 +52,28 @@ from .rasterize_channel import (
     NoCrossSectionLocationsError,
     fill_wedges, IntersectingSidesError,
 )
-from .rasterize_channel_utils import merge_rasters
+from .rasterize_channel_cache import ChannelRasterCache, channel_fingerprints
+from .rasterize_channel_utils import (
+    TEMPORARY_RASTER_OPTIONS,
+    map_ordered,
+    merge_rasters,
+    rasterize_channel,
+    write_raster,
+)
 
 
 DEBUG_MODE = False
+NODATA_VALUE = -9999
 
 
-def align_qgs_rectangle(extent: QgsRectangle, xres, yres):
-    """round the coordinates of an extent tuple (minx, miny, maxx, maxy) to a multiple of the resolution (pixel size) in
-    such a way that the new extent contains the input extent"""
-    minx = float(np.trunc(extent.xMinimum() / xres) * xres)
-    miny = float(np.trunc(extent.yMinimum() / yres) * yres)
-    maxx = float(np.ceil(extent.xMaximum() / xres) * xres)
-    maxy = float(np.ceil(extent.yMaximum() / yres) * yres)
-    return QgsRectangle(minx, miny, maxx, maxy)
+def cross_section_location_features_per_channel(
+        cross_section_location_features: QgsFeatureSource
+) -> Dict[int, List[QgsFeature]]:
+    """Group the cross-section location features by their channel_id, in a single pass over the source"""
+    result = defaultdict(list)
+    for cross_section_location_feature in cross_section_location_features.getFeatures():
+        result[cross_section_location_feature.attribute("channel_id")].append(cross_section_location_feature)
+    return result
 
 
 def read_channels(
@@ -79,57 +81,82 @@ def read_channels(
         cross_section_location_features: QgsFeatureSource,
         pixel_size: float,
         feedback: Union[QgsProcessingFeedback, QgsProcessingMultiStepFeedback],
+        channel_ids: Set[int] = None,
+        max_workers: int = 1,
 ) -> Tuple[List[Channel], List[int]]:
-    channels = []
-    errors = []
-    for i, channel_feature in enumerate(channel_features.getFeatures()):
+    """
+    Read the channels and their cross-section locations, and make them valid (generate parallel offsets and triangles)
+
+    The channels are read in the calling thread and made valid by ``max_workers`` worker threads. Results are collected
+    in the order of the channel features, so the output does not depend on the number of workers.
+
+    :param channel_ids: only read the channels with these ids. If None, all channels are read
+    """
+    input_channels = []
+    features_per_channel = cross_section_location_features_per_channel(cross_section_location_features)
+    for channel_feature in channel_features.getFeatures():
         if feedback.isCanceled():
-            return []
+            return [], []
         channel_id = channel_feature.attribute("id")
+        if channel_ids is not None and channel_id not in channel_ids:
+            continue
         feedback.setProgressText(
             f"Reading channel and cross-section data for channel {channel_id}..."
         )
         channel = Channel.from_qgs_feature(channel_feature)
-        for cross_section_location_feature in cross_section_location_features.getFeatures():
-            if channel_id == cross_section_location_feature.attribute("channel_id"):
-                cross_section_location = CrossSectionLocation.from_qgs_feature(
-                    cross_section_location_feature,
-                    wall_displacement=pixel_size / 4.0,
-                    simplify_tolerance=0.01
-                )
-                channel.add_cross_section_location(cross_section_location)
-        channel.geometry = channel.geometry.simplify(pixel_size)
-        try:
-            if DEBUG_MODE:
-                feedback.pushInfo(f"Channel has {len(channel.cross_section_locations)} cross-section locations")
-            channels += channel.make_valid()
-        except EmptyOffsetError:
-            errors.append(channel_id)
-            feedback.reportError(
-                f"ERROR: Could not read channel with id {channel.id[0]}: no valid parallel offset can be generated "
-                f"for some cross-sections. "
-            )
-        except InvalidOffsetError:
-            errors.append(channel_id)
-            feedback.reportError(
-                f"ERROR: Could not read channel with id {channel.id[0]}: no valid parallel offset can be generated "
-                f"for some cross-sections. It may help to split the channel in the middle of its bends."
-            )
-        except WidthsNotIncreasingError:
-            errors.append(channel_id)
-            feedback.reportError(
-                f"ERROR: Could not read channel with id {channel.id[0]}: the widths in the cross-section table for one "
-                f"or more cross-section locations are not all increasing with height."
+        for cross_section_location_feature in features_per_channel.get(channel_id, []):
+            cross_section_location = CrossSectionLocation.from_qgs_feature(
+                cross_section_location_feature,
+                wall_displacement=pixel_size / 4.0,
+                simplify_tolerance=0.01
             )
-        except NoCrossSectionLocationsError:
-            errors.append(channel_id)
-            feedback.reportError(
-                f"ERROR: Channel with id {channel.id[0]} has no cross-section locations."
-            )
-        except Exception as e:
-            errors.append(channel_id)
-            feedback.reportError(f"ERROR: Channel with id {channel_id} could not be read. Error details: {repr(e)}")
-        feedback.setProgress(100 * i / channel_features.featureCount())
+            channel.add_cross_section_location(cross_section_location)
+        channel.geometry = channel.geometry.simplify(pixel_size)
+        if DEBUG_MODE:
+            feedback.pushInfo(f"Channel has {len(channel.cross_section_locations)} cross-section locations")
+        input_channels.append(channel)
+
+    channels = []
+    errors = []
+    results = map_ordered(Channel.make_valid, input_channels, max_workers)
+    try:
+        for i, (channel, future) in enumerate(results):
+            if feedback.isCanceled():
+                return [], []
+            channel_id = channel.id[0]
+            feedback.setProgressText(f"Generating parallel offsets and triangles for channel {channel_id}...")
+            try:
+                channels += future.result()
+            except EmptyOffsetError:
+                errors.append(channel_id)
+                feedback.reportError(
+                    f"ERROR: Could not read channel with id {channel.id[0]}: no valid parallel offset can be generated "
+                    f"for some cross-sections. "
+                )
+            except InvalidOffsetError:
+                errors.append(channel_id)
+                feedback.reportError(
+                    f"ERROR: Could not read channel with id {channel.id[0]}: no valid parallel offset can be generated "
+                    f"for some cross-sections. It may help to split the channel in the middle of its bends."
+                )
+            except WidthsNotIncreasingError:
+                errors.append(channel_id)
+                feedback.reportError(
+                    f"ERROR: Could not read channel with id {channel.id[0]}: the widths in the cross-section table for "
+                    f"one or more cross-section locations are not all increasing with height."
+                )
+            except NoCrossSectionLocationsError:
+                errors.append(channel_id)
+                feedback.reportError(
+                    f"ERROR: Channel with id {channel.id[0]} has no cross-section locations."
+                )
+            except Exception as e:
+                errors.append(channel_id)
+                feedback.reportError(f"ERROR: Channel with id {channel_id} could not be read. Error details: {repr(e)}")
+            feedback.setProgress(100 * i / len(input_channels))
+    finally:
+        # on cancel, do not start on the channels that are still waiting
+        results.close()
     return channels, errors
 
 
@@ -138,220 +165,107 @@ def rasterize(
         pixel_size: float,
         crs,
         errors: List[int],
-        warnings: List[int],
         feedback: Union[QgsProcessingFeedback, QgsProcessingMultiStepFeedback],
-        context,
+        output_dir: Path,
+        max_workers: int = 1,
+        cache: ChannelRasterCache = None,
         points_sink: QgsFeatureSink = None,
         points_fields: QgsFields = None,
         triangles_sink: QgsFeatureSink = None,
         triangles_fields: QgsFields = None,
         outline_sink: QgsFeatureSink = None,
         outline_fields: QgsFields = None,
-) -> Tuple[List[str], int]:
+) -> List[str]:
+    """
+    Rasterize each channel's triangles to a compressed GeoTIFF in ``output_dir``, masked by the channel's outline.
+    Returns the filenames of the rasters
 
-    rasters = []
-    total_missing_pixels = 0
-    for i, channel in enumerate(channels):
-        if feedback.isCanceled():
-            return {}
-        if channel.id[1] == 0:
-            feedback.setProgressText(f"Rasterizing channel {channel.id[0]}...")
-        else:
-            feedback.setProgressText(
-                f"Rasterizing part {channel.id[1] + 1} of channel {channel.id[0]}..."
-            )
-        points = [QgsPoint(*point.geom.coords[0]) for point in channel.points]
-        if DEBUG_MODE:
-            for (point_idx, qgs_point) in [
-                (point.index, QgsPoint(*point.geom.coords[0])) for point in channel.points
-            ]:
-                point_feature = QgsFeature()
-                point_feature.setFields(points_fields)
-                point_feature.setAttribute(0, i)
-                point_feature.setAttribute(1, point_idx)
-                point_feature.setGeometry(qgs_point)
-                points_sink.addFeature(point_feature, QgsFeatureSink.FastInsert)
-
-        # create temporary mesh file
-        provider_meta = QgsProviderRegistry.instance().providerMetadata("mdal")
-        mesh = QgsMesh()
-        temp_mesh_filename = f"{uuid4()}.nc"
-        temp_mesh_fullpath = QgsProcessingUtils.generateTempFilename(
-            temp_mesh_filename
-        )
-        mesh_format = "Ugrid"
-        provider_meta.createMeshData(mesh=mesh, fileName=temp_mesh_fullpath, driverName=mesh_format, crs=crs)
-        mesh_layer = QgsMeshLayer(temp_mesh_fullpath, "editable mesh", "mdal")
-
-        # add points to mesh
-        transform = QgsCoordinateTransform()
-        mesh_layer.startFrameEditing(transform)
-        editor = mesh_layer.meshEditor()
-        points_added = editor.addPointsAsVertices(points, 0.0000001)
-        if points_added != len(points):
-            feedback.pushWarning(
-                f"Warning: Added only {points_added} points from a total of {len(points)}!"
-            )
+    The channels are rasterized by ``max_workers`` worker threads, with at most a few channels ahead of the one that is
+    collected. Results are collected in the order of ``channels``, so the output does not depend on the number of
+    workers. Feedback, cancellation and the (debug) feature sinks are handled in the calling thread.
 
-        # add faces to mesh
-        try:
-            triangles_dict = {k: v for k, v in enumerate(channel.triangles)}
-            if DEBUG_MODE:
-                for triangle_nr, triangle in triangles_dict.items():
-                    triangle_feature = QgsFeature()
-                    triangle_feature.setFields(triangles_fields)
-                    triangle_feature.setAttribute(0, i)
-                    triangle_feature.setAttribute(1, triangle_nr)
-                    triangle_geometry = QgsGeometry()
-                    triangle_geometry.fromWkb(triangle.geometry.wkb)
-                    triangle_feature.setGeometry(triangle_geometry)
-                    triangles_sink.addFeature(triangle_feature, QgsFeatureSink.FastInsert)
-                outline_feature = QgsFeature()
-                outline_feature.setFields(outline_fields)
-                outline_feature.setAttribute(0, i)
-                outline_geometry = QgsGeometry()
-                outline_geometry.fromWkb(channel.outline.wkb)
-                outline_feature.setGeometry(outline_geometry)
-                outline_sink.addFeature(outline_feature, QgsFeatureSink.FastInsert)
-
-            total_triangles = len(triangles_dict)
-            faces_added = 0
-            occupied_vertices = np.array([], dtype=int)
-            finished = False
-            processed_triangles = []
-            while not finished:
-                if feedback.isCanceled():
-                    return {}
-                finished = True
-                for k in processed_triangles:
-                    triangles_dict.pop(k)
-                processed_triangles = []
-                for j, triangle in triangles_dict.items():
-                    if (
-                        j == 0
-                        or np.sum(np.in1d(triangle.vertex_indices, occupied_vertices)) >= 2
-                    ):
-                        error = editor.addFace(triangle.vertex_indices)
-                        # To list error types, run [e for e in Qgis.MeshEditingErrorType]
-                        if error.errorType == Qgis.MeshEditingErrorType.NoError:
-                            finished = False
-                            processed_triangles.append(j)
-                            faces_added += 1
-                            occupied_vertices = np.append(occupied_vertices, triangle.vertex_indices)
-                        elif DEBUG_MODE:
-                            feedback.pushInfo(
-                                f"Could not (yet) add triangle {j}.\n"
-                                f"Error type {str(error.errorType)}.\n"
-                                f"Error element index: {error.elementIndex}\n"
-                                f"Error point: {[p.geom for p in triangle.points if p.index == error.elementIndex]}\n"
-                                f"WKT: {triangle.geometry.wkt}\n"
-                                f"Vertex indices: {triangle.vertex_indices}\n"
-                                f"Points: {[pnt.geom.wkt for pnt in channel.points if pnt.index in [p.index for p in triangle.points]]}"
-                            )
-
-            if faces_added != total_triangles:
-                missing_area = np.sum(
-                    np.array([tri.geometry.area for tri in triangles_dict.values()])
+    If ``cache`` is given, the rasters are added to it
+    """
+    rasters = []
+    srs = crs.toWkt()
+
+    def output_filename(channel: Channel) -> str:
+        return str(output_dir / f"channel_{channel.id[0]}_{channel.id[1]}.tif")
+
+    results = map_ordered(
+        lambda channel: rasterize_channel(
+            channel, pixel_size, output_filename=output_filename(channel), srs=srs, nodatavalue=NODATA_VALUE
+        ),
+        channels,
+        max_workers,
+    )
+    try:
+        for i, (channel, future) in enumerate(results):
+            if feedback.isCanceled():
+                return []
+            if channel.id[1] == 0:
+                feedback.setProgressText(f"Rasterizing channel {channel.id[0]}...")
+            else:
+                feedback.setProgressText(
+                    f"Rasterizing part {channel.id[1] + 1} of channel {channel.id[0]}..."
                 )
+            if DEBUG_MODE:
+                for (point_idx, qgs_point) in [
+                    (point.index, QgsPoint(*point.geom.coords[0])) for point in channel.points
+                ]:
+                    point_feature = QgsFeature()
+                    point_feature.setFields(points_fields)
+                    point_feature.setAttribute(0, i)
+                    point_feature.setAttribute(1, point_idx)
+                    point_feature.setGeometry(qgs_point)
+                    points_sink.addFeature(point_feature, QgsFeatureSink.FastInsert)
+
+            try:
                 if DEBUG_MODE:
-                    feedback.pushInfo(f"Missing triangles:")
-                    tri_queries = [f"SELECT ST_GeomFromText('{tri.geometry.wkt}') as geom /*:polygon:28992*/" for tri in
-                                   triangles_dict.values()]
-                    feedback.pushInfo("\nUNION\n".join(tri_queries))
-                if missing_area > (pixel_size**2):
-                    warnings.append(channel.id),
-                    missing_pixels = int(missing_area / (pixel_size**2))
-                    total_missing_pixels += missing_pixels
-                    warning_msg = (f"Up to {missing_pixels} pixel(s) may be missing from the raster for "
-                                   f"channel {channel.id[0]}")
-                    if channel.id[1] > 0:
-                        warning_msg += f", part {channel.id[1] + 1}"
-                    feedback.pushWarning(f"Warning: {warning_msg}!")
-
-            mesh_layer.commitFrameEditing(transform, continueEditing=False)
-            context.temporaryLayerStore().addMapLayer(
-                mesh_layer
-            )  # otherwise it cannot be used in processing alg
-
-            extent = align_qgs_rectangle(
-                mesh_layer.extent(), xres=pixel_size, yres=pixel_size
-            )
-            rasterize_mesh_params = {
-                "INPUT": mesh_layer.id(),
-                "DATASET_GROUPS": [0],
-                "DATASET_TIME": {"type": "static"},
-                "EXTENT": extent,
-                "PIXEL_SIZE": pixel_size,
-                "CRS_OUTPUT": crs,
-                "OUTPUT": "TEMPORARY_OUTPUT",
-            }
-
-            # Do not pass feedback to child algorithm to keep the logging clean
-            rasterized = processing.run(
-                "native:meshrasterize", rasterize_mesh_params, context=context
-            )["OUTPUT"]
-
-            crs_auth_id = crs.authid()
-            uri = f"polygon?crs={crs_auth_id}"
-            clip_extent_layer = QgsVectorLayer(uri, "Clip extent", "memory")
-            clip_feature = QgsFeature(QgsFields())
-            outline_geometry = QgsGeometry.fromWkt(channel.outline.wkt)
-            clip_feature.setGeometry(outline_geometry)
-            clip_extent_layer.dataProvider().addFeatures([clip_feature])
-
-            clip_parameters = {
-                "INPUT": rasterized,
-                "MASK": clip_extent_layer,
-                "SOURCE_CRS": None,
-                "TARGET_CRS": None,
-                "NODATA": -9999,
-                "ALPHA_BAND": False,
-                "CROP_TO_CUTLINE": False,
-                "KEEP_RESOLUTION": True,
-                "SET_RESOLUTION": False,
-                "X_RESOLUTION": None,
-                "Y_RESOLUTION": None,
-                "MULTITHREADING": False,
-                "OPTIONS": "COMPRESS=DEFLATE|PREDICTOR=2|ZLEVEL=9",
-                "DATA_TYPE": 6,  # Float32
-                "EXTRA": "-tap",
-                "OUTPUT": "TEMPORARY_OUTPUT",
-            }
-
-            # use QgsProcessingAlgorithm.run() instead of processing.run() to be able to hide feedback but still be
-            # able to check if algorithm ran succesfully (ok == True)
-            reg = QgsApplication.processingRegistry()
-            alg_cliprasterbymasklayer = reg.algorithmById(
-                "gdal:cliprasterbymasklayer"
-            )
-            results, ok = alg_cliprasterbymasklayer.run(
-                clip_parameters, context=context, feedback=QgsProcessingFeedback()
-            )
-            if not ok:
+                    for triangle_nr, triangle in enumerate(channel.triangles):
+                        triangle_feature = QgsFeature()
+                        triangle_feature.setFields(triangles_fields)
+                        triangle_feature.setAttribute(0, i)
+                        triangle_feature.setAttribute(1, triangle_nr)
+                        triangle_geometry = QgsGeometry()
+                        triangle_geometry.fromWkb(triangle.geometry.wkb)
+                        triangle_feature.setGeometry(triangle_geometry)
+                        triangles_sink.addFeature(triangle_feature, QgsFeatureSink.FastInsert)
+                    outline_feature = QgsFeature()
+                    outline_feature.setFields(outline_fields)
+                    outline_feature.setAttribute(0, i)
+                    outline_geometry = QgsGeometry()
+                    outline_geometry.fromWkb(channel.outline.wkb)
+                    outline_feature.setGeometry(outline_geometry)
+                    outline_sink.addFeature(outline_feature, QgsFeatureSink.FastInsert)
+
+                if not future.result():
+                    feedback.pushWarning(f"Warning: Rasterizing channel {channel.id} resulted in an empty raster")
+                    continue
+                if cache:
+                    cache.add(channel.id[0], output_filename(channel))
+                rasters.append(output_filename(channel))
+
+            except IntersectingSidesError as e:
+                errors.append(channel.id)
                 feedback.reportError(
-                    f"Error when clipping channel raster by outline for channel {channel.id}",
-                    fatalError=False,
+                    f"Error: could not rasterize channel {channel.id} (IntersectingSidesError)",
+                    fatalError=False
+                )
+                feedback.reportError(
+                    str(e)
+                )
+            except Exception as e:
+                errors.append(channel.id)
+                feedback.reportError(
+                    f"ERROR: Channel with id {channel.id} could not be rasterized. Error details: {repr(e)}"
                 )
-                continue
-            rasters.append(results["OUTPUT"])
-
-        except IntersectingSidesError as e:
-            errors.append(channel.id)
-            feedback.reportError(
-                f"Error: could not rasterize channel {channel.id} (IntersectingSidesError)",
-                fatalError=False
-            )
-            feedback.reportError(
-                str(e)
-            )
-        except Exception as e:
-            errors.append(channel.id)
-            feedback.reportError(
-                f"ERROR: Channel with id {channel.id} could not be rasterized. Error details: {repr(e)}"
-            )
 
-        feedback.setProgress(100 * i / len(channels))
-    return rasters, total_missing_pixels
+            feedback.setProgress(100 * i / len(channels))
+    finally:
+        # on cancel or error, do not start rasterizing the channels that are still waiting
+        results.close()
+    return rasters
 
 
 class RasterizeChannelsAlgorithm(QgsProcessingAlgorithm):
@@ -363,6 +277,8 @@ class RasterizeChannelsAlgorithm(QgsProcessingAlgorithm):
     INPUT_CROSS_SECTION_LOCATIONS = "INPUT_CROSS_SECTION_LOCATIONS"
     INPUT_DEM = "INPUT_DEM"
     INPUT_PIXEL_SIZE = "PIXEL_SIZE"
+    INPUT_WORKERS = "WORKERS"
+    INPUT_CACHE_DIR = "CACHE_DIR"
 
     OUTPUT = "OUTPUT"
 
@@ -402,6 +318,25 @@ class RasterizeChannelsAlgorithm(QgsProcessingAlgorithm):
         pixel_size_param.setMetadata({"widget_wrapper": {"decimals": 2}})
         self.addParameter(pixel_size_param)
 
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INPUT_WORKERS,
+                self.tr("Number of parallel workers"),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=os.cpu_count() or 1,
+                minValue=1,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.INPUT_CACHE_DIR,
+                self.tr("Cache directory"),
+                behavior=QgsProcessingParameterFile.Folder,
+                optional=True,
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterRasterDestination(
                 self.OUTPUT,
@@ -518,6 +453,8 @@ class RasterizeChannelsAlgorithm(QgsProcessingAlgorithm):
         user_pixel_size = self.parameterAsDouble(
             parameters, self.INPUT_PIXEL_SIZE, context
         )
+        max_workers = self.parameterAsInt(parameters, self.INPUT_WORKERS, context)
+        cache_dir = self.parameterAsFile(parameters, self.INPUT_CACHE_DIR, context)
         if dem:
             if np.abs(dem.rasterUnitsPerPixelX() - dem.rasterUnitsPerPixelY()) > 0.0001:  # 1/10 mm tolerance
                 feedback.reportError(
@@ -539,11 +476,37 @@ class RasterizeChannelsAlgorithm(QgsProcessingAlgorithm):
 
         feedback.pushInfo("Step 1/4: Read channel and cross-section data")
 
+        cache = None
+        if cache_dir:
+            # Only channels that have changed since the previous run are rasterized again. Their neighbours are read
+            # as well, because they are needed to fill the wedges at the junctions
+            cache = ChannelRasterCache(cache_dir)
+            fingerprints, neighbours = channel_fingerprints(
+                channel_features=channel_features.getFeatures(),
+                cross_section_location_features_per_channel=cross_section_location_features_per_channel(
+                    cross_section_location_features
+                ),
+                pixel_size=pixel_size,
+            )
+            changed_channel_ids = cache.changed_channel_ids(fingerprints)
+            channel_ids_to_read = set(changed_channel_ids)
+            for channel_id in changed_channel_ids:
+                channel_ids_to_read |= neighbours.get(channel_id, set())
+            feedback.pushInfo(
+                f"Using cached rasters for {len(fingerprints) - len(changed_channel_ids)} unchanged channels; "
+                f"rasterizing {len(changed_channel_ids)} new or changed channels"
+            )
+        else:
+            channel_ids_to_read = None
+            changed_channel_ids = None
+
         channels, errors = read_channels(
             channel_features=channel_features,
             cross_section_location_features=cross_section_location_features,
             pixel_size=pixel_size,
-            feedback=feedback
+            feedback=feedback,
+            channel_ids=channel_ids_to_read,
+            max_workers=max_workers,
         )
         if feedback.isCanceled():
             return {}
@@ -552,22 +515,27 @@ class RasterizeChannelsAlgorithm(QgsProcessingAlgorithm):
         if feedback.isCanceled():
             return {}
 
-        if len(channels) == 0:
+        if changed_channel_ids is not None:
+            channels = [channel for channel in channels if channel.id[0] in changed_channel_ids]
+        elif len(channels) == 0:
             feedback.reportError(
                 "No valid channels to process", fatalError=True
             )
             raise QgsProcessingException()
 
         feedback.pushInfo("Step 2/4: Rasterize channels")
-        warnings = []
-        rasters, total_missing_pixels = rasterize(
+        # the channels are rasterized to temporary files, so that they do not have to be kept in memory until merged
+        temp_dir = TemporaryDirectory()
+        temp_dir_path = Path(temp_dir.name)
+        rasters = rasterize(
             channels=channels,
             pixel_size=pixel_size,
             crs=channel_features.sourceCrs(),
             errors=errors,
-            warnings=warnings,
             feedback=feedback,
-            context=context,
+            output_dir=temp_dir_path,
+            max_workers=max_workers,
+            cache=cache,
             points_sink=points_sink if DEBUG_MODE else None,
             points_fields=points_fields if DEBUG_MODE else None,
             triangles_sink=triangles_sink if DEBUG_MODE else None,
@@ -575,26 +543,50 @@ class RasterizeChannelsAlgorithm(QgsProcessingAlgorithm):
             outline_sink=outline_sink if DEBUG_MODE else None,
             outline_fields=outline_fields if DEBUG_MODE else None,
         )
+        if feedback.isCanceled():
+            return {}
+        if cache:
+            for error in errors:
+                # errors contains channel ids (read_channels) or (channel id, part) tuples (rasterize)
+                cache.discard(error[0] if isinstance(error, tuple) else error)
+            cache.save(fingerprints)
+            srs = channel_features.sourceCrs().toWkt()
+            for channel_id in set(fingerprints) - changed_channel_ids:
+                for part, (data, geotransform) in enumerate(cache.rasters(channel_id)):
+                    filename = str(temp_dir_path / f"cached_channel_{channel_id}_{part}.tif")
+                    write_raster(
+                        output_filename=filename,
+                        geotransform=geotransform,
+                        srs=srs,
+                        data=data,
+                        nodatavalue=NODATA_VALUE,
+                        dataset_creation_options=TEMPORARY_RASTER_OPTIONS,
+                    )
+                    rasters.append(filename)
         feedback.setProgressText("Step 3/4: Merge rasters...")
         if len(rasters) == 0:
             feedback.reportError(
                 "No valid channels to process", fatalError=True
             )
             raise QgsProcessingException()
-        rasters_datasets = [gdal.Open(raster) for raster in rasters]
         if dem:
             uri = dem.dataProvider().dataSourceUri()
             dem_gdal_datasource = gdal.Open(uri)
-            rasters_datasets.append(dem_gdal_datasource)
+            rasters.append(dem_gdal_datasource)
         merge_rasters(
-            rasters_datasets,
-            tile_size=1000,
+            rasters,
+            tile_size=1024,
             aggregation_method="min",
             output_filename=output_raster,
-            output_nodatavalue=-9999,
+            output_nodatavalue=NODATA_VALUE,
             output_pixel_size=pixel_size,
             feedback=feedback,
+            max_workers=max_workers,
         )
+        temp_dir.cleanup()
+        if feedback.isCanceled():
+            # the output raster has not been completely written
+            return {}
 
         if errors:
             feedback.pushWarning(
@@ -602,13 +594,6 @@ class RasterizeChannelsAlgorithm(QgsProcessingAlgorithm):
                 f"See previous log messages for more information."
             )
 
-        if warnings:
-            feedback.pushWarning(
-                f"Warning: The following channels may have missing pixels: {', '.join([str(i) for i in warnings])}. "
-                f"In total, up to {total_missing_pixels} pixels may be missing. See previous log messages for more "
-                f"information."
-            )
-
         return {self.OUTPUT: output_raster}
 
     def name(self):
@@ -666,6 +651,10 @@ class RasterizeChannelsAlgorithm(QgsProcessingAlgorithm):
             <p>If not used, <em>Pixel size&nbsp;</em>has to be filled in.</p>
             <h4>Pixel size</h4>
             <p>Optional input. If&nbsp;<em>Digital elevation model</em> is not specified, specify the pixel size of the output raster.</p>
+            <h4>Number of parallel workers</h4>
+            <p>Number of channels (or output tiles, when merging) that are processed at the same time. The result does not depend on this setting. Defaults to the number of processors.</p>
+            <h4>Cache directory</h4>
+            <p>Optional input. Directory in which the rasterized channels are stored. When the algorithm is run again with the same cache directory, only channels of which the geometry, the cross-section locations, or the channels they connect to have changed are rasterized again; the stored rasters are used for all other channels. Use a separate cache directory for each model.</p>
             <h4>Rasterized channels</h4>
             <p>Output file location. A temporary output can also be chosen - note that in that case, the file will be deleted when closing the project.</p>
             """
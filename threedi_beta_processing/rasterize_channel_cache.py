@@ -0,0 +1,154 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+import numpy as np
+from osgeo import gdal
+
+# Increase when a change to the rasterization makes previously cached rasters invalid
+CACHE_VERSION = 1
+
+CROSS_SECTION_LOCATION_ATTRIBUTES = [
+    "id", "cross_section_shape", "cross_section_table", "reference_level", "bank_level"
+]
+
+
+def _feature_fingerprint(feature, attributes: Iterable[str]) -> str:
+    """md5 of the geometry and given attributes of a QgsFeature"""
+    md5 = hashlib.md5(bytes(feature.geometry().asWkb()))
+    for attribute in attributes:
+        md5.update(repr(feature.attribute(attribute)).encode())
+    return md5.hexdigest()
+
+
+def channel_fingerprints(
+        channel_features: Iterable,
+        cross_section_location_features_per_channel: Dict[int, List],
+        pixel_size: float,
+) -> Tuple[Dict[int, str], Dict[int, Set[int]]]:
+    """
+    Returns a fingerprint {channel id: fingerprint} for each channel feature, and the ids of the channels that share a
+    connection node with each channel {channel id: {neighbour channel ids}}
+
+    The fingerprint covers everything the channel's raster depends on: the channel's geometry and connection nodes, its
+    cross-section locations, the pixel size, and the same data of the channels it shares a connection node with (wedge
+    fills at junctions use the neighbouring channels)
+    """
+    own_fingerprints = dict()
+    channel_ids_per_connection_node = dict()
+    for channel_feature in channel_features:
+        channel_id = channel_feature.attribute("id")
+        md5 = hashlib.md5(
+            _feature_fingerprint(
+                channel_feature, ["id", "connection_node_id_start", "connection_node_id_end"]
+            ).encode()
+        )
+        cross_section_location_features = sorted(
+            cross_section_location_features_per_channel.get(channel_id, []),
+            key=lambda feature: feature.attribute("id")
+        )
+        for cross_section_location_feature in cross_section_location_features:
+            md5.update(
+                _feature_fingerprint(cross_section_location_feature, CROSS_SECTION_LOCATION_ATTRIBUTES).encode()
+            )
+        own_fingerprints[channel_id] = md5.hexdigest()
+        for connection_node_id in {
+            channel_feature.attribute("connection_node_id_start"),
+            channel_feature.attribute("connection_node_id_end"),
+        }:
+            channel_ids_per_connection_node.setdefault(connection_node_id, set()).add(channel_id)
+
+    neighbours = neighbouring_channel_ids(channel_ids_per_connection_node)
+    result = dict()
+    for channel_id, own_fingerprint in own_fingerprints.items():
+        md5 = hashlib.md5(f"{CACHE_VERSION} {pixel_size!r} {own_fingerprint}".encode())
+        for neighbour_id in sorted(neighbours.get(channel_id, set()), key=repr):
+            md5.update(own_fingerprints[neighbour_id].encode())
+        result[channel_id] = md5.hexdigest()
+    return result, neighbours
+
+
+def neighbouring_channel_ids(channel_ids_per_connection_node: Dict[int, Set[int]]) -> Dict[int, Set[int]]:
+    """Returns {channel id: ids of the other channels that share a connection node with it}"""
+    result = dict()
+    for channel_ids in channel_ids_per_connection_node.values():
+        for channel_id in channel_ids:
+            result.setdefault(channel_id, set()).update(channel_ids - {channel_id})
+    return result
+
+
+class ChannelRasterCache:
+    """
+    On-disk cache of the rasterized channels, one file per channel, so that only channels that have been changed
+    since the previous run have to be rasterized again
+
+    Each file contains the channel's fingerprint (see ``channel_fingerprints()``) and the array and geotransform of
+    each of the parts the channel was split into
+    """
+
+    def __init__(self, cache_dir: Union[str, Path]):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._new_rasters: Dict[int, List[Union[str, Path]]] = dict()
+
+    def _path(self, channel_id: int) -> Path:
+        return self.cache_dir / f"channel_{channel_id}.npz"
+
+    def fingerprint(self, channel_id: int) -> Union[str, None]:
+        """Returns the fingerprint of the cached rasters of the channel, or None if it is not in the cache"""
+        path = self._path(channel_id)
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            return str(data["fingerprint"])
+
+    def changed_channel_ids(self, fingerprints: Dict[int, str]) -> Set[int]:
+        """Returns the ids of the channels that are not in the cache, or have a different fingerprint"""
+        return {
+            channel_id for channel_id, fingerprint in fingerprints.items()
+            if self.fingerprint(channel_id) != fingerprint
+        }
+
+    def rasters(self, channel_id: int) -> List[Tuple[np.ndarray, Tuple]]:
+        """Returns the cached (array, geotransform) of each part of the channel"""
+        with np.load(self._path(channel_id)) as data:
+            return [
+                (data[f"data_{i}"], tuple(data[f"geotransform_{i}"]))
+                for i in range(int(data["part_count"]))
+            ]
+
+    def add(self, channel_id: int, filename: Union[str, Path]):
+        """
+        Add the raster file of one part of the channel. Call ``save()`` to store it in the cache, the file must still
+        exist at that time
+        """
+        self._new_rasters.setdefault(channel_id, []).append(filename)
+
+    def discard(self, channel_id: int):
+        """Do not save the rasters added for this channel, e.g. because not all of its parts could be rasterized"""
+        self._new_rasters.pop(channel_id, None)
+
+    def save(self, fingerprints: Dict[int, str]):
+        """
+        Write the rasters added since the previous ``save()`` to the cache, with the channels' current fingerprint
+
+        The rasters are read one channel at a time
+        """
+        for channel_id, filenames in self._new_rasters.items():
+            path = self._path(channel_id)
+            tmp_path = path.with_name(path.stem + "_tmp.npz")
+            arrays = dict()
+            for i, filename in enumerate(filenames):
+                raster = gdal.Open(str(filename))
+                arrays[f"data_{i}"] = raster.ReadAsArray()
+                arrays[f"geotransform_{i}"] = np.array(raster.GetGeoTransform(), dtype=float)
+                raster = None
+            np.savez_compressed(
+                tmp_path,
+                fingerprint=np.array(fingerprints[channel_id]),
+                part_count=np.array(len(filenames)),
+                **arrays
+            )
+            os.replace(tmp_path, path)
+        self._new_rasters = dict()
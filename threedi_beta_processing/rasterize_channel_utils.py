@@ -1,12 +1,49 @@
 # TODO ignore rasters that are 100% nodata
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Union, List, Tuple
+from threading import Lock
+from typing import Any, Callable, Iterable, Iterator, Union, List, Tuple
 
 from osgeo import gdal, osr
 import numpy as np
+from shapely import STRtree, intersects_xy, prepare
 from shapely.geometry import MultiPolygon, Polygon, box
 
+# creation options of the intermediate rasters, e.g. of single channels, that are written to a temporary directory
+TEMPORARY_RASTER_OPTIONS = ["COMPRESS=DEFLATE", "PREDICTOR=3"]
+
+
+def map_ordered(
+    function: Callable,
+    items: Iterable,
+    max_workers: int = 1,
+    max_pending: int = None,
+) -> Iterator[Tuple[Any, Future]]:
+    """
+    Run ``function(item)`` for each item in a pool of ``max_workers`` threads. Yields (item, future) in the order of
+    ``items``
+
+    At most ``max_pending`` (default: twice ``max_workers``) items are submitted ahead of the item that is yielded, so
+    that finished results do not pile up in memory while the caller handles the results one by one. When the generator
+    is closed, e.g. because the caller stops iterating, the items that have not started yet are cancelled.
+    """
+    if max_pending is None:
+        max_pending = 2 * max_workers
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, executor.submit(function, item)))
+            if len(pending) > max_pending:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
 
 def read_as_array(
     raster: gdal.Dataset,
@@ -67,6 +104,142 @@ def read_as_array(
         return arr
 
 
+def rasterize_triangles(
+    vertices: np.ndarray,
+    triangles: np.ndarray,
+    pixel_size: float,
+    nodatavalue: float = -9999,
+    mask: Union[Polygon, MultiPolygon] = None,
+    chunk_size: int = 2 ** 20,
+) -> Tuple[np.ndarray, Tuple]:
+    """
+    Rasterize a triangulated surface by linear (barycentric) interpolation of the vertex z values at the pixel centres
+
+    The extent of the output is the extent of the vertices, aligned to multiples of ``pixel_size``. Pixels whose
+    centre is not in any triangle, or not in ``mask`` (if given), get ``nodatavalue``.
+
+    :param vertices: (n, 3) array of vertex x, y, z coordinates
+    :param triangles: (m, 3) array of the indices (in ``vertices``) of the corners of each triangle
+    :param pixel_size: pixel size of the output raster
+    :param nodatavalue: value of pixels that are not covered by a triangle
+    :param mask: only pixels whose centre intersects this geometry get a value
+    :param chunk_size: approximate number of candidate pixels that are evaluated at once, to limit memory use
+    :returns: (float32 array, geotransform)
+    """
+    first_col = int(np.floor(np.min(vertices[:, 0]) / pixel_size))
+    last_col = int(np.ceil(np.max(vertices[:, 0]) / pixel_size))
+    first_row = int(np.floor(np.min(vertices[:, 1]) / pixel_size))
+    last_row = int(np.ceil(np.max(vertices[:, 1]) / pixel_size))
+    minx = first_col * pixel_size
+    maxy = last_row * pixel_size
+    width = max(last_col - first_col, 1)
+    height = max(last_row - first_row, 1)
+    result = np.full((height, width), np.nan, dtype=np.float32)
+
+    # pixel coordinates (column, row) of the triangle corners, relative to the upper left corner of the output
+    columns = (vertices[:, 0] - minx) / pixel_size
+    rows = (maxy - vertices[:, 1]) / pixel_size
+    c, r = columns[triangles], rows[triangles]
+    z = vertices[triangles, 2]
+    denominator = (r[:, 1] - r[:, 2]) * (c[:, 0] - c[:, 2]) + (c[:, 2] - c[:, 1]) * (r[:, 0] - r[:, 2])
+    degenerate = denominator == 0
+    denominator[degenerate] = 1
+
+    # barycentric weights of the first two corners of each triangle, as a linear function of the pixel coordinates:
+    # weight = column_factor * column + row_factor * row + constant
+    weight_0_column = (r[:, 1] - r[:, 2]) / denominator
+    weight_0_row = (c[:, 2] - c[:, 1]) / denominator
+    weight_0_constant = -weight_0_column * c[:, 2] - weight_0_row * r[:, 2]
+    weight_1_column = (r[:, 2] - r[:, 0]) / denominator
+    weight_1_row = (c[:, 0] - c[:, 2]) / denominator
+    weight_1_constant = -weight_1_column * c[:, 2] - weight_1_row * r[:, 2]
+
+    # pixel centres that may be within each triangle. Degenerate triangles are skipped
+    col_min = np.maximum(np.floor(np.min(c, axis=1) - 0.5).astype(int), 0)
+    col_max = np.minimum(np.ceil(np.max(c, axis=1) - 0.5).astype(int), width - 1)
+    row_min = np.maximum(np.floor(np.min(r, axis=1) - 0.5).astype(int), 0)
+    row_max = np.minimum(np.ceil(np.max(r, axis=1) - 0.5).astype(int), height - 1)
+    col_count = np.maximum(col_max - col_min + 1, 0)
+    pixel_counts = np.where(degenerate, 0, col_count * np.maximum(row_max - row_min + 1, 0))
+
+    # evaluate the candidate pixels of consecutive triangles in chunks of about chunk_size pixels
+    cumulative_counts = np.cumsum(pixel_counts)
+    start = 0
+    while start < len(triangles):
+        end = np.searchsorted(cumulative_counts, cumulative_counts[start] - pixel_counts[start] + chunk_size, "right")
+        chunk = np.arange(start, max(end, start + 1))
+        start = chunk[-1] + 1
+        counts = pixel_counts[chunk]
+        triangle = np.repeat(chunk, counts)
+        if len(triangle) == 0:
+            continue
+        # index of each pixel within the bounding box of its triangle
+        k = np.arange(len(triangle)) - np.repeat(np.cumsum(counts) - counts, counts)
+        pixel_col = col_min[triangle] + k % col_count[triangle]
+        pixel_row = row_min[triangle] + k // col_count[triangle]
+        pixel_c = pixel_col + 0.5
+        pixel_r = pixel_row + 0.5
+        weight_0 = weight_0_column[triangle] * pixel_c + weight_0_row[triangle] * pixel_r + weight_0_constant[triangle]
+        weight_1 = weight_1_column[triangle] * pixel_c + weight_1_row[triangle] * pixel_r + weight_1_constant[triangle]
+        weight_2 = 1 - weight_0 - weight_1
+        inside = (weight_0 >= -1e-9) & (weight_1 >= -1e-9) & (weight_2 >= -1e-9)
+        triangle = triangle[inside]
+        weight_0, weight_1, weight_2 = weight_0[inside], weight_1[inside], weight_2[inside]
+        values = weight_0 * z[triangle, 0] + weight_1 * z[triangle, 1] + weight_2 * z[triangle, 2]
+        # where triangles overlap, the last triangle determines the pixel value
+        flat_index = (pixel_row * width + pixel_col)[inside]
+        _, last = np.unique(flat_index[::-1], return_index=True)
+        last = len(flat_index) - 1 - last
+        result.flat[flat_index[last]] = values[last]
+
+    if mask is not None:
+        prepare(mask)
+        data_rows, data_cols = np.nonzero(~np.isnan(result))
+        in_mask = intersects_xy(
+            mask,
+            minx + (data_cols + 0.5) * pixel_size,
+            maxy - (data_rows + 0.5) * pixel_size,
+        )
+        result[data_rows[~in_mask], data_cols[~in_mask]] = np.nan
+
+    result[np.isnan(result)] = nodatavalue
+    geotransform = (minx, pixel_size, 0.0, maxy, 0.0, -1 * pixel_size)
+    return result, geotransform
+
+
+def rasterize_channel(
+    channel,
+    pixel_size: float,
+    output_filename: Union[str, Path],
+    srs: str = "",
+    nodatavalue: float = -9999,
+) -> bool:
+    """
+    Rasterize a channel's triangles, masked by the channel's outline, to a compressed GeoTIFF. Returns False, without
+    writing the file, if none of the pixels has a value.
+
+    Does not use any QGIS objects, so it can safely run in a worker thread
+    """
+    data, geotransform = rasterize_triangles(
+        vertices=channel.vertex_coordinates,
+        triangles=channel.triangle_vertex_indices,
+        pixel_size=pixel_size,
+        nodatavalue=nodatavalue,
+        mask=channel.outline,
+    )
+    if np.all(data == nodatavalue):
+        return False
+    write_raster(
+        output_filename=output_filename,
+        geotransform=geotransform,
+        srs=srs,
+        data=data,
+        nodatavalue=nodatavalue,
+        dataset_creation_options=TEMPORARY_RASTER_OPTIONS,
+    )
+    return True
+
+
 def write_raster(
     output_filename: Path,
     geotransform: Tuple,
@@ -78,7 +251,7 @@ def write_raster(
     dataset_creation_options=None,
 ):
     """
-    write a numpy array to a gdal raster
+    write a numpy array to a gdal raster and return the raster dataset
 
     if dataset_creation_options is not specified, the following will be used:
     ["COMPRESS=DEFLATE", "PREDICTOR=2", "ZLEVEL=9"]
@@ -99,7 +272,7 @@ def write_raster(
     dst_ds.SetGeoTransform(geotransform)
     dst_ds.SetProjection(srs)
     dst_ds.GetRasterBand(1).SetNoDataValue(nodatavalue)
-    return
+    return dst_ds
 
 
 def build_vrt(output_filepath, raster_filepaths, **vrt_options):
@@ -109,6 +282,11 @@ def build_vrt(output_filepath, raster_filepaths, **vrt_options):
     vrt_ds = None
 
 
+def open_raster(raster: Union[gdal.Dataset, str, Path]) -> gdal.Dataset:
+    """Return the raster dataset, opening it if ``raster`` is a filename"""
+    return gdal.Open(str(raster)) if isinstance(raster, (str, Path)) else raster
+
+
 def bounding_box(raster: gdal.Dataset) -> Polygon:
     ulx, xres, xskew, uly, yskew, yres = raster.GetGeoTransform()
     lrx = ulx + (raster.RasterXSize * xres)
@@ -117,122 +295,160 @@ def bounding_box(raster: gdal.Dataset) -> Polygon:
 
 
 def tile_aggregate(
-    rasters: List[gdal.Dataset],
+    rasters: List[Union[gdal.Dataset, str, Path]],
     bbox: Tuple[float, float, float, float],
     aggregation_method: str,
     output_nodatavalue: float,
+    locks: List[Lock] = None,
 ) -> np.array:
+    """
+    Aggregate the values of ``rasters`` within ``bbox``, pixel by pixel. Nodata is ignored.
+
+    The rasters are read one by one into a running aggregate, so only one of them is in memory at a time. Rasters that
+    are given as a filename are opened for this call only.
+
+    :param locks: one lock (or None) per raster, held while reading from it. Needed if the same raster datasets are read
+    from several threads
+    """
     assert len(rasters) > 0
-    methods = {"min": np.nanmin, "max": np.nanmax}
+    methods = {"min": np.fmin, "max": np.fmax}
     method = methods[aggregation_method]
-    arrays = []
-    for raster in rasters:
-        raster_array = read_as_array(raster=raster, bbox=bbox, pad=True)
-        ndv = raster.GetRasterBand(1).GetNoDataValue()
+    result = None
+    for i, raster in enumerate(rasters):
+        dataset = open_raster(raster)
+        with (locks[i] if locks and locks[i] else nullcontext()):
+            raster_array = read_as_array(raster=dataset, bbox=bbox, pad=True)
+        ndv = dataset.GetRasterBand(1).GetNoDataValue()
+        raster_array = raster_array.astype(float)
         raster_array[raster_array == ndv] = np.nan
-        arrays.append(raster_array)
-    result = method(np.array(arrays), axis=0)
+        if result is None:
+            result = raster_array
+        else:
+            method(result, raster_array, out=result)
     result[np.isnan(result)] = output_nodatavalue
     return result
 
 
-def progress_gdal_to_qgis(complete, message, qgs_feedback):
-    qgs_feedback.setProgress(complete*100)
-
 def merge_rasters(
-    rasters: List[gdal.Dataset],
+    rasters: List[Union[gdal.Dataset, str, Path]],
     tile_size: int,
     aggregation_method: str,
     output_filename: Path,
     output_pixel_size: float,
     output_nodatavalue: float,
     feedback=None,
+    max_workers: int = 1,
 ):
     """Assumes that all input rasters have the same SRS, resolution, skew, and pixels are
     aligned (as in gdal.Warp's targetAlignedPixels)
 
-    tile_size in pixels
+    tile_size in pixels. Should be a multiple of the block size (256) of the output raster, so that no compressed
+    block is written by more than one tile
+
+    Rasters can be given as datasets or as filenames. Rasters that are given as a filename are only opened while they
+    are read, so that many (e.g. single channel) rasters do not all have to be kept open or in memory.
+
+    The output extent is divided in tiles. For each tile, the intersecting input rasters are looked up in a spatial
+    index and aggregated, and the result is written directly into the (tiled) output raster. Tiles are processed by
+    ``max_workers`` worker threads.
     """
     temp_dir = TemporaryDirectory()
     temp_dir_path = Path(temp_dir.name)
 
     # resample rasters if their pixel size is different from output_pixel_size (tiny difference is allowed)
     resampled_rasters = []
+    bboxes = []
     for i, raster in enumerate(rasters):
+        dataset = open_raster(raster)
         # GeoTransform: (ulx, xres, xskew, uly, yskew, yres)
-        _, xres, _, _, _, yres = raster.GetGeoTransform()
+        _, xres, _, _, _, yres = dataset.GetGeoTransform()
         if abs(abs(xres) - abs(output_pixel_size)) > 1/(1000*tile_size) or \
                 abs(abs(yres) - abs(output_pixel_size)) > 1/(1000*tile_size):
             print("Resampling...")
             resampled_raster_file_name = str(temp_dir_path / f"resampled_raster_{i}.tif")
             options = gdal.WarpOptions(xRes=output_pixel_size, yRes=output_pixel_size, resampleAlg="near")
-            resampled_raster = gdal.Warp(resampled_raster_file_name, raster, options=options)
-            resampled_rasters.append(resampled_raster)
+            dataset = gdal.Warp(resampled_raster_file_name, dataset, options=options)
+            resampled_rasters.append(dataset)
         else:
             resampled_rasters.append(raster)
-    bboxes = [bounding_box(raster) for raster in resampled_rasters]
+        bboxes.append(bounding_box(dataset))
+        if i == 0:
+            # GeoTransform: (ulx, xres, xskew, uly, yskew, yres/)
+            _, _, xskew, _, yskew, _ = dataset.GetGeoTransform()
+            srs = dataset.GetProjection()
+    bbox_index = STRtree(bboxes)
     minx, miny, maxx, maxy = MultiPolygon(bboxes).bounds
-    ncols = int(np.ceil(((maxx - minx) / abs(output_pixel_size)) / tile_size))
-    nrows = int(np.ceil(((maxy - miny) / abs(output_pixel_size)) / tile_size))
+    pixel_size = abs(output_pixel_size)
+    width = int(round((maxx - minx) / pixel_size))
+    height = int(round((maxy - miny) / pixel_size))
+    ncols = int(np.ceil(width / tile_size))
+    nrows = int(np.ceil(height / tile_size))
     ntiles = ncols * nrows
-    geo_tile_size_x = tile_size * abs(output_pixel_size)
-    geo_tile_size_y = tile_size * abs(output_pixel_size)
-
-    # GeoTransform: (ulx, xres, xskew, uly, yskew, yres/)
-    _, _, xskew, _, yskew, _ = resampled_rasters[0].GetGeoTransform()
-    srs = resampled_rasters[0].GetProjection()
-    tiles = []
-    rows = []
-    for tile_row in range(nrows):
-        # print(f"tile_row: {tile_row}")
-        tile_maxy = maxy - tile_row * geo_tile_size_y
-        for tile_col in range(ncols):
-            # print(f"    tile_col: {tile_col}")
-            tile_minx = minx + tile_col * geo_tile_size_x
-            tile_polygon = box(
-                tile_minx,
-                tile_maxy - geo_tile_size_y,
-                tile_minx + geo_tile_size_x,
-                tile_maxy,
-            )
-            # print(f"    tile_polygon.bounds: {tile_polygon.bounds}")
-            intersecting_rasters = [
-                raster
-                for i, raster in enumerate(resampled_rasters)
-                if tile_polygon.intersects(bboxes[i])
-            ]
-            if len(intersecting_rasters) == 0:
-                continue
-            else:
-                tile = tile_aggregate(
-                    rasters=intersecting_rasters,
-                    bbox=tile_polygon.bounds,
-                    aggregation_method=aggregation_method,
-                    output_nodatavalue=output_nodatavalue,
-                )
-            tile_path = temp_dir_path / f"tile_row_{tile_row}_col_{tile_col}.tif"
-            geotransform = (tile_minx, output_pixel_size, xskew, tile_maxy, yskew, -1 * output_pixel_size)
-            write_raster(
-                output_filename=tile_path,
-                geotransform=geotransform,
-                srs=srs,
-                data=tile,
-            )
-            tiles.append(str(tile_path))
+
+    driver = gdal.GetDriverByName("GTiff")
+    output = driver.Create(
+        str(output_filename),
+        xsize=width,
+        ysize=height,
+        bands=1,
+        eType=gdal.GDT_Float32,
+        options=[
+            "COMPRESS=DEFLATE", "PREDICTOR=2", "ZLEVEL=9", "TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256",
+            "BIGTIFF=IF_SAFER", "NUM_THREADS=ALL_CPUS"
+        ],
+    )
+    output.SetGeoTransform((minx, pixel_size, xskew, maxy, yskew, -1 * pixel_size))
+    output.SetProjection(srs)
+    output_band = output.GetRasterBand(1)
+    output_band.SetNoDataValue(output_nodatavalue)  # tiles that are not written will be nodata
+
+    # GDAL datasets must not be used by several threads at the same time. Rasters given by filename are opened in the
+    # thread that reads them
+    raster_locks = [None if isinstance(raster, (str, Path)) else Lock() for raster in resampled_rasters]
+    output_lock = Lock()
+
+    def process_tile(tile_row: int, tile_col: int):
+        xoff = tile_col * tile_size
+        yoff = tile_row * tile_size
+        tile_width = min(tile_size, width - xoff)
+        tile_height = min(tile_size, height - yoff)
+        tile_polygon = box(
+            minx + xoff * pixel_size,
+            maxy - (yoff + tile_height) * pixel_size,
+            minx + (xoff + tile_width) * pixel_size,
+            maxy - yoff * pixel_size,
+        )
+        # sort the indices to make the order in which the rasters are aggregated deterministic
+        intersecting = sorted(
+            i for i in bbox_index.query(tile_polygon) if tile_polygon.intersects(bboxes[i])
+        )
+        if len(intersecting) == 0:
+            return
+        tile = tile_aggregate(
+            rasters=[resampled_rasters[i] for i in intersecting],
+            bbox=tile_polygon.bounds,
+            aggregation_method=aggregation_method,
+            output_nodatavalue=output_nodatavalue,
+            locks=[raster_locks[i] for i in intersecting],
+        )
+        with output_lock:
+            output_band.WriteArray(tile, xoff=xoff, yoff=yoff)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(process_tile, tile_row, tile_col)
+            for tile_row in range(nrows)
+            for tile_col in range(ncols)
+        ]
+        for i, future in enumerate(futures):
+            if feedback and feedback.isCanceled():
+                executor.shutdown(wait=True, cancel_futures=True)
+                break
+            future.result()
             if feedback:
-                feedback.setProgress((tile_row * ncols + tile_col + 1) / ntiles * 100)
+                feedback.setProgress((i + 1) / ntiles * 100)
     if feedback:
         feedback.setProgressText("Step 4/4: Writing output raster to disk...")
-    vrt_path = temp_dir_path / "result.vrt"
-    vrt_options = {}
-    build_vrt(output_filepath=str(vrt_path), raster_filepaths=tiles, **vrt_options)
-    vrt = gdal.Open(vrt_path)
-    callback = progress_gdal_to_qgis if feedback else None
-    callback_data = feedback if feedback else None
-    gdal.Translate(
-        destName=output_filename,
-        srcDS=vrt,
-        creationOptions=["COMPRESS=DEFLATE", "PREDICTOR=2", "ZLEVEL=9"],
-        callback=callback,
-        callback_data=callback_data
-    )
+    output_band.FlushCache()
+    output_band = None
+    output = None
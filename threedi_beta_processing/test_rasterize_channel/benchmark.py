@@ -0,0 +1,231 @@
+"""
+Benchmark of the channel rasterizer stages, without QGIS
+
+Generates a random network of channels with cross-section locations (using the cross-section fixtures from test.py)
+and reports the wall time and peak memory of each stage: make valid (parallel offsets and triangulation), triangulate,
+fill wedges, sort triangles, rasterize and merge rasters. The triangulate stage triangulates the parallel offsets of
+the valid channels once more, to time triangulate_between() separately from the rest of make valid. Make valid and
+rasterize use the same helpers as the Rasterize channels algorithm, running in --workers worker threads. Memory is
+traced with tracemalloc, which slows down all stages, so compare timings only between runs of this script.
+
+Example:
+    python test_rasterize_channel/benchmark.py --channels 200 --cross-section-locations 5 --output benchmark.json
+
+To check for regressions, compare with the output of an earlier run. The script exits with a non-zero status if any
+stage is more than --tolerance (fraction) slower than in the baseline:
+    python test_rasterize_channel/benchmark.py --channels 200 --cross-section-locations 5 --baseline benchmark.json
+"""
+import argparse
+import importlib.util
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, List
+
+import numpy as np
+from shapely.geometry import LineString
+
+# make the modules in threedi_beta_processing importable, regardless of the working directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from rasterize_channel import Channel, CrossSectionLocation, fill_wedges
+from rasterize_channel_utils import map_ordered, merge_rasters, rasterize_channel
+
+NODATA_VALUE = -9999
+
+
+def load_test_fixtures():
+    """Import test.py by its path, because the module name 'test' is taken by the standard library"""
+    spec = importlib.util.spec_from_file_location("test_rasterize_channel", Path(__file__).parent / "test.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def cross_section_templates() -> List[CrossSectionLocation]:
+    fixtures = load_test_fixtures()
+    return [fixtures.get_test_cross_section_location(nr) for nr in (0, 5)]
+
+
+def generate_channels(
+        channel_count: int,
+        cross_section_location_count: int,
+        seed: int = 0,
+        channel_length: float = 200.0,
+        vertex_spacing: float = 5.0,
+) -> List[Channel]:
+    """
+    Generate a random tree-shaped network of meandering channels, each with ``cross_section_location_count``
+    cross-section locations. Each channel starts at a random connection node of the existing network.
+    """
+    rng = np.random.default_rng(seed)
+    templates = cross_section_templates()
+    node_xy = {0: np.array([0.0, 0.0])}
+    channels = []
+    for channel_id in range(1, channel_count + 1):
+        start_node_id = int(rng.choice(list(node_xy.keys())))
+        end_node_id = len(node_xy)
+        vertex_count = int(channel_length / vertex_spacing) + 1
+        angles = rng.uniform(0, 2 * np.pi) + np.cumsum(rng.normal(0, 0.1, vertex_count - 1))
+        steps = np.stack([np.cos(angles), np.sin(angles)], axis=1) * vertex_spacing
+        coords = node_xy[start_node_id] + np.vstack([[0, 0], np.cumsum(steps, axis=0)])
+        node_xy[end_node_id] = coords[-1]
+        geometry = LineString(coords)
+        channel = Channel(
+            id=channel_id,
+            connection_node_id_start=start_node_id,
+            connection_node_id_end=end_node_id,
+            geometry=geometry,
+        )
+        for i in range(cross_section_location_count):
+            template = templates[int(rng.integers(len(templates)))]
+            channel.add_cross_section_location(
+                CrossSectionLocation(
+                    id=channel_id * cross_section_location_count + i,
+                    reference_level=float(rng.uniform(-2, 2)),
+                    bank_level=template.bank_level,
+                    y_ordinates=template.y_ordinates,
+                    z_ordinates=template.z_ordinates - template.reference_level,
+                    geometry=geometry.interpolate((i + 0.5) / cross_section_location_count, normalized=True),
+                )
+            )
+        channels.append(channel)
+    return channels
+
+
+class Benchmark:
+    def __init__(self):
+        self.results: Dict[str, Dict[str, float]] = dict()
+
+    @contextmanager
+    def stage(self, name: str):
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.results[name] = {
+                "wall_time": time.perf_counter() - start,
+                "peak_memory": tracemalloc.get_traced_memory()[1],
+            }
+
+    def summary(self) -> str:
+        return "\n".join(
+            f"{name}: {result['wall_time']:.3f} s, peak memory {result['peak_memory'] / 2 ** 20:.1f} MiB"
+            for name, result in self.results.items()
+        )
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> List[str]:
+    """Return a description of each stage whose wall time exceeds the baseline's by more than ``tolerance``"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        baseline_time = baseline[name]["wall_time"]
+        if result["wall_time"] > baseline_time * (1 + tolerance):
+            regressions.append(
+                f"{name}: {result['wall_time']:.3f} s, baseline {baseline_time:.3f} s "
+                f"(+{(result['wall_time'] / baseline_time - 1) * 100:.0f}%)"
+            )
+    return regressions
+
+
+def run(channel_count: int, cross_section_location_count: int, pixel_size: float, seed: int,
+        max_workers: int = 1) -> Benchmark:
+    tracemalloc.start()
+    benchmark = Benchmark()
+    with benchmark.stage("generate channels"):
+        input_channels = generate_channels(channel_count, cross_section_location_count, seed=seed)
+
+    channels = []
+    errors = []
+    with benchmark.stage("make valid"):
+        for channel in input_channels:
+            channel.geometry = channel.geometry.simplify(pixel_size)
+        for channel, future in map_ordered(Channel.make_valid, input_channels, max_workers):
+            try:
+                channels += future.result()
+            except Exception as e:
+                errors.append((channel.id, repr(e)))
+
+    with benchmark.stage("triangulate"):
+        for channel in channels:
+            channel.fill_parallel_offsets()
+
+    with benchmark.stage("fill wedges"):
+        fill_wedges(channels)
+
+    with benchmark.stage("sort triangles"):
+        for channel in channels:
+            channel.triangles
+
+    with TemporaryDirectory() as temp_dir:
+        def output_filename(channel: Channel) -> str:
+            return str(Path(temp_dir) / f"channel_{channel.id[0]}_{channel.id[1]}.tif")
+
+        rasters = []
+        with benchmark.stage("rasterize"):
+            for channel, future in map_ordered(
+                lambda channel: rasterize_channel(
+                    channel, pixel_size, output_filename=output_filename(channel), nodatavalue=NODATA_VALUE
+                ),
+                channels,
+                max_workers,
+            ):
+                if future.result():
+                    rasters.append(output_filename(channel))
+
+        with benchmark.stage("merge rasters"):
+            merge_rasters(
+                rasters,
+                tile_size=1024,
+                aggregation_method="min",
+                output_filename=Path(temp_dir) / "merged.tif",
+                output_pixel_size=pixel_size,
+                output_nodatavalue=NODATA_VALUE,
+            )
+    tracemalloc.stop()
+    if errors:
+        print(f"{len(errors)} channels could not be made valid: {errors}")
+    return benchmark
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--cross-section-locations", type=int, default=3)
+    parser.add_argument("--pixel-size", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker threads (default: 1)")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare the results with this JSON file from an earlier run")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed slowdown per stage compared to the baseline, as a fraction (default: 0.25)"
+    )
+    args = parser.parse_args()
+    result = run(
+        channel_count=args.channels,
+        cross_section_location_count=args.cross_section_locations,
+        pixel_size=args.pixel_size,
+        seed=args.seed,
+        max_workers=args.workers,
+    )
+    print(result.summary())
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result.results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result.results, json.load(f), args.tolerance)
+        if regressions:
+            print("Slower than baseline:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("No stages slower than baseline")
@@ -15,6 +15,7 @@ from rasterize_channel import (
     # fill_wedges,
     parse_cross_section_table,
     triangulate_between, highest_valid_index_single_offset, highest_valid_index, is_valid_offset,
+    is_clearly_between,
 )
 
 
@@ -1136,6 +1137,21 @@ def test_triangulate_between():
     assert triangles[0].geometry.wkt == "POLYGON Z ((50 5 15, 50 0 10, 45 2.5 15, 50 5 15))"
 
 
+def test_is_clearly_between():
+    left = np.array([[0, 0], [0, 2], [0, 4]], dtype=float)
+    right = np.array([[10, 0], [10, 3], [10, 6]], dtype=float)
+    # nothing between the lines
+    assert is_clearly_between([(0, 0), (1, 0), (0, 1)], (left, right))
+    assert is_clearly_between([(0, 0), (1, 0), (1, 1)], (left, right))
+
+    # the left line folds back into the triangle
+    left_folded = np.array([[0, 0], [0, 2], [3, 0.5]], dtype=float)
+    assert not is_clearly_between([(0, 0), (1, 0), (0, 1)], (left_folded, right))
+
+    # degenerate triangle
+    assert not is_clearly_between([(0, 0), (1, 0), (0, 1)], (np.array([[0, 0], [0, 0]], dtype=float), right))
+
+
 if __name__ == "__main__":
     # test_parse_cross_section_table()
     # test_channel_azimuth_at()
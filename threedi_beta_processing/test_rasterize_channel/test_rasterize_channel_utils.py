@@ -1,8 +1,10 @@
 from pathlib import Path
 
+import numpy as np
 from osgeo import gdal
+from shapely.geometry import box
 
-from ..rasterize_channel_utils import merge_rasters
+from ..rasterize_channel_utils import merge_rasters, rasterize_triangles
 
 
 TEST_DATA_DIR = Path(__file__).parent
@@ -20,8 +22,25 @@ def test_merge_rasters():
     )
 
 
+def test_rasterize_triangles():
+    # plane z = x + 2y, covered by two triangles
+    vertices = np.array([[0, 0, 0], [10, 0, 10], [0, 10, 20], [10, 10, 30]], dtype=float)
+    triangles = np.array([[0, 1, 2], [1, 3, 2]])
+    data, geotransform = rasterize_triangles(vertices, triangles, pixel_size=1.0)
+    assert geotransform == (0.0, 1.0, 0.0, 10.0, 0.0, -1.0)
+    assert data.shape == (10, 10)
+    x, y = np.meshgrid(np.arange(10) + 0.5, 10 - (np.arange(10) + 0.5))
+    assert np.allclose(data, x + 2 * y)
+
+    # only pixels with their centre in the mask get a value
+    data, geotransform = rasterize_triangles(vertices, triangles, pixel_size=1.0, mask=box(0, 0, 5, 5))
+    assert np.sum(data != -9999) == 25
+    assert np.all(data[:5, :] == -9999)
+
+
 # def test_align_extent():
 #     assert align_extent((10.3, 99.8, 20.3, 199.8), xres=0.5, yres=0.5) == (10.0, 99.5, 20.5, 200.0)
 
 test_merge_rasters()
+test_rasterize_triangles()
 # test_align_extent()
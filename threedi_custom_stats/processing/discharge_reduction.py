@@ -1,4 +1,3 @@
-from datetime import datetime
 from pathlib import Path
 from typing import List, Tuple, Iterator, Dict
 
@@ -6,12 +5,17 @@ from shapely.geometry import LineString
 
 try:
     from .leak_detector import LeakDetector, Edge, highest
+    from .leak_detector_cache import LeakDetectorCache
+    from .profiler import Profiler
 except ImportError:
     from leak_detector import LeakDetector, Edge, highest
+    from leak_detector_cache import LeakDetectorCache
+    from profiler import Profiler
 try:
     from ..threedi_result_aggregation.base import (
         water_levels_at_cross_section,
         prepare_timeseries,
+        prepare_timeseries_in_blocks,
         aggregate_prepared_timeseries
     )
     from ..threedi_result_aggregation.aggregation_classes import (
@@ -26,6 +30,7 @@ except ImportError:
     from threedi_result_aggregation.base import (
         water_levels_at_cross_section,
         prepare_timeseries,
+        prepare_timeseries_in_blocks,
         aggregate_prepared_timeseries
     )
     from threedi_result_aggregation.aggregation_classes import (
@@ -46,6 +51,137 @@ OLD = "OLD"
 NEW = "NEW"
 
 
+def sorted_exchange_levels(exchange_levels: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sort the exchange levels of each edge once, so that they can be used in `discharge_reduction_factors_2d`
+
+    :param exchange_levels: list of 1D arrays of exchange levels, one array for each edge
+    :return: tuple of
+     - 2D array (edges x max number of exchange levels) of sorted exchange levels, padded with inf. NaN values are
+       treated as padding, i.e. they are ignored.
+     - 2D array (edges x max number of exchange levels + 1) of the cumulative sum of the sorted exchange levels,
+       starting with 0
+    """
+    max_length = max([len(levels) for levels in exchange_levels], default=0)
+    result = np.full((len(exchange_levels), max_length), np.inf)
+    for i, levels in enumerate(exchange_levels):
+        levels = np.asarray(levels, dtype=float)
+        result[i, :len(levels)] = np.where(np.isnan(levels), np.inf, levels)
+    result.sort(axis=1)
+    cumulative = np.zeros((len(exchange_levels), max_length + 1))
+    np.cumsum(np.where(np.isfinite(result), result, 0), axis=1, out=cumulative[:, 1:])
+    return result, cumulative
+
+
+def count_lower(sorted_values: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    """
+    Row-wise equivalent of `np.searchsorted(sorted_values[i], queries[i], side="left")` for all rows i at once,
+    i.e. the number of values in each row of `sorted_values` that is lower than each of the `queries` in that row
+
+    :param sorted_values: 2D array (rows x n), sorted along axis 1
+    :param queries: 2D array (rows x m)
+    :return: 2D integer array (rows x m)
+    """
+    nr_rows, n = sorted_values.shape
+    m = queries.shape[1]
+    rows = np.concatenate([np.repeat(np.arange(nr_rows), m), np.repeat(np.arange(nr_rows), n)])
+    values = np.concatenate([queries.ravel(), sorted_values.ravel()])
+    is_value = np.concatenate([np.zeros(nr_rows * m, dtype=bool), np.ones(nr_rows * n, dtype=bool)])
+
+    # sort by row, then by value; queries are placed before values that are equal to them
+    order = np.lexsort((is_value, values, rows))
+    nr_values_up_to = np.cumsum(is_value[order])
+    is_query = ~is_value[order]
+    query_indices = order[is_query]
+    result = np.empty(nr_rows * m, dtype=int)
+    result[query_indices] = nr_values_up_to[is_query] - rows[query_indices] * n
+    return result.reshape(nr_rows, m)
+
+
+def wet_cross_sectional_areas_and_perimeters(
+        sorted_levels: np.ndarray,
+        cumulative_levels: np.ndarray,
+        nr_lower_levels: np.ndarray,
+        water_levels: np.ndarray,
+        obstacle_crest_levels: np.ndarray,
+        pixel_size: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Calculate the wet cross-sectional area and the wetted perimeter for all edges and water levels at once, with
+    exchange levels that are lower than the obstacle crest level raised to the obstacle crest level.
+
+    If the water level is above the obstacle crest level, the exchange levels below the water level are the `k` lowest
+    ones, of which the `m` lowest are raised to the crest level. So:
+     A = (k * water level - (m * crest level + sum of the levels k - m)) * pixel size
+     P = k * pixel size
+
+    :param sorted_levels: output of `sorted_exchange_levels`
+    :param cumulative_levels: output of `sorted_exchange_levels`
+    :param nr_lower_levels: number of exchange levels lower than each water level, i.e. `count_lower(sorted_levels,
+    water_levels)`
+    :param water_levels: 2D array (edges x timesteps)
+    :param obstacle_crest_levels: 1D array (edges)
+    :param pixel_size: width of the cross-section that each exchange level applies to
+    :return: tuple of 2D arrays (edges x timesteps) of wet cross-sectional areas and wetted perimeters
+    """
+    crest_levels = obstacle_crest_levels[:, np.newaxis]
+    is_wet = water_levels > crest_levels
+    k = np.where(is_wet, nr_lower_levels, 0)
+    m = np.minimum(count_lower(sorted_levels, crest_levels), k)
+    bed_level_sums = m * crest_levels + \
+        np.take_along_axis(cumulative_levels, k, axis=1) - \
+        np.take_along_axis(cumulative_levels, m, axis=1)
+    with np.errstate(invalid="ignore"):
+        areas = np.where(is_wet, np.maximum(k * water_levels - bed_level_sums, 0), 0) * pixel_size
+    perimeters = k * pixel_size
+    return areas, perimeters
+
+
+def discharge_reduction_factors_2d(
+        sorted_levels: np.ndarray,
+        cumulative_levels: np.ndarray,
+        water_levels: np.ndarray,
+        old_obstacle_crest_levels: np.ndarray,
+        new_obstacle_crest_levels: np.ndarray,
+        pixel_size: float
+) -> np.ndarray:
+    """
+    Calculate the discharge reduction factor (see `EdgeWithDischargeThreshold.discharge_reduction_factor`) for all
+    edges and water levels at once
+
+    :param sorted_levels: output of `sorted_exchange_levels`
+    :param cumulative_levels: output of `sorted_exchange_levels`
+    :param water_levels: 2D array (edges x timesteps)
+    :param old_obstacle_crest_levels: 1D array (edges)
+    :param new_obstacle_crest_levels: 1D array (edges)
+    :param pixel_size: width of the cross-section that each exchange level applies to
+    :return: 2D array (edges x timesteps)
+    """
+    water_levels = np.asarray(water_levels, dtype=float)
+    nr_lower_levels = count_lower(sorted_levels, water_levels)
+    old_areas, old_perimeters = wet_cross_sectional_areas_and_perimeters(
+        sorted_levels=sorted_levels,
+        cumulative_levels=cumulative_levels,
+        nr_lower_levels=nr_lower_levels,
+        water_levels=water_levels,
+        obstacle_crest_levels=np.asarray(old_obstacle_crest_levels, dtype=float),
+        pixel_size=pixel_size
+    )
+    new_areas, new_perimeters = wet_cross_sectional_areas_and_perimeters(
+        sorted_levels=sorted_levels,
+        cumulative_levels=cumulative_levels,
+        nr_lower_levels=nr_lower_levels,
+        water_levels=water_levels,
+        obstacle_crest_levels=np.asarray(new_obstacle_crest_levels, dtype=float),
+        pixel_size=pixel_size
+    )
+    result = np.zeros(water_levels.shape)
+    valid = (old_areas > 0) & (new_areas > 0)
+    result[valid] = np.sqrt(new_areas[valid] / new_perimeters[valid]) / \
+        np.sqrt(old_areas[valid] / old_perimeters[valid])
+    return result
+
+
 class LeakDetectorWithDischargeThreshold(LeakDetector):
     # TODO: re-implement result_edges() and result_obstacles()
     Q_NET_SUM = Aggregation(
@@ -53,6 +189,7 @@ class LeakDetectorWithDischargeThreshold(LeakDetector):
         method=AGGREGATION_METHODS.get_by_short_name("sum"),
         sign=AggregationSign("net", "Net"),
     )
+    TIMESERIES_BLOCK_SIZE = 100  # number of timesteps to read at once when calculating cumulative discharges
 
     def __init__(
             self,
@@ -66,7 +203,9 @@ class LeakDetectorWithDischargeThreshold(LeakDetector):
             obstacles: List[Tuple[LineString, float]] = None,
             feedback=None,
             start_time: float = None,
-            end_time: float = None
+            end_time: float = None,
+            cache: LeakDetectorCache = None,
+            profiler: Profiler = None
     ):
         """
         Initialize LeakDetector with GridH5ResultAdmin instead of GridH5Admin
@@ -76,20 +215,28 @@ class LeakDetectorWithDischargeThreshold(LeakDetector):
         self.min_discharge = min_discharge
         self.start_time = start_time
         self.end_time = end_time
+        self.profiler = profiler or Profiler()
+        self.profiler.start("calculate cumulative discharges")
         if feedback:
-            feedback.pushInfo(f"{datetime.now()}")
             feedback.setProgressText("Calculate cumulative discharges...")
+        # stream the discharges in blocks of timesteps, to avoid reading the full discharge matrix of all flowlines
         all_2d_open_water_flowlines = grid_result_admin.lines.subset('2D_OPEN_WATER').filter(id__in=flowline_ids)
-        discharges, self.tintervals = prepare_timeseries(
-            nodes_or_lines=all_2d_open_water_flowlines,
-            aggregation=self.Q_NET_SUM
-        )
-        q_net_sum = aggregate_prepared_timeseries(
-            timeseries=discharges,
-            tintervals=self.tintervals,
-            start_time=self.start_time,
-            aggregation=self.Q_NET_SUM,
-        )
+        q_net_sum = np.zeros(all_2d_open_water_flowlines.count)
+        for discharges, tintervals in prepare_timeseries_in_blocks(
+                nodes_or_lines=all_2d_open_water_flowlines,
+                aggregation=self.Q_NET_SUM,
+                block_size=self.TIMESERIES_BLOCK_SIZE
+        ):
+            if feedback:
+                if feedback.isCanceled():
+                    return
+            self.profiler.count("discharge timeseries blocks")
+            q_net_sum += aggregate_prepared_timeseries(
+                timeseries=discharges,
+                tintervals=tintervals,
+                start_time=self.start_time,
+                aggregation=self.Q_NET_SUM,
+            )
         relevant_flowline_ids = all_2d_open_water_flowlines.id[
             np.abs(q_net_sum) > self.min_discharge
         ]
@@ -102,42 +249,77 @@ class LeakDetectorWithDischargeThreshold(LeakDetector):
             search_precision=search_precision,
             min_peak_prominence=min_peak_prominence,
             obstacles=obstacles,
-            feedback=feedback
+            feedback=feedback,
+            cache=cache,
+            profiler=self.profiler
         )
 
         # convert edges to EdgeWithDischargeThreshold
+        self.profiler.start("convert edges")
         self._edge_dict = {
             line_nodes: EdgeWithDischargeThreshold.from_edge(edge=edge, ld=self)
             for line_nodes, edge in self._edge_by_line_nodes.items()
         }  # {line_nodes: Edge}
         self.edges = list(self._edge_dict.values())
-        discharges = dict(zip(all_2d_open_water_flowlines.id, discharges.T))
         cumulative_discharges = dict(zip(all_2d_open_water_flowlines.id, q_net_sum))
         for edge in self.edges:
-            edge.discharges = discharges[edge.flowline_id]
             edge.discharge_without_obstacle = cumulative_discharges[edge.flowline_id]
 
-        # attributes set in calculate_water_levels_at_cross_section
+        # attributes set in read_discharges and calculate_water_levels_at_cross_section
         self.water_levels = None
         self.tintervals = None
+        self.profiler.stop()
 
     def run(self, feedback=None):
         super().run(feedback)
+        self.read_discharges(feedback)
         self.calculate_water_levels_at_cross_section(feedback)
         self.calculate_discharge_reduction(feedback)
+        self.profiler.stop()
+
+    def edges_with_obstacles(self) -> List:
+        """Return the edges for which an obstacle has been identified"""
+        return [edge for edge in self.edges if edge.obstacles]
+
+    def read_discharges(self, feedback=None):
+        """
+        Read the discharge timeseries for the flowlines for which an obstacle has been identified
+        """
+        self.profiler.start("read discharges")
+        if feedback:
+            feedback.setProgressText("Read discharges at cell edges...")
+        edges = self.edges_with_obstacles()
+        if not edges:
+            return
+        flowline_ids = sorted(edge.flowline_id for edge in edges)
+        flowlines = self.grid_result_admin.lines.filter(id__in=flowline_ids)
+        discharges, self.tintervals = prepare_timeseries(
+            nodes_or_lines=flowlines,
+            aggregation=self.Q_NET_SUM
+        )
+        discharges_dict = dict(zip(flowlines.id, discharges.T))
+        for edge in edges:
+            edge.discharges = discharges_dict[edge.flowline_id]
 
     def calculate_water_levels_at_cross_section(self, feedback=None):
+        """
+        Read the water levels at the cross-section for the flowlines for which an obstacle has been identified
+        """
         # get water_level_at_cross_section timeseries and time intervals
+        self.profiler.start("calculate water levels")
         if feedback:
-            feedback.pushInfo(f"{datetime.now()}")
             feedback.setProgressText("Calculate water levels at cell edges...")
+        edges = self.edges_with_obstacles()
+        if not edges:
+            return
+        flowline_ids = sorted(edge.flowline_id for edge in edges)
         water_levels, self.tintervals = water_levels_at_cross_section(
             gr=self.grid_result_admin,
-            flowline_ids=list(self.flowlines.id),
+            flowline_ids=flowline_ids,
             aggregation_sign=AggregationSign(short_name="net", long_name="Net")
         )
-        water_levels_dict = self.bind_to_flowline_ids(water_levels.T)
-        for edge in self.edges:
+        water_levels_dict = dict(zip(flowline_ids, water_levels.T))
+        for edge in edges:
             edge.water_levels_at_cross_section = water_levels_dict[edge.flowline_id]
 
     def calculate_discharge_reduction(self, feedback=None):
@@ -146,17 +328,29 @@ class LeakDetectorWithDischargeThreshold(LeakDetector):
         Resulting {flowline_id: discharge_reduction} dict is stored in `self.discharge_reduction`
         """
 
-        # select discharge timeseries for flowlines for which cumulative discharge exceeds threshold from previously
-        # retrieved discharge timeseries
+        self.profiler.start("calculate discharge reduction")
         if feedback:
-            feedback.pushInfo(f"{datetime.now()}")
             feedback.setProgressText("Calculate discharge reduction...")
 
-        for i, edge in enumerate(self.edges):
+        edges = self.edges_with_obstacles()  # skip if no obstacle has been identified
+        if not edges:
+            return
+        sorted_levels, cumulative_levels = sorted_exchange_levels([edge.exchange_levels for edge in edges])
+        if feedback:
+            if feedback.isCanceled():
+                return
+        discharge_reduction_factors = discharge_reduction_factors_2d(
+            sorted_levels=sorted_levels,
+            cumulative_levels=cumulative_levels,
+            water_levels=np.vstack([edge.water_levels_at_cross_section for edge in edges]),
+            old_obstacle_crest_levels=np.array([edge._get_obstacle_crest_level(OLD) for edge in edges]),
+            new_obstacle_crest_levels=np.array([edge._get_obstacle_crest_level(NEW) for edge in edges]),
+            pixel_size=self.dem.RasterXSize
+        )
+        for i, edge in enumerate(edges):
             if feedback:
-                feedback.setProgress(100 * i / len(self.edges))
-            if edge.obstacles:  # skip if no obstacle has been identified
-                edge.calculate_discharge_reduction()
+                feedback.setProgress(100 * i / len(edges))
+            edge.calculate_discharge_reduction(discharge_reduction_factors=discharge_reduction_factors[i])
 
     def flowlines_with_high_discharge_reduction(self) -> List[int]:
         """Return a list of ids of flowlines for which the discharge reduction exceeds the threshold"""
@@ -209,6 +403,7 @@ class EdgeWithDischargeThreshold(Edge):
         result_edge.obstacles = edge.obstacles
 
         # attributes set in calculate_geometries()
+        result_edge.flowline_coords = edge.flowline_coords
         result_edge.flowline_geometry = edge.flowline_geometry
         result_edge.geometry = edge.geometry
         result_edge.start_coord = edge.start_coord
@@ -290,15 +485,25 @@ class EdgeWithDischargeThreshold(Edge):
 
     def discharge_reduction_factors(self, water_levels: np.array):
         """Vectorized version of `discharge_reduction_factor`"""
-        v_discharge_reduction_factors = np.vectorize(self.discharge_reduction_factor, otypes=[float])
-        return v_discharge_reduction_factors(water_levels)
-
-    def calculate_discharge_reduction(self):
+        sorted_levels, cumulative_levels = sorted_exchange_levels([self.exchange_levels])
+        return discharge_reduction_factors_2d(
+            sorted_levels=sorted_levels,
+            cumulative_levels=cumulative_levels,
+            water_levels=np.atleast_1d(water_levels)[np.newaxis, :],
+            old_obstacle_crest_levels=np.array([self._get_obstacle_crest_level(OLD)]),
+            new_obstacle_crest_levels=np.array([self._get_obstacle_crest_level(NEW)]),
+            pixel_size=self.ld.dem.RasterXSize
+        )[0]
+
+    def calculate_discharge_reduction(self, discharge_reduction_factors: np.ndarray = None):
         """
         Calculate the difference in net cumulative discharge when an obstacle is applied to a flowline's cross-section
+
+        :param discharge_reduction_factors: discharge reduction factor for each timestep, if already calculated
         """
         if self.obstacles:
-            discharge_reduction_factors = self.discharge_reduction_factors(self.water_levels_at_cross_section)
+            if discharge_reduction_factors is None:
+                discharge_reduction_factors = self.discharge_reduction_factors(self.water_levels_at_cross_section)
             self.discharge_with_obstacle = np.nansum(self.discharges * discharge_reduction_factors * self.ld.tintervals)
             self.discharge_reduction = abs(self.discharge_with_obstacle - self.discharge_without_obstacle)
 
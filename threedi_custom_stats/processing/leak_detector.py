@@ -1,4 +1,3 @@
-from datetime import datetime
 from typing import Dict, Union, List, Tuple, Optional, Iterator
 
 import numpy as np
@@ -10,6 +9,13 @@ from scipy.signal import find_peaks
 from threedigrid.admin.gridadmin import GridH5Admin
 from threedigrid.admin.lines.models import Lines
 
+try:
+    from .leak_detector_cache import LeakDetectorCache
+    from .profiler import Profiler
+except ImportError:
+    from leak_detector_cache import LeakDetectorCache
+    from profiler import Profiler
+
 SEARCH_STRUCTURE = generate_binary_structure(2, 2)
 TOP = 'top'
 RIGHT = 'right'
@@ -115,6 +121,42 @@ def intersection(
     return None
 
 
+def segments_intersect(segments: np.ndarray, segment) -> np.ndarray:
+    """
+    Vectorized test of which of `segments` intersect with `segment`. Touching segments are considered to intersect,
+    in line with shapely's `intersects` predicate.
+
+    :param segments: array of shape (n, 4), each row containing the coordinates of a segment: [x0, y0, x1, y1]
+    :param segment: coordinates of a single segment: [x0, y0, x1, y1]
+    :return: boolean array of length n
+    """
+    segments = np.asarray(segments, dtype=float).reshape(-1, 4)
+    ax, ay, bx, by = segments.T
+    cx, cy, dx, dy = (float(val) for val in segment)
+
+    def orientation(px, py, qx, qy, rx, ry):
+        return np.sign((qx - px) * (ry - py) - (qy - py) * (rx - px))
+
+    def on_segment(px, py, qx, qy, rx, ry):
+        """Return True where r, which is collinear with p and q, lies within the bounding box of p and q"""
+        return (
+            (np.minimum(px, qx) <= rx) & (rx <= np.maximum(px, qx)) &
+            (np.minimum(py, qy) <= ry) & (ry <= np.maximum(py, qy))
+        )
+
+    o1 = orientation(ax, ay, bx, by, cx, cy)
+    o2 = orientation(ax, ay, bx, by, dx, dy)
+    o3 = orientation(cx, cy, dx, dy, ax, ay)
+    o4 = orientation(cx, cy, dx, dy, bx, by)
+
+    result = (o1 != o2) & (o3 != o4)
+    result |= (o1 == 0) & on_segment(ax, ay, bx, by, cx, cy)
+    result |= (o2 == 0) & on_segment(ax, ay, bx, by, dx, dy)
+    result |= (o3 == 0) & on_segment(cx, cy, dx, dy, ax, ay)
+    result |= (o4 == 0) & on_segment(cx, cy, dx, dy, bx, by)
+    return result
+
+
 class LeakDetector:
     """
     Interface between the gridadmin and the classes in this module
@@ -130,7 +172,9 @@ class LeakDetector:
             search_precision: float = None,
             min_peak_prominence: float = None,
             obstacles: List[Tuple[LineString, float]] = None,
-            feedback=None
+            feedback=None,
+            cache: LeakDetectorCache = None,
+            profiler: Profiler = None
     ):
         """
         :param gridadmin:
@@ -140,8 +184,13 @@ class LeakDetector:
         :param search_precision:
         :param min_peak_prominence:
         :param feedback: Object that has .pushWarning() method, like QgsProcessingFeedback
+        :param cache: cache of DEM pixels per cell and exchange levels per edge, to speed up repeated runs on the same
+        DEM and gridadmin
+        :param profiler: collects timings per stage and counts of cells, cell pairs, etc.
         """
         self.dem = dem
+        self.cache = cache
+        self.profiler = profiler or Profiler()
         self.min_obstacle_height = min_obstacle_height
         self.search_precision = search_precision or self.suitable_search_precision()
         self.min_peak_prominence = min_peak_prominence or min_obstacle_height
@@ -159,8 +208,8 @@ class LeakDetector:
         self.flowlines__line_coords = self.bind_to_flowline_ids(self.flowlines.line_coords.T)
 
         # Create cells
+        self.profiler.start("read cells")
         if feedback:
-            feedback.pushInfo(f"{datetime.now()}")
             feedback.setProgressText("Read cells...")
         unique_cell_ids = np.unique(np.squeeze(self.flowlines.line_nodes.data))
         cells__cell_coords = dict(
@@ -171,6 +220,7 @@ class LeakDetector:
         )
 
         self._cell_dict = dict()
+        self.profiler.count("cells", len(cells__cell_coords))
         for i, (cell_id, cell_coords) in enumerate(cells__cell_coords.items()):
             if feedback:
                 if feedback.isCanceled():
@@ -180,8 +230,8 @@ class LeakDetector:
                 feedback.setProgress(100 * i / len(cells__cell_coords))
 
         # Find cell neighbours
+        self.profiler.start("find cell neighbours")
         if feedback:
-            feedback.pushInfo(f"{datetime.now()}")
             feedback.setProgressText("Find cell neighbours...")
         for i, flowline_id in enumerate(self.flowlines__id):
             if feedback:
@@ -197,10 +247,11 @@ class LeakDetector:
                 feedback.setProgress(100 * i / len(self.flowlines__id))
 
         # Create edges
+        self.profiler.start("create edges")
         if feedback:
-            feedback.pushInfo(f"{datetime.now()}")
             feedback.setProgressText("Create edges...")
         self.edges = list()
+        self.profiler.count("edges", len(self.flowlines__id))
         self._edge_by_line_nodes = dict()  # {line_nodes: Edge}
         self._edge_by_flowline_id = dict()  # {flowline_id: Edge}
         for i, flowline_id in enumerate(self.flowlines__id):
@@ -222,11 +273,13 @@ class LeakDetector:
             self._edge_by_flowline_id[flowline_id] = edge
             if feedback:
                 feedback.setProgress(100 * i / len(self.flowlines__id))
+        if self.cache:
+            self.cache.save()
 
         # Update edge exchange level from obstacles
         if obstacles:
+            self.profiler.start("update exchange levels from obstacles")
             if feedback:
-                feedback.pushInfo(f"{datetime.now()}")
                 feedback.setProgressText("Update edge exchange level from obstacles...")
                 feedback.setProgress(0)
             flowline_geometries = [edge.flowline_geometry for edge in self.edges]
@@ -258,6 +311,7 @@ class LeakDetector:
                     if edge.exchange_level < crest_level:
                         edge.exchange_level = crest_level
                 feedback.setProgress(100 * i / len(obstacle_indices))
+        self.profiler.stop()
 
     def suitable_search_precision(self):
         return min(self.min_obstacle_height/10, 0.1)
@@ -314,7 +368,9 @@ class LeakDetector:
         """
 
         # find obstacles
+        self.profiler.start("find obstacles")
         for i, cell_pair in enumerate(self.cell_pairs()):
+            self.profiler.count("cell pairs")
             try:
                 cell_pair.find_obstacles()
                 if feedback:
@@ -326,6 +382,7 @@ class LeakDetector:
                 raise e
 
         # find connecting obstacles
+        self.profiler.start("find connecting obstacles")
         for i, cell_pair in enumerate(self.cell_pairs()):
             try:
                 cell_pair.find_connecting_obstacles()
@@ -336,6 +393,7 @@ class LeakDetector:
             except IndexError as e:
                 print(f"Something went wrong in cell pair ({cell_pair.reference_cell.id, cell_pair.neigh_cell.id})")
                 raise e
+        self.profiler.stop()
 
     def results(self, geometry: str, flowline_ids=None) -> Iterator[Dict]:
         """
@@ -388,6 +446,7 @@ class Obstacle:
         from_y = self.from_cell.coords[3] - (from_pos_y * abs(gt[5]) + abs(gt[5]) / 2)
         to_x = self.to_cell.coords[0] + to_pos_x * abs(gt[1]) + abs(gt[1]) / 2
         to_y = self.to_cell.coords[3] - (to_pos_y * abs(gt[5]) + abs(gt[5]) / 2)
+        self.coords = (from_x, from_y, to_x, to_y)
         self.geometry = LineString([Point(from_x, from_y), Point(to_x, to_y)])
 
     @staticmethod
@@ -451,6 +510,7 @@ class Edge:
         self.obstacles: List[Obstacle] = list()
 
         # attributes set in calculate_geometries()
+        self.flowline_coords = None
         self.flowline_geometry = None
         self.geometry = None
         self.start_coord = None
@@ -463,9 +523,10 @@ class Edge:
     def calculate_geometries(self, flowline_coords: Tuple[float, float, float, float]):
         """
         Set the geometries of the edge and the flowline crossing the edge
-        sets `self.flowline_geometry`, `self.geometry`, `self.start_coord`, `self.end_coord`
+        sets `self.flowline_coords`, `self.flowline_geometry`, `self.geometry`, `self.start_coord`, `self.end_coord`
         """
         x0, y0, x1, y1 = flowline_coords
+        self.flowline_coords = np.array([x0, y0, x1, y1], dtype=float)
         self.flowline_geometry = LineString([Point(x0, y0), Point(x1, y1)])
 
         # set start and end coordinates
@@ -498,8 +559,15 @@ class Edge:
             else:
                 bbox = [self.start_coord[0], self.start_coord[1] - pxsize, self.end_coord[0],
                         self.end_coord[1] + pxsize]
-            arr = read_as_array(raster=self.ld.dem, bbox=bbox, pad=True)
-            self.exchange_levels = np.nanmax(arr, axis=int(self.is_bottom_up))
+
+            def read_exchange_levels():
+                arr = read_as_array(raster=self.ld.dem, bbox=bbox, pad=True)
+                return np.nanmax(arr, axis=int(self.is_bottom_up))
+
+            if self.ld.cache:
+                self.exchange_levels = self.ld.cache.exchange_levels(self.flowline_id, read_exchange_levels)
+            else:
+                self.exchange_levels = read_exchange_levels()
             self.exchange_level = np.nanmin(self.exchange_levels)
 
     @property
@@ -542,7 +610,10 @@ class Cell:
         self.coords = coords
         self.xmax = np.max(coords[[0, 2]])
         self.xmin = np.min(coords[[0, 2]])
-        self.pixels = read_as_array(raster=ld.dem, bbox=coords, pad=True)
+        if ld.cache:
+            self.pixels = ld.cache.cell_pixels(id, lambda: read_as_array(raster=ld.dem, bbox=coords, pad=True))
+        else:
+            self.pixels = read_as_array(raster=ld.dem, bbox=coords, pad=True)
         band = ld.dem.GetRasterBand(1)
         ndv = band.GetNoDataValue()
         maxval = np.nanmax(self.pixels)
@@ -786,6 +857,37 @@ class CellPair:
             self.edges[1] = [self.ld.edge(self.reference_cell, self.neigh_cell)]
             self.edges[2] = self.neigh_cell.edges(RIGHT)
 
+        # attributes set in candidate_edges
+        self._candidate_edges = None
+        self._candidate_flowline_coords = None
+
+    @property
+    def candidate_edges(self) -> List[Edge]:
+        """
+        All unique edges of the cells in this cell pair, i.e. the edges to which an obstacle found in this cell pair
+        may be assigned
+        """
+        if self._candidate_edges is None:
+            self._candidate_edges = list(
+                dict.fromkeys(
+                    edge
+                    for cell in self.cells.values()
+                    for side in [TOP, RIGHT, BOTTOM, LEFT]
+                    for edge in cell.edges(side)
+                )
+            )
+            self._candidate_flowline_coords = np.array(
+                [edge.flowline_coords for edge in self._candidate_edges]
+            ).reshape(-1, 4)
+        return self._candidate_edges
+
+    @property
+    def candidate_flowline_coords(self) -> np.ndarray:
+        """Array of shape (n, 4) with the flowline coordinates of `candidate_edges`"""
+        if self._candidate_flowline_coords is None:
+            _ = self.candidate_edges
+        return self._candidate_flowline_coords
+
     @property
     def bottom_aligned(self) -> bool:
         return round(self.reference_cell.coords[1], COORD_DECIMALS) == round(self.neigh_cell.coords[1], COORD_DECIMALS)
@@ -1045,6 +1147,7 @@ class CellPair:
 
         # case: from and to positions already connect at hmax
         labelled_pixels, labelled_pixels_nr_features = label(pixels >= hmax, structure=SEARCH_STRUCTURE)
+        self.ld.profiler.count("label calls")
         from_pixel_label = int(labelled_pixels[from_pos])
         to_pixel_label = labelled_pixels[to_pos]
         if from_pixel_label != 0 and np.any(to_pixel_label == from_pixel_label):
@@ -1055,6 +1158,7 @@ class CellPair:
             while (hmax - hmin) > self.ld.search_precision:
                 hcurrent = np.nanmean([hmin, hmax])
                 labelled_pixels, _ = label(pixels > hcurrent, structure=SEARCH_STRUCTURE)
+                self.ld.profiler.count("label calls")
                 from_pixel_label = int(labelled_pixels[from_pos])
                 to_pixel_label = labelled_pixels[to_pos]
                 if from_pixel_label != 0 and np.any(to_pixel_label == from_pixel_label):
@@ -1136,6 +1240,7 @@ class CellPair:
         maxima = self.maxima()
         for from_pos in maxima[LEFTHANDSIDE]:
             for to_pos in maxima[RIGHTHANDSIDE]:
+                self.ld.profiler.count("maxima pairs evaluated")
                 from_pos_cell = self.locate_pos(from_pos)
                 from_pos_transformed = self.transform(pos=from_pos, from_array=MERGED, to_array=from_pos_cell)
                 to_pos_cell = self.locate_pos(to_pos)
@@ -1192,13 +1297,12 @@ class CellPair:
 
                 # # edge
                 # edges are all whose flowline is intersected by the obstacle, except the from_edge and to_edge
-                potential_edges = []
-                for cell in self.cells.values():
-                    for side in [TOP, RIGHT, BOTTOM, LEFT]:
-                        for edge in cell.edges(side):
-                            if edge not in [obstacle.from_edge, obstacle.to_edge] + potential_edges:
-                                potential_edges.append(edge)
-                edges = [pe for pe in potential_edges if pe.flowline_geometry.intersects(obstacle.geometry)]
+                excluded_edges = [obstacle.from_edge, obstacle.to_edge]
+                intersects = segments_intersect(self.candidate_flowline_coords, obstacle.coords)
+                edges = [
+                    edge for edge, is_intersected in zip(self.candidate_edges, intersects)
+                    if is_intersected and edge not in excluded_edges
+                ]
                 if len(edges) == 0:
                     continue  # this can happen e.g. at the model boundary in some cases; there is an obstacle, but it
                     # doesn't intersect any relevant flowlines
@@ -1209,6 +1313,8 @@ class CellPair:
                             self.ld.search_precision:
                         edge.obstacles.append(obstacle)
                         obstacle.edges.append(edge)
+                if obstacle.edges:
+                    self.ld.profiler.count("obstacles")
 
     def find_connecting_obstacles(self):
         """
@@ -1287,6 +1393,7 @@ class CellPair:
                                 obstacle.from_edge = middle_edge
                                 obstacle.to_edge = middle_edge
                                 middle_edge.obstacles.append(obstacle)
+                                self.ld.profiler.count("connecting obstacles")
 
 
 def is_obstacle_relevant(
@@ -1345,6 +1452,7 @@ def is_obstacle_relevant(
         pixels >= crest_level - cell_or_cellpair.ld.min_obstacle_height,
         structure=SEARCH_STRUCTURE
     )[0]
+    cell_or_cellpair.ld.profiler.count("label calls")
     from_pos_label = labelled_pixels[from_pos]
     relevant = True
     for side in compare_to_sides:
@@ -10,6 +10,7 @@
 *                                                                         *
 ***************************************************************************
 """
+import os
 from pathlib import Path
 
 from osgeo import gdal
@@ -41,6 +42,7 @@ from qgis.core import (
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterFeatureSource,
     QgsProcessingParameterFile,
+    QgsProcessingParameterFileDestination,
     QgsProcessingParameterNumber,
     QgsProcessingParameterRasterDestination,
     QgsProcessingParameterRasterLayer,
@@ -52,6 +54,8 @@ from qgis.core import (
 )
 
 from .leak_detector import LeakDetector
+from .leak_detector_cache import LeakDetectorCache
+from .profiler import Profiler
 from .discharge_reduction import LeakDetectorWithDischargeThreshold
 from ..threedi_result_aggregation.aggregation_classes import Aggregation, AggregationSign
 from ..threedi_result_aggregation.constants import AGGREGATION_VARIABLES, AGGREGATION_METHODS
@@ -80,9 +84,11 @@ class DetectLeakingObstaclesBase(QgsProcessingAlgorithm):
     INPUT_FLOWLINES = "INPUT_FLOWLINES"
     INPUT_OBSTACLES = "INPUT_OBSTACLES"
     INPUT_MIN_OBSTACLE_HEIGHT = "INPUT_MIN_OBSTACLE_HEIGHT"
+    INPUT_CACHE_DIR = "INPUT_CACHE_DIR"
 
     OUTPUT_EDGES = "OUTPUT_EDGES"
     OUTPUT_OBSTACLES = "OUTPUT_OBSTACLES"
+    OUTPUT_PROFILE = "OUTPUT_PROFILE"
 
     def initAlgorithm(self, config):
 
@@ -124,6 +130,15 @@ class DetectLeakingObstaclesBase(QgsProcessingAlgorithm):
         min_obstacle_height_param.setMetadata({"widget_wrapper": {"decimals": 3}})
         self.addParameter(min_obstacle_height_param)
 
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.INPUT_CACHE_DIR,
+                "Cache folder",
+                behavior=QgsProcessingParameterFile.Folder,
+                optional=True
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT_EDGES,
@@ -140,6 +155,16 @@ class DetectLeakingObstaclesBase(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.OUTPUT_PROFILE,
+                "Output: Profiling report",
+                fileFilter="JSON files (*.json)",
+                optional=True,
+                createByDefault=False
+            )
+        )
+
     def checkParameterValues(self, parameters: Dict[str, Any], context: QgsProcessingContext) -> Tuple[bool, str]:
         success, msg = super().checkParameterValues(parameters, context)
         if success:
@@ -180,6 +205,16 @@ class DetectLeakingObstaclesBase(QgsProcessingAlgorithm):
         flowlines_source = self.parameterAsSource(parameters, self.INPUT_FLOWLINES, context)
         obstacles_source = self.parameterAsSource(parameters, self.INPUT_OBSTACLES, context)
         self.min_obstacle_height = self.parameterAsDouble(parameters, self.INPUT_MIN_OBSTACLE_HEIGHT, context)
+        cache_dir = self.parameterAsFile(parameters, self.INPUT_CACHE_DIR, context)
+        self.cache = None
+        if cache_dir:
+            dem_files = self.dem_ds.GetFileList() or []
+            if dem_files and all(os.path.isfile(fn) for fn in dem_files):
+                self.cache = LeakDetectorCache(
+                    cache_dir=cache_dir, gridadmin_fn=self.gridadmin_fn, dem_files=dem_files
+                )
+            else:
+                feedback.pushWarning("The DEM is not stored in files, so its data will not be cached")
 
         crs = QgsCoordinateReferenceSystem(f"EPSG:{self.gridadmin.epsg_code}")
 
@@ -234,35 +269,50 @@ class DetectLeakingObstaclesBase(QgsProcessingAlgorithm):
             flowline_ids=self.flowline_ids,
             min_obstacle_height=self.min_obstacle_height,
             obstacles=self.input_obstacles,
-            feedback=feedback
+            feedback=feedback,
+            cache=self.cache,
+            profiler=self.profiler
         )
         return leak_detector
 
     def processAlgorithm(self, parameters, context, feedback):
-        self.read_parameters(parameters, context, feedback)
-        feedback.setProgressText("Read computational grid...")
-        leak_detector = self.get_leak_detector(feedback)
-        if feedback.isCanceled():
-            return {}
-        feedback.setProgressText("Find obstacles...")
-        leak_detector.run(feedback=feedback)
-        feedback.setProgressText("Create 'Obstacle on cell edge' features...")
-        self.add_features_to_sink(
-            feedback=feedback,
-            sink=self.edges_sink,
-            features_data=leak_detector.results(geometry='EDGE')
-        )
-        feedback.setProgressText("Create 'Obstacle in DEM' features...")
-        self.add_features_to_sink(
-            feedback=feedback,
-            sink=self.obstacles_sink,
-            features_data=leak_detector.results(geometry='OBSTACLE')
-        )
-
-        return {
-            self.OUTPUT_EDGES: self.edges_sink_dest_id,
-            self.OUTPUT_OBSTACLES: self.obstacles_sink_dest_id
-        }
+        self.profile_fn = self.parameterAsFileOutput(parameters, self.OUTPUT_PROFILE, context)
+        self.profiler = Profiler(trace_memory=bool(self.profile_fn))
+        try:
+            self.read_parameters(parameters, context, feedback)
+            feedback.setProgressText("Read computational grid...")
+            leak_detector = self.get_leak_detector(feedback)
+            if feedback.isCanceled():
+                return {}
+            feedback.setProgressText("Find obstacles...")
+            leak_detector.run(feedback=feedback)
+            self.profiler.start("create features")
+            feedback.setProgressText("Create 'Obstacle on cell edge' features...")
+            self.add_features_to_sink(
+                feedback=feedback,
+                sink=self.edges_sink,
+                features_data=leak_detector.results(geometry='EDGE')
+            )
+            feedback.setProgressText("Create 'Obstacle in DEM' features...")
+            self.add_features_to_sink(
+                feedback=feedback,
+                sink=self.obstacles_sink,
+                features_data=leak_detector.results(geometry='OBSTACLE')
+            )
+            self.profiler.stop()
+            feedback.pushInfo(self.profiler.summary())
+
+            result = {
+                self.OUTPUT_EDGES: self.edges_sink_dest_id,
+                self.OUTPUT_OBSTACLES: self.obstacles_sink_dest_id
+            }
+            if self.profile_fn:
+                self.profiler.write_json(self.profile_fn)
+                result[self.OUTPUT_PROFILE] = self.profile_fn
+            return result
+        finally:
+            # stop tracing memory, also when cancelled or failed
+            self.profiler.close()
 
     def group(self):
         """
@@ -323,6 +373,8 @@ class DetectLeakingObstaclesAlgorithm(DetectLeakingObstaclesBase):
                 <p>Can be used to limit the analysis to a specific part of the computational grid. For example, select flowlines that have a total discharge of > 10 m<sup>3</sup></p>
                 <h4>Minimum obstacle height (m)</h4>
                 <p>Only obstacles with a crest level that is significantly higher than the exchange level will be identified. 'Significantly higher' is defined as <em>crest level &gt; exchange level + minimum obstacle height</em>.</p>
+                <h4>Cache folder</h4>
+                <p>Optional. DEM pixels per cell and exchange levels per cell edge are stored in this folder, so that they do not have to be read from the DEM again when the algorithm is rerun on the same gridadmin file and DEM, e.g. with a different minimum obstacle height. The cache is not used if the gridadmin file or the DEM has changed.</p>
                 <h4>Vertical search precision (m)</h4>
                 <p>The crest level of the identified obstacle will always be within <em>vertical search precision</em> of the actual crest level. A smaller value will yield more precise results; a higher value will make the algorithm faster to execute.</p>
                 <h3>Outputs</h3>
@@ -337,6 +389,8 @@ class DetectLeakingObstaclesAlgorithm(DetectLeakingObstaclesBase):
                 <h4>Obstacle on cell edge</h4>
                 <p>Suggested obstacle to add to the schematisation. In most cases, it is recommended solve any leaking obstacle issues with grid refinement, and only add obstacles if this does not solve the issue.</p>
                 <p>The styling shows the difference between the crest level and the exchange level</p>
+                <h4>Profiling report</h4>
+                <p>Optional JSON file with the wall time and CPU time of each stage of the analysis, and counts of e.g. the number of cells, cell pairs and obstacles.</p>
             """
 
     def createInstance(self):
@@ -384,7 +438,9 @@ class DetectLeakingObstaclesWithDischargeThresholdAlgorithm(DetectLeakingObstacl
             min_obstacle_height=self.min_obstacle_height,
             min_discharge=self.min_discharge,
             obstacles=self.input_obstacles,
-            feedback=feedback
+            feedback=feedback,
+            cache=self.cache,
+            profiler=self.profiler
         )
         return leak_detector
 
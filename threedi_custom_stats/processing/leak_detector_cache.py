@@ -0,0 +1,119 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Union
+
+import numpy as np
+
+
+def files_fingerprint(paths: Iterable[Union[str, Path]]) -> str:
+    """
+    Return a md5 hash of the path, size and modification time of each of the files at `paths`. Raises OSError if one
+    of them does not exist
+    """
+    md5 = hashlib.md5()
+    for path in paths:
+        stat = os.stat(path)
+        md5.update(f"{Path(path).resolve()} {stat.st_size} {stat.st_mtime_ns}\n".encode())
+    return md5.hexdigest()
+
+
+def _split_ragged(values: np.ndarray, shapes: np.ndarray) -> list:
+    """Split a flat array into arrays of given `shapes` (one row per array)"""
+    sizes = np.prod(shapes, axis=1).astype(int)
+    offsets = np.cumsum(sizes)[:-1]
+    return [part.reshape(shape) for part, shape in zip(np.split(values, offsets), shapes)]
+
+
+class LeakDetectorCache:
+    """
+    On-disk cache of the parts of the leak detector input that do not depend on the search parameters
+    (min_obstacle_height, min_peak_prominence, search_precision):
+
+     - the DEM pixels of each cell (nodata pixels not yet replaced)
+     - the exchange levels along each edge, as read from the DEM
+
+    The cache file name contains a fingerprint of the path, size and modification time of the gridadmin file and of
+    all files the DEM consists of (e.g. the source tiles of a VRT), so changing any of them invalidates the cache.
+    """
+
+    def __init__(
+            self,
+            cache_dir: Union[str, Path],
+            gridadmin_fn: Union[str, Path],
+            dem_files: Iterable[Union[str, Path]],
+    ):
+        """
+        :param cache_dir: directory in which the cache file is stored
+        :param gridadmin_fn: path to the gridadmin (.h5) file
+        :param dem_files: paths to the files of the DEM, e.g. as returned by `gdal.Dataset.GetFileList()`
+        """
+        self.fingerprint = files_fingerprint([gridadmin_fn, *dem_files])
+        self.path = Path(cache_dir) / f"leak_detector_{self.fingerprint}.npz"
+        self._cell_pixels: Dict[int, np.ndarray] = dict()  # {cell_id: pixels}
+        self._exchange_levels: Dict[int, np.ndarray] = dict()  # {flowline_id: exchange_levels}
+        self._modified = False
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        """Read the cache file, if it exists and matches the current fingerprint"""
+        if not self.path.exists():
+            return
+        with np.load(self.path) as data:
+            if str(data["fingerprint"]) != self.fingerprint:
+                return
+            self._cell_pixels = dict(
+                zip(data["cell_ids"].tolist(), _split_ragged(data["cell_pixels"], data["cell_shapes"]))
+            )
+            self._exchange_levels = dict(
+                zip(
+                    data["flowline_ids"].tolist(),
+                    _split_ragged(data["exchange_levels"], data["exchange_levels_shapes"])
+                )
+            )
+
+    def save(self):
+        """Write the cache file, if anything was added since it was read"""
+        if not self._modified:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        cell_pixels = list(self._cell_pixels.values())
+        exchange_levels = list(self._exchange_levels.values())
+        tmp_path = self.path.with_name(self.path.stem + "_tmp.npz")
+        np.savez(
+            tmp_path,
+            fingerprint=np.array(self.fingerprint),
+            cell_ids=np.array(list(self._cell_pixels.keys()), dtype=int),
+            cell_shapes=np.array([arr.shape for arr in cell_pixels], dtype=int).reshape(-1, 2),
+            cell_pixels=np.concatenate([arr.ravel() for arr in cell_pixels]) if cell_pixels else np.array([]),
+            flowline_ids=np.array(list(self._exchange_levels.keys()), dtype=int),
+            exchange_levels_shapes=np.array([arr.shape for arr in exchange_levels], dtype=int).reshape(-1, 1),
+            exchange_levels=np.concatenate(exchange_levels) if exchange_levels else np.array([]),
+        )
+        os.replace(tmp_path, self.path)
+        self._modified = False
+
+    def _get(self, store: Dict[int, np.ndarray], key: int, read: Callable[[], np.ndarray]) -> np.ndarray:
+        key = int(key)
+        if key in store:
+            self.hits += 1
+        else:
+            self.misses += 1
+            store[key] = np.asarray(read())
+            self._modified = True
+        return store[key].copy()
+
+    def cell_pixels(self, cell_id: int, read: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        Return the DEM pixels of the cell with `cell_id`. `read` is called to read them if they are not in the cache
+        """
+        return self._get(self._cell_pixels, cell_id, read)
+
+    def exchange_levels(self, flowline_id: int, read: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        Return the exchange levels along the edge crossed by flowline `flowline_id`. `read` is called to read them if
+        they are not in the cache
+        """
+        return self._get(self._exchange_levels, flowline_id, read)
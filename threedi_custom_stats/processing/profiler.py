@@ -0,0 +1,109 @@
+import json
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Union
+
+
+class Profiler:
+    """
+    Collects wall time, CPU time and (optionally) peak memory per stage, and counts of arbitrary events
+
+    Usage:
+        profiler = Profiler()
+        profiler.start("read cells")
+        ...
+        profiler.count("cells")
+        profiler.start("find obstacles")  # stops "read cells"
+        ...
+        profiler.write_json("report.json")
+        profiler.close()
+    """
+
+    def __init__(self, trace_memory: bool = False):
+        """
+        :param trace_memory: track peak memory use per stage with `tracemalloc`. This slows down execution.
+        """
+        self.trace_memory = trace_memory
+        self.stages: Dict[str, Dict[str, float]] = dict()
+        self.counts: Dict[str, int] = defaultdict(int)
+        self._current = None  # (name, wall start time, cpu start time) of the stage that is being timed
+        self._started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+
+    def start(self, name: str):
+        """
+        Start timing stage `name`, stopping the current stage (if any). Timings of stages with the same name are added
+        up.
+        """
+        self.stop()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        self._current = (name, time.perf_counter(), time.process_time())
+
+    def stop(self):
+        """Stop timing the current stage (if any)"""
+        if self._current is None:
+            return
+        name, wall_start, cpu_start = self._current
+        self._current = None
+        stage = self.stages.setdefault(name, {"wall_time": 0.0, "cpu_time": 0.0, "calls": 0})
+        stage["wall_time"] += time.perf_counter() - wall_start
+        stage["cpu_time"] += time.process_time() - cpu_start
+        stage["calls"] += 1
+        if self.trace_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            stage["peak_memory"] = max(stage.get("peak_memory", 0), peak_memory)
+
+    def close(self):
+        """
+        Stop the current stage (if any), and stop tracing memory if this profiler started it. The results remain
+        available.
+        """
+        self.stop()
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name: str):
+        """Context manager that times the code it wraps as stage `name`"""
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def count(self, name: str, n: int = 1):
+        """Add `n` to the counter `name`"""
+        self.counts[name] += n
+
+    def report(self) -> Dict:
+        """Return a JSON serializable dict with all stage timings and counts. Stops the current stage (if any)."""
+        self.stop()
+        result = {
+            "stages": self.stages,
+            "counts": dict(self.counts),
+            "total_wall_time": sum(stage["wall_time"] for stage in self.stages.values()),
+            "total_cpu_time": sum(stage["cpu_time"] for stage in self.stages.values()),
+        }
+        if self.trace_memory:
+            result["peak_memory"] = max([stage["peak_memory"] for stage in self.stages.values()], default=0)
+        return result
+
+    def write_json(self, path: Union[str, Path]):
+        """Write `report()` to a JSON file"""
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def summary(self) -> str:
+        """Return a human readable summary of the report"""
+        lines = [
+            f"{name}: {stage['wall_time']:.3f} s wall time, {stage['cpu_time']:.3f} s CPU time"
+            for name, stage in self.stages.items()
+        ]
+        lines += [f"{name}: {count}" for name, count in self.counts.items()]
+        return "\n".join(lines)
@@ -0,0 +1,43 @@
+"""
+Run the leak detector on the test data and write a profiling report (timings per stage, counts, peak memory)
+
+Usage: python profile_leak_detector.py [output.json]
+"""
+import sys
+from pathlib import Path
+
+from osgeo import gdal
+from threedigrid.admin.gridadmin import GridH5Admin
+
+from leak_detector import LeakDetector
+from profiler import Profiler
+
+DATA_DIR = Path(__file__).parent / 'data'
+DEM_FILENAME = DATA_DIR / 'dem_0_01.tif'
+DEM_DATASOURCE = gdal.Open(str(DEM_FILENAME), gdal.GA_ReadOnly)
+GRIDADMIN_FILENAME = DATA_DIR / 'gridadmin.h5'
+GR = GridH5Admin(GRIDADMIN_FILENAME)
+MIN_PEAK_PROMINENCE = 0.05
+SEARCH_PRECISION = 0.001
+MIN_OBSTACLE_HEIGHT = 0.05
+
+
+def run(output_fn):
+    profiler = Profiler(trace_memory=True)
+    leak_detector = LeakDetector(
+        gridadmin=GR,
+        dem=DEM_DATASOURCE,
+        flowline_ids=list(GR.lines.id),
+        min_obstacle_height=MIN_OBSTACLE_HEIGHT,
+        search_precision=SEARCH_PRECISION,
+        min_peak_prominence=MIN_PEAK_PROMINENCE,
+        profiler=profiler
+    )
+    leak_detector.run()
+    print(profiler.summary())
+    profiler.write_json(output_fn)
+    profiler.close()
+
+
+if __name__ == "__main__":
+    run(sys.argv[1] if len(sys.argv) > 1 else Path(__file__).parent / 'profile.json')
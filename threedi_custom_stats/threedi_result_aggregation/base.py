@@ -5,7 +5,7 @@
 
 import argparse
 import warnings
-from typing import List, Tuple, Union
+from typing import Iterator, List, Tuple, Union
 
 from threedigrid.admin.gridresultadmin import GridH5ResultAdmin
 from threedigrid.admin.nodes.models import Nodes
@@ -156,7 +156,58 @@ def prepare_timeseries(
         nodes_or_lines=nodes_or_lines, start_time=start_time, end_time=end_time
     )
     ts = nodes_or_lines.timeseries(ts_start_time, ts_end_time)
+    raw_values_signed = curate_timeseries(
+        ts=ts,
+        nodes_or_lines=nodes_or_lines,
+        aggregation=aggregation,
+        cfl_strictness=cfl_strictness,
+    )
+    return raw_values_signed, tintervals
+
 
+def prepare_timeseries_in_blocks(
+    nodes_or_lines: Union[Nodes, Lines],
+    aggregation: Aggregation,
+    start_time: float = None,
+    end_time: float = None,
+    cfl_strictness=1,
+    block_size: int = 100,
+) -> Iterator[Tuple[np.array, np.array]]:
+    """
+    Same as `prepare_timeseries`, but yields the timeseries in blocks of at most `block_size` timesteps, so that
+    aggregations that can be calculated incrementally (e.g. sum) do not require the entire timeseries to be in memory
+
+    :return: iterator of tuples of timeseries values, time intervals
+    """
+    ts_start_time, ts_end_time, tintervals = time_intervals(
+        nodes_or_lines=nodes_or_lines, start_time=start_time, end_time=end_time
+    )
+    ts_start_time_idx = int(np.where(np.array(nodes_or_lines.timestamps) == ts_start_time)[0][0])
+    for block_start in range(0, len(tintervals), block_size):
+        block_tintervals = tintervals[block_start:block_start + block_size]
+        first_idx = ts_start_time_idx + block_start
+        ts = nodes_or_lines.timeseries(indexes=slice(first_idx, first_idx + len(block_tintervals)))
+        raw_values_signed = curate_timeseries(
+            ts=ts,
+            nodes_or_lines=nodes_or_lines,
+            aggregation=aggregation,
+            cfl_strictness=cfl_strictness,
+        )
+        yield raw_values_signed, block_tintervals
+
+
+def curate_timeseries(
+    ts,
+    nodes_or_lines: Union[Nodes, Lines],
+    aggregation: Aggregation,
+    cfl_strictness=1,
+) -> np.array:
+    """
+    Return the values of the variable specified by `aggregation` from timeseries `ts`, with the fixes described in
+    `prepare_timeseries`
+
+    :param ts: result of `nodes_or_lines.timeseries()`
+    """
     # Line variables
     if aggregation.variable.short_name in ["q", "u1", "au", "qp", "up1"]:
         raw_values = getattr(ts, aggregation.variable.short_name)
@@ -250,7 +301,7 @@ def prepare_timeseries(
     else:
         raw_values_signed = raw_values
 
-    return raw_values_signed, tintervals
+    return raw_values_signed
 
 
 def aggregate_prepared_timeseries(